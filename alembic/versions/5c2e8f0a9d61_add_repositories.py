@@ -0,0 +1,33 @@
+"""Add repositories table
+
+Revision ID: 5c2e8f0a9d61
+Revises: e4a9c1d7b3f8
+Create Date: 2026-10-17 22:30:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c2e8f0a9d61'
+down_revision = 'e4a9c1d7b3f8'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('repositories',
+    sa.Column('path', sa.String(), nullable=False),
+    sa.Column('creator', sa.String(), nullable=True),
+    sa.Column('created', sa.DateTime(), nullable=True),
+    sa.Column('last_push', sa.DateTime(), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('packs', sa.Integer(), nullable=True),
+    sa.Column('scanned', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('path')
+    )
+
+
+def downgrade():
+    op.drop_table('repositories')
@@ -0,0 +1,26 @@
+"""Add maintenance time to repositories
+
+Revision ID: 8f1b6d2c4e73
+Revises: 5c2e8f0a9d61
+Create Date: 2026-10-17 23:40:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f1b6d2c4e73'
+down_revision = '5c2e8f0a9d61'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('repositories',
+                  sa.Column('maintained', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('repositories') as batch_op:
+        batch_op.drop_column('maintained')
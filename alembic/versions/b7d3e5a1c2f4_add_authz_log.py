@@ -0,0 +1,39 @@
+"""Add authz_log table, filled by triggers
+
+Revision ID: b7d3e5a1c2f4
+Revises: 4160ccb58402
+Create Date: 2026-10-17 19:40:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e5a1c2f4'
+down_revision = '4160ccb58402'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+from githome.model import AUTHZ_LOG_TRIGGERS
+
+
+def upgrade():
+    op.create_table('authz_log',
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('ident', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('version'),
+    sqlite_autoincrement=True
+    )
+
+    for trigger in AUTHZ_LOG_TRIGGERS:
+        op.execute(trigger.statement)
+
+
+def downgrade():
+    for table in ('users', 'public_keys', 'config'):
+        for event in ('insert', 'update', 'delete'):
+            op.execute('DROP TRIGGER authz_log_{}_{}'.format(table, event))
+
+    op.drop_table('authz_log')
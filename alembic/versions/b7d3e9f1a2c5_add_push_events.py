@@ -0,0 +1,37 @@
+"""Add push_events table
+
+Revision ID: b7d3e9f1a2c5
+Revises: 8f1b6d2c4e73
+Create Date: 2026-10-18 00:30:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e9f1a2c5'
+down_revision = '8f1b6d2c4e73'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('push_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('time', sa.DateTime(), nullable=False),
+    sa.Column('repo', sa.String(), nullable=False),
+    sa.Column('user', sa.String(), nullable=True),
+    sa.Column('ref', sa.String(), nullable=False),
+    sa.Column('old', sa.String(), nullable=False),
+    sa.Column('new', sa.String(), nullable=False),
+    sa.Column('request_id', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_push_events_repo_time', 'push_events',
+                    ['repo', 'time'])
+
+
+def downgrade():
+    op.drop_index('ix_push_events_repo_time', table_name='push_events')
+    op.drop_table('push_events')
@@ -0,0 +1,45 @@
+"""Add rules table, allowing everything by default
+
+Revision ID: e4a9c1d7b3f8
+Revises: b7d3e5a1c2f4
+Create Date: 2026-10-17 21:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e4a9c1d7b3f8'
+down_revision = 'b7d3e5a1c2f4'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+from githome.authz import DEFAULT_RULES
+from githome.model import RULE_LOG_TRIGGERS
+
+
+def upgrade():
+    rules = op.create_table('rules',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user', sa.String(), nullable=False),
+    sa.Column('pattern', sa.String(), nullable=False),
+    sa.Column('rights', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    for trigger in RULE_LOG_TRIGGERS:
+        op.execute(trigger.statement)
+
+    # existing installations keep allowing everything
+    op.bulk_insert(rules, [
+        {'user': user, 'pattern': pattern, 'rights': rights}
+        for user, pattern, rights in DEFAULT_RULES
+    ])
+
+
+def downgrade():
+    for event in ('insert', 'update', 'delete'):
+        op.execute('DROP TRIGGER authz_log_rules_{}'.format(event))
+
+    op.drop_table('rules')
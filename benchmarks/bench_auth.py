@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""Benchmark the functions on the authorization path.
+
+Covers path sanitization, rewriting large ``authorized_keys`` files,
+authorizing commands, and generating the ``authorized_keys`` block and
+updating ``authorized_keys`` for large numbers of keys. Results are written as
+JSON, see :mod:`compare` to compare two runs.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import click
+from pathlib import Path
+
+from benchlib import make_key_blob, populate, timed, write_results
+from githome.home import GitHome
+from githome.util import block_replace, block_update, sanitize_path
+
+
+PATH_SHAPES = {
+    'simple': 'foo',
+    'suffixed': 'foo.git',
+    'nested': 'foo/bar/baz',
+    'absolute': '/srv/git/foo/bar.git',
+    'quoted-chars': 'f o!o/b@r$(ls)/q"ux',
+    'deep': '/'.join('component{}'.format(i) for i in range(32)),
+    'long-name': 'x' * 200,
+}
+
+MARKER_START = '# -- added by githome bench, do not remove these markers --\n'
+MARKER_END = '# -- end githome bench. keep trailing newline! --\n'
+
+
+def ak_line(i):
+    from base64 import b64encode
+
+    return 'ssh-rsa {} user{}@host\n'.format(b64encode(make_key_blob(i)), i)
+
+
+def ak_buffer(size):
+    """Return an authorized_keys file of about ``size`` bytes, with a githome
+    block of half its size in the middle, the same file without the block and
+    the block itself."""
+    lines = []
+    total = 0
+    while total < size:
+        lines.append(ak_line(len(lines)))
+        total += len(lines[-1])
+
+    quarter = len(lines) // 4
+    before = ''.join(lines[:quarter])
+    block = ''.join(lines[quarter:3 * quarter])
+    after = ''.join(lines[3 * quarter:])
+
+    return (before + MARKER_START + block + MARKER_END + after,
+            before + after, block)
+
+
+def bench_sanitize_path(number):
+    for shape, path in sorted(PATH_SHAPES.items()):
+        yield {'params': {'shape': shape}}, timed(
+            lambda: sanitize_path(path), number=number
+        )
+
+
+def bench_block_replace(buffers):
+    for buf, _, block in buffers:
+        yield {'params': {'size': len(buf)}}, timed(
+            lambda: block_replace(MARKER_START, MARKER_END, buf, block)
+        )
+
+
+def bench_block_update(buffers):
+    for buf, no_block, block in buffers:
+        yield {'params': {'size': len(buf), 'case': 'replace'}}, timed(
+            lambda: block_update(MARKER_START, MARKER_END, buf, block)
+        )
+        yield {'params': {'size': len(buf), 'case': 'append'}}, timed(
+            lambda: block_update(MARKER_START, MARKER_END, no_block, block)
+        )
+
+
+def create_githome(root, num_keys):
+    path = Path(root) / str(num_keys)
+    path.mkdir()
+
+    gh = GitHome.initialize(path)
+    gh.config['local']['authorized_keys_file'] = os.devnull
+    gh.save()
+    populate(gh, num_keys)
+    return gh
+
+
+def bench_authorize_command(gh, number):
+    user = gh.get_user_by_name('user0')
+    gh.get_repo(sanitize_path('foo/bar'), create=True)
+
+    for name in ('git-upload-pack', 'git-receive-pack'):
+        yield {'params': {'command': name}}, timed(
+            lambda: gh.authorize_command(user, [name, 'foo/bar']),
+            number=number
+        )
+
+
+def bench_authorized_keys_block(gh, num_keys, repeat):
+    for gh_client in (True, False):
+        gh.config['local']['use_gh_client'] = gh_client
+        gh.save()
+
+        yield ({'params': {'keys': num_keys, 'use_gh_client': gh_client}},
+               timed(gh.get_authorized_keys_block, repeat=repeat))
+
+        # do not measure the identity map
+        gh.session.expunge_all()
+
+
+def bench_update_authorized_keys(gh, num_keys, repeat):
+    from sshkeys import Key as SSHKey
+
+    ak = gh.path / 'authorized_keys'
+    ak.open('w').close()
+    gh.config['local']['authorized_keys_file'] = str(ak)
+    gh.save()
+
+    yield ({'params': {'keys': num_keys, 'case': 'rebuild'}},
+           timed(lambda: gh.update_authorized_keys(full=True), repeat=repeat))
+
+    user = gh.get_user_by_name('user0')
+    blobs = (make_key_blob(num_keys + i) for i in range(repeat * 10))
+
+    def add_key():
+        gh.add_key(user, SSHKey(next(blobs)))
+        gh.session.commit()
+        gh.update_authorized_keys()
+
+    yield ({'params': {'keys': num_keys, 'case': 'add-one'}},
+           timed(add_key, repeat=repeat * 10))
+
+
+@click.command()
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Where to write the results.')
+@click.option('--keys', default='10000,50000,100000', metavar='N[,N...]',
+              help='Numbers of keys to generate authorized_keys blocks for.')
+@click.option('--buffer-sizes', default='1,4,16', metavar='MB[,MB...]',
+              help='Sizes of authorized_keys files to update, in megabytes.')
+@click.option('--number', default=10000, metavar='N',
+              help='Calls per measurement of the cheap functions.')
+@click.option('--repeat', default=3, metavar='N',
+              help='Measurements of authorized_keys block generation.')
+def main(output, keys, buffer_sizes, number, repeat):
+    results = {}
+
+    def run(name, benchmark):
+        for info, timing in benchmark:
+            info.update(timing)
+            results.setdefault(name, []).append(info)
+            click.echo('{:30s} {!s:50} {:.6f}s'.format(
+                name, info['params'], info['median']), err=True)
+
+    run('sanitize_path', bench_sanitize_path(number))
+    buffers = [ak_buffer(int(float(mb) * 1024 * 1024))
+               for mb in buffer_sizes.split(',')]
+    run('block_replace', bench_block_replace(buffers))
+    run('block_update', bench_block_update(buffers))
+
+    root = tempfile.mkdtemp(prefix='githome-bench-')
+    try:
+        for num_keys in (int(n) for n in keys.split(',')):
+            gh = create_githome(root, num_keys)
+
+            # does not depend on the number of keys
+            if 'authorize_command' not in results:
+                run('authorize_command',
+                    bench_authorize_command(gh, number // 10))
+
+            run('get_authorized_keys_block',
+                bench_authorized_keys_block(gh, num_keys, repeat))
+            run('update_authorized_keys',
+                bench_update_authorized_keys(gh, num_keys, repeat))
+    finally:
+        shutil.rmtree(root)
+
+    write_results(output, 'auth', results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""Load test ``githome run-server``.
+
+Starts a server on a temporary githome seeded with users and keys, then opens
+many concurrent connections speaking the same protocol as ``gh_client``. The
+requests mix valid, malformed and unknown fingerprints, as well as fetches and
+pushes. Reports throughput and latency percentiles, which makes stalls of the
+event loop visible in the tail latencies.
+"""
+
+from collections import Counter
+import errno
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+import click
+from pathlib import Path
+import trollius as asyncio
+from trollius import From, Return
+
+from benchlib import populate, write_results
+from githome.home import GitHome
+from githome.proto import HEADER, Message, unpack_header
+from githome.util import sanitize_path
+
+
+COMMANDS = ('git-upload-pack', 'git-receive-pack')
+
+
+def percentile(values, q):
+    """Return the ``q``-th percentile of sorted ``values``, by the nearest
+    rank method."""
+    if not values:
+        return None
+    rank = max(int(round(q / 100.0 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class Workload(object):
+    """Generates requests.
+
+    :param fingerprints: Hex-encoded fingerprints of known keys.
+    :param invalid: Share of requests with a malformed fingerprint.
+    :param unknown: Share of requests with a well-formed, unknown fingerprint.
+    :param push: Share of requests that are pushes.
+    :param repos: Number of distinct repositories requested.
+    """
+
+    def __init__(self, fingerprints, invalid, unknown, push, repos):
+        self.fingerprints = fingerprints
+        self.invalid = invalid
+        self.unknown = unknown
+        self.push = push
+        self.repos = repos
+
+    def request(self):
+        r = random.random()
+        if r < self.invalid:
+            kind, fp = 'invalid', 'not-a-fingerprint'
+        elif r < self.invalid + self.unknown:
+            kind, fp = 'unknown', os.urandom(16).encode('hex')
+        else:
+            kind, fp = 'valid', random.choice(self.fingerprints)
+
+        cmd = COMMANDS[random.random() < self.push]
+        repo = repo_name(random.randrange(self.repos))
+
+        return kind, Message([
+            ('op', 'auth'),
+            ('fingerprint', fp),
+            ('command', "{} '{}'".format(cmd, repo)),
+        ])
+
+
+class Refused(Exception):
+    pass
+
+
+@asyncio.coroutine
+def session(socket_path, request):
+    """Send a single request and wait for the reply, like ``gh_client``.
+
+    :return: The reply's status.
+    """
+    # connecting to a unix socket never blocks, but fails if the server's
+    # backlog is full. asyncio would wait for the socket to become writable
+    # and carry on as if it was connected
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        sock.close()
+        if e.errno == errno.EAGAIN:
+            raise Refused()
+        raise
+
+    reader, writer = yield From(asyncio.open_unix_connection(sock=sock))
+    try:
+        writer.write(request.encode())
+        _, length = unpack_header((yield From(
+            reader.readexactly(HEADER.size))))
+        reply = Message.decode((yield From(reader.readexactly(length))))
+    finally:
+        writer.close()
+
+    raise Return(reply.get('status'))
+
+
+@asyncio.coroutine
+def run_load(socket_path, workload, total, concurrency):
+    """Run ``total`` sessions, at most ``concurrency`` at a time.
+
+    :return: A list of ``(kind, outcome, latency)`` tuples.
+    """
+    results = []
+    sem = asyncio.Semaphore(concurrency)
+
+    @asyncio.coroutine
+    def one():
+        kind, request = workload.request()
+        start = default_timer()
+        try:
+            outcome = yield From(session(socket_path, request))
+        except Refused:
+            outcome = 'refused (backlog full)'
+        except (socket.error, OSError, asyncio.IncompleteReadError) as e:
+            outcome = 'failed ({})'.format(
+                getattr(e, 'strerror', None) or e.__class__.__name__)
+        finally:
+            sem.release()
+        results.append((kind, outcome, default_timer() - start))
+
+    tasks = []
+    for _ in range(total):
+        yield From(sem.acquire())
+        tasks.append(asyncio.ensure_future(one()))
+
+    yield From(asyncio.wait(tasks))
+    raise Return(results)
+
+
+def repo_name(i):
+    return 'bench/repo{}'.format(i)
+
+
+def run_client(args):
+    """Run a share of the load in its own process and event loop; a single
+    Python process cannot generate enough load to saturate the server."""
+    socket_path, workload, total, concurrency = args
+
+    # forked processes share the parent's random state
+    random.seed()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(
+            run_load(socket_path, workload, total, concurrency)
+        )
+    finally:
+        loop.close()
+
+
+def split(total, parts):
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+
+def create_githome(root, num_users, num_keys, num_repos):
+    gh = GitHome.initialize(root)
+    gh.config['local']['authorized_keys_file'] = os.devnull
+    gh.save()
+    fingerprints = populate(gh, num_keys,
+                            keys_per_user=max(num_keys // num_users, 1))
+
+    # fetches from missing repositories fail, so every repository exists
+    for i in range(num_repos):
+        gh.get_repo(sanitize_path(repo_name(i)), create=True)
+
+    return gh, fingerprints
+
+
+def start_server(gh, server_args, log):
+    args = [sys.executable, '-c', 'from githome.cmd import cli; cli()',
+            '--githome', str(gh.path), 'run-server'] + list(server_args)
+    proc = subprocess.Popen(args, stdout=log, stderr=log)
+
+    path = str(gh.path / gh.config['local']['gh_client_socket'])
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise click.ClickException('Server exited with status {}'
+                                       .format(proc.returncode))
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(path)
+        except socket.error:
+            time.sleep(0.1)
+        else:
+            return proc, path
+        finally:
+            sock.close()
+
+    proc.terminate()
+    raise click.ClickException('Server did not start')
+
+
+def summarize(results, elapsed):
+    latencies = sorted(latency for _, _, latency in results)
+
+    summary = {
+        'sessions': len(results),
+        'seconds': elapsed,
+        'throughput': len(results) / elapsed,
+        'outcomes': dict(Counter('{} {}'.format(kind, outcome)
+                                 for kind, outcome, _ in results)),
+    }
+    for q in (50, 95, 99, 100):
+        summary['p{}'.format(q)] = percentile(latencies, q)
+
+    return summary
+
+
+@click.command()
+@click.option('--users', default=1000, metavar='N',
+              help='Number of users. Each owns the same number of keys.')
+@click.option('--keys', default=3000, metavar='N',
+              help='Number of keys.')
+@click.option('--sessions', default=20000, metavar='N',
+              help='Total number of sessions.')
+@click.option('--concurrency', default=1000, metavar='N',
+              help='Maximum number of concurrent sessions.')
+@click.option('--processes', default=multiprocessing.cpu_count(),
+              metavar='N', help='Number of client processes.')
+@click.option('--invalid', default=0.05, metavar='SHARE',
+              help='Share of malformed fingerprints.')
+@click.option('--unknown', default=0.1, metavar='SHARE',
+              help='Share of unknown fingerprints.')
+@click.option('--push', default=0.2, metavar='SHARE',
+              help='Share of pushes.')
+@click.option('--repos', default=100, metavar='N',
+              help='Number of distinct repositories.')
+@click.option('--output', '-o', type=click.File('w'),
+              help='Also write the results as JSON.')
+@click.argument('server_args', nargs=-1)
+def main(users, keys, sessions, concurrency, processes, invalid, unknown,
+         push, repos, output, server_args):
+    """Load test a server, started with SERVER_ARGS passed on to
+    ``githome run-server``; e.g. ``-- --workers 4``."""
+    logging.basicConfig(level=logging.WARNING)
+
+    limit = raise_fd_limit()
+    if concurrency * 2 + 64 > limit:
+        click.echo('warning: file descriptor limit of {} may be too low for '
+                   '{} concurrent sessions'.format(limit, concurrency),
+                   err=True)
+
+    root = Path(tempfile.mkdtemp(prefix='githome-bench-'))
+    proc = None
+    try:
+        gh, fingerprints = create_githome(root, users, keys, repos)
+        workload = Workload(fingerprints, invalid, unknown, push, repos)
+
+        with open(str(root / 'server.log'), 'w') as log:
+            proc, path = start_server(gh, server_args, log)
+
+        pool = multiprocessing.Pool(processes)
+        start = default_timer()
+        results = pool.map(run_client, [
+            (path, workload, n, c) for n, c in zip(
+                split(sessions, processes), split(concurrency, processes)
+            )
+        ])
+        summary = summarize(sum(results, []), default_timer() - start)
+        pool.close()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(str(root))
+
+    click.echo('{sessions} sessions in {seconds:.2f}s, {throughput:.0f}/s'
+               .format(**summary))
+    click.echo('latency p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, '
+               'max {:.2f} ms'.format(*(summary[p] * 1000 for p in
+                                        ('p50', 'p95', 'p99', 'p100'))))
+    for outcome, n in sorted(summary['outcomes'].items()):
+        click.echo('  {:40s} {}'.format(outcome, n))
+
+    if output:
+        # median and params allow comparing runs with compare.py
+        summary.update(median=summary['p50'], params={
+            'users': users, 'keys': keys, 'concurrency': concurrency,
+            'processes': processes,
+            'server_args': ' '.join(server_args),
+        })
+        write_results(output, 'server', {'load': [summary]})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""Benchmark SQLite settings, see :mod:`githome.storage`.
+
+For every profile of settings, measures the latency of small commits, like
+those of ``githome user add``, the time to load the server's key index and
+how readers and a writer in separate processes hold each other up: a writer
+commits in a loop, while a reader loads the key index over and over on a
+read-only connection, like the server does. Lock errors are counted.
+"""
+
+import multiprocessing
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+import click
+from pathlib import Path
+from sqlalchemy.exc import OperationalError
+
+from benchlib import populate, timed, write_results
+from githome.cache import KeyIndex
+from githome.home import GitHome
+from githome.storage import SECTION, create_engine
+
+
+PROFILES = {
+    # SQLite's defaults, apart from pysqlite's five second timeout
+    'legacy': {'journal_mode': 'delete', 'busy_timeout': 5000,
+               'mmap_size': 0, 'synchronous': 'full'},
+    'default': {},
+    'wal-normal': {'synchronous': 'normal'},
+    'no-timeout': {'busy_timeout': 0},
+}
+
+
+def create_githome(root, profile, num_keys):
+    path = Path(root) / profile
+    path.mkdir()
+
+    gh = GitHome.initialize(path)
+    for name, value in PROFILES[profile].items():
+        gh.config.cset('{}.{}'.format(SECTION, name), value)
+    gh.save()
+    populate(gh, num_keys)
+
+    # a fresh instance, which uses the settings
+    return GitHome(path)
+
+
+def commit(gh, counter=[0]):
+    counter[0] += 1
+    gh.create_user('bench{}'.format(counter[0]))
+    gh.session.commit()
+
+
+def bench_commit(gh, repeat):
+    return timed(lambda: commit(gh), repeat=repeat)
+
+
+def bench_index_refresh(gh, repeat):
+    index = KeyIndex(create_engine(gh.dsn, read_only=True))
+    try:
+        return timed(lambda: index.refresh(force=True), repeat=repeat)
+    finally:
+        index.close()
+
+
+def write_loop(path, commits, start):
+    gh = GitHome(path)
+    start.wait()
+
+    latencies, errors = [], 0
+    for i in range(commits):
+        begin = default_timer()
+        try:
+            gh.create_user('writer{}'.format(i))
+            gh.session.commit()
+        except OperationalError:
+            gh.session.rollback()
+            errors += 1
+        latencies.append(default_timer() - begin)
+
+    return latencies, errors
+
+
+def read_loop(path, done, start, results):
+    gh = GitHome(path)
+    index = KeyIndex(create_engine(gh.dsn, read_only=True))
+    start.wait()
+
+    latencies, errors = [], 0
+    while not done.is_set():
+        begin = default_timer()
+        try:
+            index.refresh(force=True)
+        except OperationalError:
+            errors += 1
+        latencies.append(default_timer() - begin)
+
+    index.close()
+    results.put((latencies, errors))
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        'min': latencies[0],
+        'median': latencies[len(latencies) // 2],
+        'max': latencies[-1],
+        'calls': len(latencies),
+    }
+
+
+def bench_contention(gh, commits):
+    """Commit in one process while another one reads.
+
+    :return: Timings of the writer's commits and the reader's index loads,
+             including the number of lock errors of each.
+    """
+    path = str(gh.path)
+    start = multiprocessing.Event()
+    done = multiprocessing.Event()
+    results = multiprocessing.Queue()
+
+    reader = multiprocessing.Process(target=read_loop,
+                                     args=(path, done, start, results))
+    reader.start()
+
+    start.set()
+    try:
+        write_latencies, write_errors = write_loop(path, commits, start)
+    finally:
+        done.set()
+    read_latencies, read_errors = results.get()
+    reader.join()
+
+    write = summarize(write_latencies)
+    write['errors'] = write_errors
+    read = summarize(read_latencies)
+    read['errors'] = read_errors
+    return write, read
+
+
+@click.command()
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Where to write the results.')
+@click.option('--profiles', default=','.join(sorted(PROFILES)),
+              metavar='NAME[,NAME...]', help='Profiles of settings to run.')
+@click.option('--keys', default=50000, metavar='N',
+              help='Number of keys in the database.')
+@click.option('--repeat', default=20, metavar='N',
+              help='Measurements of commits and index loads.')
+@click.option('--commits', default=200, metavar='N',
+              help='Commits of the writer while measuring contention.')
+def main(output, profiles, keys, repeat, commits):
+    results = {}
+
+    def record(name, params, timing):
+        timing['params'] = params
+        results.setdefault(name, []).append(timing)
+        click.echo('{:20s} {!s:45} {:.6f}s (max {:.6f}s){}'.format(
+            name, params, timing['median'], timing['max'],
+            ', {} errors'.format(timing['errors']) if 'errors' in timing
+            else ''), err=True)
+
+    root = tempfile.mkdtemp(prefix='githome-bench-')
+    try:
+        for profile in profiles.split(','):
+            if profile not in PROFILES:
+                raise click.BadParameter('Unknown profile {}'.format(profile))
+
+            gh = create_githome(root, profile, keys)
+            params = {'profile': profile, 'keys': keys}
+
+            record('commit', params, bench_commit(gh, repeat))
+            record('index_refresh', params, bench_index_refresh(gh, repeat))
+
+            write, read = bench_contention(gh, commits)
+            record('contended_commit', params, write)
+            record('contended_refresh', params, read)
+    finally:
+        shutil.rmtree(root)
+
+    write_results(output, 'storage', results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
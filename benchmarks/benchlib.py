@@ -0,0 +1,108 @@
+"""Helpers shared by the benchmarks."""
+
+from datetime import datetime
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+from timeit import default_timer
+
+from sqlalchemy import insert
+
+
+def timed(func, repeat=5, number=1):
+    """Time ``func``.
+
+    :param repeat: How often to measure.
+    :param number: Calls of ``func`` per measurement.
+    :return: A dictionary of the best, median and worst time per call, in
+             seconds, and the number of calls.
+    """
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(number):
+            func()
+        times.append((default_timer() - start) / number)
+
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+        'calls': repeat * number,
+    }
+
+
+def ssh_string(data):
+    return struct.pack('!I', len(data)) + data
+
+
+def make_key_blob(i):
+    """Return the blob of a fake, but well-formed, 2048 bit RSA public key.
+
+    Different values for ``i`` result in different keys.
+    """
+    modulus = b'\x00' + struct.pack('!Q', i) + os.urandom(248)
+    return (ssh_string(b'ssh-rsa') + ssh_string(b'\x01\x00\x01') +
+            ssh_string(modulus))
+
+
+def populate(gh, num_keys, keys_per_user=3):
+    """Add ``num_keys`` keys, owned by ``num_keys / keys_per_user`` users.
+
+    Rows are inserted in bulk, bypassing the ORM, so large databases can be
+    created quickly.
+
+    :return: The hex-encoded fingerprints of all keys.
+    """
+    from hashlib import md5
+    from githome.model import PublicKey, User
+
+    num_users = max(num_keys // keys_per_user, 1)
+
+    with gh.bind.begin() as con:
+        con.execute(insert(User.__table__), [
+            {'id': i + 1, 'name': 'user{}'.format(i)}
+            for i in range(num_users)
+        ])
+
+        rows = []
+        for i in range(num_keys):
+            blob = make_key_blob(i)
+            rows.append({'fingerprint': md5(blob).hexdigest(),
+                         'user_id': i % num_users + 1,
+                         'data': blob})
+        con.execute(insert(PublicKey.__table__), rows)
+
+    return [row['fingerprint'] for row in rows]
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_results(out, name, results):
+    """Write benchmark results as JSON, along with details about the
+    environment they were measured in."""
+    json.dump({
+        'benchmark': name,
+        'revision': git_revision(),
+        'date': datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results,
+    }, out, indent=2, separators=(',', ': '), sort_keys=True)
+    out.write('\n')
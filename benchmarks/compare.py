@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Compare two benchmark result files.
+
+Measurements are matched by benchmark name and parameters; the ratio of
+their medians is shown. Exits with a non-zero status if any measurement got
+slower by more than the given threshold.
+"""
+
+import json
+import sys
+
+import click
+
+from benchlib import load_results
+
+
+def index(results):
+    return {(name, json.dumps(m['params'], sort_keys=True)): m
+            for name, measurements in results['results'].items()
+            for m in measurements}
+
+
+@click.command()
+@click.argument('old', type=click.Path(exists=True))
+@click.argument('new', type=click.Path(exists=True))
+@click.option('--threshold', default=1.25, metavar='RATIO',
+              help='Maximum ratio of new to old median before a measurement '
+                   'counts as a regression.')
+def main(old, new, threshold):
+    old, new = load_results(old), load_results(new)
+    old_index, new_index = index(old), index(new)
+
+    click.echo('{} -> {}'.format(old['revision'], new['revision']))
+
+    regressions = 0
+    for key in sorted(set(old_index) & set(new_index)):
+        before, after = old_index[key]['median'], new_index[key]['median']
+        ratio = after / before if before else float('inf')
+
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+
+        click.echo('{:30s} {:50s} {:12.6f}s {:12.6f}s {:7.2f}x{}'.format(
+            key[0], key[1], before, after, ratio, flag
+        ))
+
+    for key in sorted(set(old_index) ^ set(new_index)):
+        click.echo('{:30s} {:50s} only in {}'.format(
+            key[0], key[1], 'old' if key in old_index else 'new'
+        ))
+
+    if regressions:
+        click.echo('{} regression(s)'.format(regressions), err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Measure how long it takes to import the githome CLI.
+
+Every call of ``githome`` pays for importing :mod:`githome.cmd`, so it must
+stay cheap. The import is run in a fresh interpreter several times and the
+fastest run is compared to a budget; the script exits with a non-zero status
+if the budget is exceeded or if a module that should be imported lazily is
+loaded.
+
+On Python 3.7 and later, the time is taken from ``-X importtime`` and the
+slowest modules are listed. Older interpreters lack ``-X importtime``, there
+the wall clock time of the interpreter is measured and the time to start an
+interpreter that imports nothing is subtracted.
+"""
+
+import json
+import subprocess
+import sys
+from timeit import default_timer
+
+import click
+
+
+#: Modules only some commands need. Importing :mod:`githome.cmd` must not load
+#: any of them.
+LAZY_MODULES = ('sqlalchemy', 'sqlacfg', 'sshkeys', 'trollius')
+
+CHECK_MODULES = '''
+import json, sys
+import {module}
+json.dump(sorted(set(m.split('.')[0] for m, mod in sys.modules.items()
+                     if mod is not None) & set({lazy!r})),
+          sys.stdout)
+'''
+
+
+def has_importtime():
+    return sys.version_info >= (3, 7)
+
+
+def parse_importtime(output):
+    """Parse the output of ``-X importtime``.
+
+    :return: A tuple of the total import time and a list of ``(cumulative
+             time, module)`` tuples, both in microseconds.
+    """
+    total = 0
+    modules = []
+
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        cumulative, name = int(fields[1]), fields[2]
+
+        # top-level imports are not indented
+        if not name.startswith('  '):
+            total += cumulative
+        modules.append((cumulative, name.strip()))
+
+    return total, modules
+
+
+def run_import(module, importtime):
+    args = [sys.executable]
+    if importtime:
+        args.extend(['-X', 'importtime'])
+    args.extend(['-c', 'import {}'.format(module)])
+
+    start = default_timer()
+    proc = subprocess.Popen(args, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    _, err = proc.communicate()
+    elapsed = default_timer() - start
+
+    if proc.returncode != 0:
+        raise click.ClickException('Importing {} failed:\n{}'.format(module,
+                                                                     err))
+    return elapsed, err
+
+
+def measure(module, runs):
+    """Return the fastest import time of ``module`` in seconds and, if
+    available, the modules it imported as reported by ``-X importtime``."""
+    importtime = has_importtime()
+    best, best_modules = None, []
+
+    for _ in range(runs):
+        elapsed, err = run_import(module, importtime)
+
+        if importtime:
+            total, modules = parse_importtime(err)
+            elapsed = total / 1e6
+        else:
+            modules = []
+            elapsed -= min(run_import('sys', False)[0] for _ in range(3))
+
+        if best is None or elapsed < best:
+            best, best_modules = elapsed, modules
+
+    return max(best, 0.0), best_modules
+
+
+def loaded_lazy_modules(module):
+    out = subprocess.check_output([
+        sys.executable, '-c', CHECK_MODULES.format(module=module,
+                                                   lazy=LAZY_MODULES)
+    ], universal_newlines=True)
+    return json.loads(out)
+
+
+@click.command()
+@click.option('--module', default='githome.cmd',
+              help='The module to import.')
+@click.option('--runs', default=10, metavar='N',
+              help='Number of imports, the fastest one counts.')
+@click.option('--max-ms', default=150.0, metavar='MS',
+              help='Fail if importing takes longer than this.')
+@click.option('--top', default=10, metavar='N',
+              help='Number of slowest modules to show, if known.')
+def main(module, runs, max_ms, top):
+    elapsed, modules = measure(module, runs)
+    elapsed_ms = elapsed * 1000
+
+    click.echo('import {}: {:.1f} ms (budget {:.1f} ms, best of {}, {})'
+               .format(module, elapsed_ms, max_ms, runs,
+                       '-X importtime' if has_importtime() else 'wall clock'))
+
+    for cumulative, name in sorted(modules, reverse=True)[:top]:
+        click.echo('  {:8.1f} ms  {}'.format(cumulative / 1000.0, name))
+
+    failed = False
+    if elapsed_ms > max_ms:
+        click.echo('FAIL: import time over budget', err=True)
+        failed = True
+
+    lazy = loaded_lazy_modules(module)
+    if lazy:
+        click.echo('FAIL: modules that should be imported lazily were '
+                   'loaded: {}'.format(', '.join(lazy)), err=True)
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+"""Authorization without a database.
+
+``githome-shell`` runs once for every SSH connection. Importing SQLAlchemy and
+opening the database would take up most of its runtime, so instead it looks up
+keys in a snapshot file that is rewritten whenever keys or users change.
+
+The snapshot starts with a header of the magic ``GHAZ``, a format version and
+the number of keys. It is followed by one fixed-size record per key, sorted by
+the key's binary MD5 fingerprint, and finally the user names referenced by the
+records. A lookup is a binary search over the memory-mapped records, no matter
+how many keys there are.
+
+Access to repositories is governed by rules, each granting a user, or
+everyone, read, write and/or create rights to repositories whose path
+matches a glob pattern (see :class:`RuleSet`). ``githome-shell`` reads them
+from a JSON file written along with the snapshot.
+
+This module, like everything ``githome-shell`` uses, must only import the
+standard library.
+"""
+
+from binascii import unhexlify
+from collections import namedtuple
+import errno
+import fnmatch
+import json
+import mmap
+import re
+import struct
+
+from pathlib import Path
+
+from .exc import KeyNotFoundError, PermissionDenied, GitHomeError
+
+
+SNAPSHOT_PATH = 'githome.authz'
+SNAPSHOT_MAGIC = b'GHAZ'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('!4sII')
+# fingerprint, user id, name offset, name length
+SNAPSHOT_RECORD = struct.Struct('!16sIIH')
+
+CMD_WHITELIST = [
+    'git-upload-pack',
+    'git-receive-pack',
+    'git-upload-archive',
+]
+
+
+RULES_PATH = 'githome.rules'
+
+READ, WRITE, CREATE = 1, 2, 4
+RIGHTS = (('r', READ), ('w', WRITE), ('c', CREATE))
+
+#: User name of rules that apply to everyone.
+ANYONE = '*'
+
+#: Rules of a new githome: everyone may read, write and create everything.
+DEFAULT_RULES = [(ANYONE, '**', 'rwc')]
+
+#: Rights needed to run each command.
+CMD_RIGHTS = {
+    'git-upload-pack': READ,
+    'git-receive-pack': WRITE,
+    'git-upload-archive': READ,
+}
+
+
+#: Lightweight, session-independent stand-in for a :class:`~model.User`.
+AuthUser = namedtuple('AuthUser', ['id', 'name'])
+
+
+def sanitize_path(path, subchar='-', invalid_chars=r'[^a-zA-Z0-9-_.]',
+                  invalid_comps=('.', '..', '.git'), force_suffix='.git'):
+    """Sanitizes a path by making it relative and git safe.
+
+    Any part coming in will be made relative first (by cutting leading
+    slashes). Invalid characters (see ``invalid_chars``) are removed and
+    replaced with ``subchar``. A suffix can be forced upon the path as well.
+
+    :param path: Path to sanitize (string or Path).
+    :param subchar: Character used to substitute illegal path components with.
+    :param invalid_chars: A regular expression that matches invalid characters.
+    :param invalid_comps: A collection of path components that are not allowed.
+    :param force_suffix: The suffix to force onto each path.
+    :return: A Path instance denoting a relative path.
+    """
+    unsafe = Path(path)
+
+    # turn absolute path into a relative one by stripping the leading '/'
+    if unsafe.is_absolute():
+        unsafe = unsafe.relative_to(unsafe.anchor)
+
+    # every component must be alphanumeric
+    components = []
+    for p in unsafe.parts:
+        # remove invalid characters
+        clean = re.sub(invalid_chars, subchar, p)
+
+        # if the name is empty, ignore it. this usually shouldn't happend with
+        # pathlib
+        if not clean:
+            continue
+
+        # if the name is potentially dangerous, reject it
+        if clean in invalid_comps:
+            raise ValueError('{} is a reserved path component'.format(clean))
+
+        components.append(clean)
+
+    if not components:
+        raise ValueError('Path too short')
+
+    # append a final suffix if not present
+    if force_suffix and not components[-1].endswith(force_suffix):
+        components[-1] += force_suffix
+
+    return Path(*components)
+
+
+def parse_rights(rights):
+    """Convert a string of rights, like ``rw``, into a bit mask.
+
+    :raise ValueError: If the string contains anything but ``r``, ``w`` and
+                       ``c``.
+    """
+    mask = 0
+    for char in rights:
+        for name, bit in RIGHTS:
+            if char == name:
+                mask |= bit
+                break
+        else:
+            raise ValueError('Invalid right {!r}, must be r, w or c'
+                             .format(char))
+    return mask
+
+
+def format_rights(mask):
+    return ''.join(name if mask & bit else '-' for name, bit in RIGHTS)
+
+
+def split_pattern(pattern, force_suffix='.git'):
+    """Split a repository path pattern into components.
+
+    Components may contain the wildcards ``*``, ``?`` and ``[...]`` of
+    :mod:`fnmatch`, which never match across slashes. A component of just
+    ``**`` matches any number of components, including none. Like paths
+    passed through :func:`sanitize_path`, the last component is given the
+    ``.git`` suffix, unless it is a wildcard that matches it anyway.
+
+    :raise ValueError: If the pattern is empty or contains ``.`` or ``..``.
+    """
+    components = [c for c in pattern.split('/') if c]
+    if not components:
+        raise ValueError('Empty pattern')
+
+    for c in components:
+        if c in ('.', '..'):
+            raise ValueError('{} is a reserved path component'.format(c))
+        if '**' in c and c != '**':
+            raise ValueError('** must be a path component of its own')
+
+    last = components[-1]
+    if not (last.endswith('*') or last.endswith(force_suffix)):
+        components[-1] += force_suffix
+
+    return components
+
+
+class _Node(object):
+    __slots__ = ('children', 'globs', 'deep', 'loop', 'rights')
+
+    def __init__(self, loop=False):
+        # literal component -> node
+        self.children = {}
+        # (component, match function, node) for components with wildcards
+        self.globs = []
+        # node of a following ``**`` component
+        self.deep = None
+        # whether this is a ``**`` node, which matches any component
+        self.loop = loop
+        # user name -> rights of rules ending here
+        self.rights = {}
+
+
+class RuleSet(object):
+    """Access rules, compiled into a trie of path components.
+
+    Each rule is a tuple of a user name (or :data:`ANYONE`), a pattern, as
+    described in :func:`split_pattern`, and the rights it grants, as parsed
+    by :func:`parse_rights`. Rights of all matching rules add up; there is
+    no way to take away rights granted by another rule.
+
+    Looking up the rights to a path walks the trie one path component at a
+    time. Literal components are found in a dictionary, so unless patterns
+    with wildcards branch off at the same place, a check costs
+    ``O(path depth)``, no matter how many rules there are.
+
+    :param rules: An iterable of ``(user, pattern, rights)`` tuples.
+    :raise ValueError: If a rule is invalid.
+    """
+
+    def __init__(self, rules=()):
+        self.root = _Node()
+        self.rules = []
+
+        for rule in rules:
+            self.add(*rule)
+
+    def add(self, user, pattern, rights):
+        mask = parse_rights(rights)
+        node = self.root
+
+        for c in split_pattern(pattern):
+            if c == '**':
+                if node.deep is None:
+                    node.deep = _Node(loop=True)
+                node = node.deep
+            elif any(char in c for char in '*?['):
+                for glob, _, child in node.globs:
+                    if glob == c:
+                        node = child
+                        break
+                else:
+                    child = _Node()
+                    node.globs.append(
+                        (c, re.compile(fnmatch.translate(c)).match, child))
+                    node = child
+            else:
+                node = node.children.setdefault(c, _Node())
+
+        node.rights[user] = node.rights.get(user, 0) | mask
+        self.rules.append((user, pattern, rights))
+
+    @staticmethod
+    def _expand(nodes):
+        # a ``**`` may also match no components at all
+        expanded = set()
+        for node in nodes:
+            while node is not None and node not in expanded:
+                expanded.add(node)
+                node = node.deep
+        return expanded
+
+    def rights(self, user_name, rel_path):
+        """Return the rights of a user to a repository.
+
+        :param rel_path: A path as returned by :func:`sanitize_path`.
+        :return: A bit mask of :data:`READ`, :data:`WRITE` and
+                 :data:`CREATE`.
+        """
+        nodes = self._expand([self.root])
+
+        for c in rel_path.parts:
+            matched = []
+            for node in nodes:
+                if node.loop:
+                    matched.append(node)
+
+                child = node.children.get(c)
+                if child is not None:
+                    matched.append(child)
+
+                for _, match, child in node.globs:
+                    if match(c):
+                        matched.append(child)
+
+            if not matched:
+                return 0
+            nodes = self._expand(matched)
+
+        mask = 0
+        for node in nodes:
+            mask |= node.rights.get(user_name, 0) | node.rights.get(ANYONE, 0)
+        return mask
+
+    @classmethod
+    def load(cls, path):
+        """Load rules written by :func:`write_rules`.
+
+        A githome that never wrote any rules has the :data:`DEFAULT_RULES`.
+        """
+        try:
+            with open(str(path), 'rb') as f:
+                rules = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            rules = DEFAULT_RULES
+
+        return cls((user, pattern, rights) for user, pattern, rights in rules)
+
+
+def write_rules(out, rules):
+    """Write rules for :meth:`RuleSet.load`.
+
+    :param out: A file opened for writing.
+    :param rules: An iterable of ``(user, pattern, rights)`` tuples.
+    """
+    json.dump([list(rule) for rule in rules], out)
+
+
+def check_command(user, command, rules=None):
+    """Check if a user may run a command.
+
+    Only checks the command itself, the repository is not accessed.
+
+    :param user: The user requesting to run the command.
+    :param command: The command, split into a list of arguments.
+    :param rules: A :class:`RuleSet` to check the user's rights to the
+                  repository with. If ``None``, everyone has all rights.
+    :return: A tuple of the command name, the sanitized relative
+             repository path and whether or not the repository may be
+             created if it does not exist.
+    """
+    if not command:
+        raise PermissionDenied('No command given')
+
+    if not command[0] in CMD_WHITELIST:
+        raise PermissionDenied(
+            '{} is not a whitelisted command.'.format(command[0])
+        )
+
+    if len(command) < 2:
+        raise PermissionDenied(
+            'Missing repository parameter'
+        )
+
+    rel_path = sanitize_path(command[1])
+    rights = (READ | WRITE | CREATE if rules is None
+              else rules.rights(user.name, rel_path))
+
+    needed = CMD_RIGHTS[command[0]]
+    if rights & needed != needed:
+        raise PermissionDenied('{} may not {} {}'.format(
+            user.name, 'write to' if needed & WRITE else 'read', rel_path))
+
+    # only pushing creates repositories, fetching from a mistyped path
+    # should not leave an empty repository behind
+    can_create = command[0] == 'git-receive-pack' and bool(rights & CREATE)
+
+    return command[0], rel_path, can_create
+
+
+def build_command(name, repo_path):
+    """Build the command line for an authorized command.
+
+    :param name: The command name, as returned by :func:`check_command`.
+    :param repo_path: Absolute path of the repository.
+    """
+    if name == 'git-upload-pack':
+        return [name, '--strict',   # do not try /.git
+                str(repo_path)]
+    elif name == 'git-receive-pack':
+        return [name, str(repo_path)]
+    elif name == 'git-upload-archive':
+        return [name, str(repo_path)]
+    else:
+        raise GitHomeError(
+            'Command {} is whitelisted, but not explicitly handled.'
+            .format(name)
+        )
+
+
+def write_snapshot(out, rows):
+    """Write a snapshot.
+
+    :param out: A file opened for writing in binary mode.
+    :param rows: An iterable of ``(fingerprint, user id, user name)`` tuples,
+                 with hex-encoded fingerprints.
+    """
+    records = []
+    names = {}
+    blob = []
+    offset = 0
+
+    for fp, uid, name in rows:
+        name = name.encode('utf8')
+        if name not in names:
+            names[name] = offset
+            blob.append(name)
+            offset += len(name)
+        records.append((unhexlify(fp), uid, names[name], len(name)))
+
+    records.sort()
+
+    out.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                   len(records)))
+    for record in records:
+        out.write(SNAPSHOT_RECORD.pack(*record))
+    out.write(b''.join(blob))
+
+
+class Snapshot(object):
+    """A memory-mapped snapshot, see :func:`write_snapshot`.
+
+    :param path: Path of the snapshot file.
+    """
+
+    def __init__(self, path):
+        with open(str(path), 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.buf) < SNAPSHOT_HEADER.size:
+            raise GitHomeError('Truncated authorization snapshot')
+
+        magic, version, self.count = SNAPSHOT_HEADER.unpack_from(self.buf)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise GitHomeError('Not an authorization snapshot or unsupported '
+                               'version')
+
+        self.names_start = (SNAPSHOT_HEADER.size +
+                            self.count * SNAPSHOT_RECORD.size)
+        if len(self.buf) < self.names_start:
+            raise GitHomeError('Truncated authorization snapshot')
+
+    def _record(self, i):
+        return SNAPSHOT_RECORD.unpack_from(
+            self.buf, SNAPSHOT_HEADER.size + i * SNAPSHOT_RECORD.size
+        )
+
+    def lookup(self, fingerprint):
+        """Find the user owning a key.
+
+        :param fingerprint: The hex-encoded fingerprint of the key.
+        :return: An :class:`AuthUser` instance.
+        """
+        try:
+            digest = unhexlify(fingerprint)
+        except (TypeError, ValueError):
+            digest = None
+
+        lo, hi = 0, self.count
+        while digest and lo < hi:
+            mid = (lo + hi) // 2
+            fp, uid, offset, length = self._record(mid)
+
+            if fp < digest:
+                lo = mid + 1
+            elif fp > digest:
+                hi = mid
+            else:
+                start = self.names_start + offset
+                return AuthUser(uid,
+                                self.buf[start:start + length].decode('utf8'))
+
+        raise KeyNotFoundError('Key {} not found'.format(fingerprint))
+
+    def close(self):
+        self.buf.close()
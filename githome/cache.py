@@ -0,0 +1,196 @@
+from collections import OrderedDict
+import threading
+from timeit import default_timer
+
+import logbook
+from sqlalchemy import func, select
+
+from .authz import AuthUser
+from .model import AuthzLog, User, PublicKey
+from .exc import KeyNotFoundError
+
+
+log = logbook.Logger('cache')
+
+
+class LRUCache(object):
+    """A dictionary of at most ``size`` items. Once full, adding an item
+    evicts the least recently added or updated one.
+
+    :param size: Maximum number of items.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._items.pop(key, default)
+
+    def clear(self):
+        self._items.clear()
+
+
+class RateLimiter(object):
+    """Token buckets, one per key, e.g. a fingerprint.
+
+    Every bucket holds up to ``burst`` tokens and gains ``rate`` tokens per
+    second. :meth:`charge` takes tokens out, :meth:`allowed` checks whether
+    any are left. Only buckets that have been charged take up memory, and
+    no more than ``size`` of them are kept, so clients making up new keys
+    cannot exhaust memory.
+
+    :param rate: Tokens gained per second.
+    :param burst: Maximum number of tokens in a bucket.
+    :param size: Maximum number of buckets to keep.
+    :param clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, rate, burst, size=10000, clock=default_timer):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets = LRUCache(size)
+
+    def _tokens(self, key, now):
+        tokens, stamp = self.buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - stamp) * self.rate)
+
+    def allowed(self, key):
+        """Return whether the bucket of ``key`` has a token left."""
+        return self._tokens(key, self.clock()) >= 1
+
+    def charge(self, key, tokens=1):
+        """Take tokens out of the bucket of ``key``."""
+        now = self.clock()
+        self.buckets[key] = (self._tokens(key, now) - tokens, now)
+
+
+class KeyIndex(object):
+    """In-memory fingerprint to user index.
+
+    The index is loaded in a single query on a dedicated connection and kept
+    around until users, keys, rules or the configuration change. Commits are
+    detected through SQLite's ``PRAGMA data_version``, which is bumped
+    whenever *another* connection commits to the database. Polling it is
+    cheap, as it does not read any tables. Since most commits, like those of
+    the push journal, touch none of the above, the index is only reloaded if
+    the latest version of the ``authz_log`` table, see
+    :class:`~githome.model.AuthzLog`, has changed as well.
+
+    Since rows are loaded through the SQL expression layer and not the ORM,
+    no stale instances are kept in any session's identity map.
+
+    Fingerprints that were looked up but not found are remembered in
+    :attr:`unknown`, a bounded :class:`LRUCache`, until the index is
+    reloaded with different keys. Callers can check it to
+    turn away clients that keep trying the same unknown key cheaply, without
+    logging every attempt.
+
+    :meth:`refresh` may be called from any thread, but only one refresh runs
+    at a time. Lookups never block, they are served from whichever index was
+    loaded last.
+
+    :param bind: An :class:`~sqlalchemy.engine.Engine` to connect to. If
+                 refreshes happen outside the creating thread, its connections
+                 must not be bound to a single thread.
+    :param unknown_size: Maximum number of unknown fingerprints to remember.
+    """
+
+    def __init__(self, bind, unknown_size=10000):
+        self.bind = bind
+        self.keys = {}
+        self.unknown = LRUCache(unknown_size)
+        self.version = None
+        self._data_version = None
+        self._con = None
+        self._lock = threading.Lock()
+
+    @property
+    def con(self):
+        if self._con is None:
+            self._con = self.bind.connect()
+        return self._con
+
+    def data_version(self):
+        return self.con.execute('PRAGMA data_version').scalar()
+
+    def log_version(self):
+        return self.con.execute(
+            select([func.max(AuthzLog.__table__.c.version)])
+        ).scalar() or 0
+
+    def refresh(self, force=False):
+        """Reload the index if the database has changed.
+
+        :param force: Reload, even if no change has been detected.
+        :return: ``True`` if the index was reloaded.
+        """
+        with self._lock:
+            return self._refresh(force)
+
+    def _refresh(self, force):
+        # the versions are read before loading; a commit that happens while
+        # we are loading will cause another reload on the next call
+        data_version = self.data_version()
+        if not force and data_version == self._data_version:
+            return False
+        self._data_version = data_version
+
+        version = self.log_version()
+        if not force and version == self.version:
+            return False
+
+        keys, users = PublicKey.__table__, User.__table__
+        qry = (select([keys.c.fingerprint, users.c.id, users.c.name])
+               .select_from(keys.join(users)))
+
+        loaded = {fp: AuthUser(uid, name)
+                  for fp, uid, name in self.con.execute(qry)}
+        if loaded != self.keys:
+            # replaced rather than cleared, lookups may be adding to it from
+            # another thread
+            self.unknown = LRUCache(self.unknown.size)
+        self.keys = loaded
+        self.version = version
+
+        log.debug('Loaded {} keys (authz_log version {})'.format(
+            len(self.keys), version))
+        return True
+
+    def lookup(self, fingerprint, remember=True):
+        """Find the user owning a key.
+
+        :param fingerprint: The hex-encoded fingerprint of the key.
+        :param remember: Add the fingerprint to :attr:`unknown`, if it is not
+                         found.
+        :return: An :class:`AuthUser` instance.
+        """
+        fingerprint = fingerprint.lower()
+        try:
+            return self.keys[fingerprint]
+        except KeyError:
+            if remember:
+                self.unknown[fingerprint] = True
+            raise KeyNotFoundError('Key {} not found'.format(fingerprint))
+
+    def close(self):
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
@@ -1,6 +1,5 @@
 from binascii import unhexlify
 import logbook
-import logging
 import pathlib
 import os
 import shlex
@@ -9,13 +8,13 @@ import sys
 import click
 from logbook import NullHandler, Logger
 from logbook.more import ColorizedStderrHandler
-from logbook.compat import redirect_logging
-from sqlacfg.format import ini_format
-from sshkeys import Key as SSHKey
 
-from .home import GitHome
 from .util import ConfigName, ConfigValue, RegEx
 
+# heavier modules, like SQLAlchemy, sshkeys or trollius, are only imported by
+# the commands that need them. scripts call the CLI often, each call should
+# not pay for more than it uses; see benchmarks/import_time.py
+
 
 log = Logger('cli')
 
@@ -24,19 +23,47 @@ def abort(status=1):
     sys.exit(status)
 
 
+class CLIContext(dict):
+    """Context object of the CLI.
+
+    The :class:`~githome.home.GitHome` is only loaded once a command accesses
+    ``obj['githome']``.
+    """
+
+    def __missing__(self, key):
+        if key != 'githome':
+            raise KeyError(key)
+
+        from .home import GitHome
+
+        path = self['githome_path']
+
+        # check if the home is valid
+        if not GitHome.check(path):
+            log.critical('Not a valid githome: "{}"; use {} init to '
+                         'initialize it first.'.format(path, 'githome'))
+            abort(1)
+
+        gh = self[key] = GitHome(path)
+        return gh
+
+
 @click.group()
 @click.option('-d', '--debug', 'loglevel', flag_value=logbook.DEBUG)
 @click.option('-q', '--quiet', 'loglevel', flag_value=logbook.WARNING)
 @click.option('--githome', default='.', metavar='PATH', type=click.Path())
 @click.pass_context
 def cli(ctx, githome, loglevel):
-    ctx.obj = {}
+    ctx.obj = CLIContext()
 
     if loglevel is None:
         loglevel = logbook.INFO
 
     # setup sqlalchemy loglevel
     if loglevel is logbook.DEBUG:
+        import logging
+        from logbook.compat import redirect_logging
+
         redirect_logging()
         logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
 
@@ -47,20 +74,7 @@ def cli(ctx, githome, loglevel):
     handler.push_application()
 
     ctx.obj['githome_path'] = pathlib.Path(githome)
-
-    # if we're just calling init, do not initialize githome
-    if ctx.invoked_subcommand == 'init':
-        return
-
-    # check if the home is valid
-    if not GitHome.check(ctx.obj['githome_path']):
-        log.critical('Not a valid githome: "{}"; use {} init to initialize it '
-                     'first.'.format(githome, 'githome'))
-        abort(1)
-
-    # create and add to context
-    gh = GitHome(ctx.obj['githome_path'])
-    ctx.obj['githome'] = gh
+    ctx.obj['loglevel'] = loglevel
 
 
 @cli.command()
@@ -96,10 +110,82 @@ def shell(obj, username):
 
 
 @cli.command('run-server')
+@click.option('--poll-interval', default=1.0, metavar='SECONDS',
+              help='How often to check the database for changes to users '
+                   'and keys.')
+@click.option('--threads', default=4, metavar='N',
+              help='Maximum number of threads used for database and '
+                   'filesystem access.')
+@click.option('--workers', default=0, metavar='N',
+              help='Number of pre-forked worker processes. By default, '
+                   'clients are served from a single process.')
+@click.option('--pool-size', default=2, metavar='N',
+              help='Number of pre-initialized repositories to keep around for '
+                   'pushes to new repositories.')
+@click.option('--metrics-file', type=click.Path(), metavar='PATH',
+              help='Periodically write metrics in Prometheus text format to '
+                   'this file. With multiple workers, the worker number is '
+                   'inserted before the extension.')
+@click.option('--metrics-interval', default=15.0, metavar='SECONDS',
+              help='How often to write the metrics file.')
+@click.option('--idle-timeout', type=float, metavar='SECONDS',
+              help='Exit after this many seconds without connections. Meant '
+                   'for use with systemd socket activation.')
+@click.option('--failure-burst', default=20, metavar='N',
+              help='Failed authorizations of a key or user in a row before '
+                   'it is throttled.')
+@click.option('--failure-rate', default=1.0, metavar='PER_SECOND',
+              help='Failed authorizations of a throttled key or user allowed '
+                   'per second.')
+@click.option('--maintenance-jobs', default=1, metavar='N',
+              help='Maximum number of repositories to repack at once. 0 '
+                   'disables repository maintenance.')
+@click.option('--maintenance-interval', default=60.0, metavar='SECONDS',
+              help='How often to look for repositories that need '
+                   'maintenance.')
+@click.option('--journal-interval', default=1.0, metavar='SECONDS',
+              help='How often to write pushes reported by the post-receive '
+                   'hook to the database.')
+@click.option('--journal-retention', default=90, metavar='DAYS',
+              help='Days to keep reported pushes for. 0 keeps them forever.')
 @click.pass_obj
-def run_server(obj):
+def run_server(obj, poll_interval, threads, workers, pool_size, metrics_file,
+               metrics_interval, idle_timeout, failure_burst, failure_rate,
+               maintenance_jobs, maintenance_interval, journal_interval,
+               journal_retention):
     gh = obj['githome']
-    gh.run_server(debug=True)
+
+    if idle_timeout and workers:
+        raise click.BadParameter('cannot be combined with --workers',
+                                 param_hint='--idle-timeout')
+
+    # event loop debugging is expensive, it records a traceback for every
+    # coroutine and callback
+    gh.run_server(debug=obj['loglevel'] is logbook.DEBUG,
+                  poll_interval=poll_interval, threads=threads,
+                  workers=workers, pool_size=pool_size,
+                  metrics_file=metrics_file,
+                  metrics_interval=metrics_interval,
+                  idle_timeout=idle_timeout,
+                  failure_rate=failure_rate, failure_burst=failure_burst,
+                  maintenance_jobs=maintenance_jobs,
+                  maintenance_interval=maintenance_interval,
+                  journal_interval=journal_interval,
+                  journal_retention=journal_retention or None)
+
+
+@cli.command('server-stats',
+             help='Show metrics of the running server')
+@click.pass_obj
+def server_stats(obj):
+    gh = obj['githome']
+
+    stats = gh.notify_server('STATS')
+    if stats is None:
+        log.critical('Could not reach server')
+        abort(1)
+
+    click.echo(stats, nl=False)
 
 
 @cli.group('user',
@@ -137,24 +223,151 @@ def delete_user(obj, name):
                     help='List user accounts')
 @click.option('-k', '--keys', is_flag=True,
               help='Also show public key fingerprints')
+@click.option('--format', type=click.Choice(['text', 'json']),
+              default='text', help='Output format.')
+@click.option('--limit', type=click.IntRange(0), metavar='N',
+              help='Show at most N users.')
+@click.option('--offset', type=click.IntRange(0), default=0, metavar='N',
+              help='Skip the first N users.')
 @click.pass_obj
-def list_users(obj, keys):
+def list_users(obj, keys, format, limit, offset):
+    from .util import readable_fingerprint
+
     gh = obj['githome']
+    users = gh.iter_user_fingerprints(limit=limit, offset=offset, keys=keys)
+
+    if format == 'json':
+        import json
+
+        # a JSON array, written one user at a time
+        sep = '['
+        for uid, name, fingerprints in users:
+            doc = {'id': uid, 'name': name}
+            if keys:
+                doc['keys'] = [readable_fingerprint(fp)
+                               for fp in fingerprints]
+            click.echo(sep + json.dumps(doc, sort_keys=True))
+            sep = ','
+        click.echo(']' if sep == ',' else '[]')
+        return
 
-    for user in gh.iter_users():
-        line = '{user.id:4d} {user.name:20s}'.format(user=user)
+    for uid, name, fingerprints in users:
+        line = '{:4d} {:20s}'.format(uid, name)
 
-        if keys and user.public_keys:
-            line += ' * {}'.format(
-                user.public_keys[0].as_pkey().readable_fingerprint
-            )
+        if fingerprints:
+            line += ' * {}'.format(readable_fingerprint(fingerprints[0]))
         click.echo(line)
 
-        if len(user.public_keys) > 1 and keys:
-            for key in user.public_keys[1:]:
-                click.echo('{0:25s} * {1}'.format(
-                    '', key.as_pkey().readable_fingerprint
-                ))
+        for fp in fingerprints[1:]:
+            click.echo('{0:25s} * {1}'.format('', readable_fingerprint(fp)))
+
+
+def read_users(f, format):
+    """Iterate over ``(user name, [key line, ...])`` tuples of a file written
+    by :func:`write_users`."""
+    if format == 'csv':
+        import csv
+
+        rows = csv.reader(f)
+        if next(rows, None) != ['name', 'key']:
+            raise click.BadParameter('CSV must start with a name,key header')
+
+        for n, row in enumerate(rows, 2):
+            if len(row) != 2:
+                raise click.BadParameter('Line {} does not have two columns'
+                                         .format(n))
+            yield row[0], [row[1]] if row[1].strip() else []
+    else:
+        import json
+
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+
+            try:
+                doc = json.loads(line)
+                yield doc['name'], list(doc.get('keys', []))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise click.BadParameter('Line {} is not an object with a '
+                                         'name field'.format(n))
+
+
+def write_users(f, format, user_keys):
+    """Write ``(user name, [key line, ...])`` tuples as JSON objects with
+    ``name`` and ``keys`` fields, one per line, or as CSV with one row per
+    key."""
+    if format == 'csv':
+        import csv
+
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['name', 'key'])
+        for name, lines in user_keys:
+            writer.writerows([name, line] for line in lines or [''])
+    else:
+        import json
+
+        for name, lines in user_keys:
+            f.write(json.dumps({'name': name, 'keys': lines},
+                               sort_keys=True) + '\n')
+
+
+@user_group.command('export',
+                    help='Write all users and their keys as JSON objects, '
+                         'one per line, or CSV')
+@click.option('--format', type=click.Choice(['jsonl', 'csv']),
+              default='jsonl', help='Output format.')
+@click.argument('output', type=click.File('wb'), default='-')
+@click.pass_obj
+def export_users(obj, format, output):
+    from base64 import b64encode
+
+    from .util import key_type
+
+    gh = obj['githome']
+
+    write_users(output, format, (
+        (name, ['{} {}'.format(key_type(data), b64encode(data))
+                for data in blobs])
+        for name, blobs in gh.iter_user_keys()
+    ))
+
+
+@user_group.command('import',
+                    help='Create users and add their keys, as written by user '
+                         'export')
+@click.option('--format', type=click.Choice(['jsonl', 'csv']),
+              default='jsonl', help='Input format.')
+@click.option('--sync', is_flag=True,
+              help='Also delete users and keys not in the input.')
+@click.argument('input', type=click.File('rb'), default='-')
+@click.pass_obj
+def import_users(obj, format, sync, input):
+    from sshkeys import Key as SSHKey
+
+    from .exc import GitHomeError
+
+    gh = obj['githome']
+
+    def parse(name, lines):
+        try:
+            return [SSHKey.from_pubkey_line(line) for line in lines]
+        except ValueError as e:
+            log.critical('Invalid key of user {}: {}'.format(name, e))
+            abort(1)
+
+    try:
+        counts = gh.import_users(
+            ((name, parse(name, lines))
+             for name, lines in read_users(input, format)),
+            sync=sync,
+        )
+    except (GitHomeError, ValueError) as e:
+        log.critical('Import failed: {}'.format(e))
+        abort(1)
+
+    gh.save()
+    log.info('Imported users: {}'.format(', '.join(
+        '{} {}'.format(n, what) for what, n in sorted(counts.items()))))
 
 
 @cli.group('key',
@@ -169,6 +382,8 @@ def key_group():
 @click.argument('keyfiles', type=click.File('rb'), nargs=-1)
 @click.pass_obj
 def add_key(obj, username, keyfiles):
+    from sshkeys import Key as SSHKey
+
     gh = obj['githome']
 
     user = gh.get_user_by_name(username)
@@ -190,6 +405,79 @@ def add_key(obj, username, keyfiles):
     gh.save()
 
 
+def iter_key_dir(path):
+    """Iterate over ``(user name, line)`` tuples of a directory of
+    ``USER.pub`` files, each holding any number of public keys."""
+    for keyfile in sorted(path.glob('*.pub')):
+        with keyfile.open('rb') as f:
+            for line in f:
+                if line.strip():
+                    yield keyfile.stem, line.strip()
+
+
+def iter_key_jsonl(f):
+    """Iterate over ``(user name, line)`` tuples of a file of JSON objects,
+    one per line, with ``user`` and ``key`` fields."""
+    import json
+
+    for n, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+
+        try:
+            doc = json.loads(line)
+            yield doc['user'], doc['key'].strip()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise click.BadParameter('Line {} is not an object with user '
+                                     'and key fields'.format(n))
+
+
+@key_group.command('import',
+                   help='Import many keys at once, from a directory of '
+                        'USER.pub files or a file of JSON objects with user '
+                        'and key fields, one per line')
+@click.argument('source', type=click.Path(exists=True, allow_dash=True))
+@click.option('--create-users', is_flag=True,
+              help='Create users that do not exist yet.')
+@click.option('--skip-existing', is_flag=True,
+              help='Skip keys already in the database instead of failing.')
+@click.pass_obj
+def import_keys(obj, source, create_users, skip_existing):
+    from sshkeys import Key as SSHKey
+
+    from .exc import GitHomeError
+
+    gh = obj['githome']
+
+    def parse(lines):
+        entries = []
+        for name, line in lines:
+            try:
+                entries.append((name, SSHKey.from_pubkey_line(line)))
+            except ValueError as e:
+                log.critical('Invalid key of user {}: {}'.format(name, e))
+                abort(1)
+        return entries
+
+    path = pathlib.Path(source)
+    if source != '-' and path.is_dir():
+        entries = parse(iter_key_dir(path))
+    else:
+        with click.open_file(source, 'rb') as f:
+            entries = parse(iter_key_jsonl(f))
+
+    try:
+        added, skipped = gh.add_keys(entries, create_users=create_users,
+                                     skip_existing=skip_existing)
+    except (GitHomeError, ValueError) as e:
+        log.critical('Import failed: {}'.format(e))
+        abort(1)
+
+    gh.save()
+    log.info('Imported {} keys, skipped {} existing keys'.format(added,
+                                                                  skipped))
+
+
 @key_group.command('rm',
                    help='Remove keys from database')
 @click.argument('fingerprints', nargs=-1,
@@ -213,15 +501,214 @@ def delete_key(obj, fingerprints):
 def show_auth_keys(obj):
     gh = obj['githome']
 
-    click.echo(gh.get_authorized_keys_block(), nl=False)
+    click.get_text_stream('stdout').writelines(gh.iter_authorized_keys())
 
 
 @key_group.command('update-ak',
-                   help='Update authorized_keys file')
+                   help='Rebuild authorized_keys file, the authorization '
+                        'snapshot and the rules file')
 @click.pass_obj
 def update_auth_keys(obj):
     gh = obj['githome']
-    gh.update_authorized_keys()
+    gh.write_authz_snapshot()
+    gh.write_rules()
+    gh.update_authorized_keys(full=True)
+
+
+@cli.group('rule',
+           help='Manage access rules. Each rule grants a user, or everyone '
+                '(*), the rights to read (r), write (w) and/or create (c) '
+                'repositories matching a pattern, like team/* or **')
+def rule_group():
+    pass
+
+
+@rule_group.command('add', help='Add an access rule')
+@click.argument('user')
+@click.argument('pattern')
+@click.argument('rights')
+@click.pass_obj
+def add_rule(obj, user, pattern, rights):
+    gh = obj['githome']
+
+    try:
+        rule = gh.add_rule(user, pattern, rights)
+    except ValueError as e:
+        log.critical('Invalid rule: {}'.format(e))
+        abort(1)
+
+    gh.save()
+    log.info('Added rule {}'.format(rule.id))
+
+
+@rule_group.command('list', help='List access rules')
+@click.pass_obj
+def list_rules(obj):
+    from .authz import format_rights, parse_rights
+
+    gh = obj['githome']
+
+    for rule_id, user, pattern, rights in gh.iter_rules():
+        click.echo('{:4d} {:20s} {} {}'.format(
+            rule_id, user, format_rights(parse_rights(rights)), pattern))
+
+
+@rule_group.command('rm', help='Remove access rules')
+@click.argument('rule_ids', type=int, nargs=-1)
+@click.pass_obj
+def delete_rule(obj, rule_ids):
+    from .exc import GitHomeError
+
+    gh = obj['githome']
+
+    for rule_id in rule_ids:
+        try:
+            gh.delete_rule(rule_id)
+        except GitHomeError as e:
+            log.critical(str(e))
+            abort(1)
+        log.info('Removed rule {}'.format(rule_id))
+
+    if rule_ids:
+        gh.save()
+
+
+@rule_group.command('check', help='Show the rights of a user to a repository')
+@click.argument('user')
+@click.argument('path')
+@click.pass_obj
+def check_rule(obj, user, path):
+    from .authz import format_rights, sanitize_path
+    from .exc import UserNotFoundError
+
+    gh = obj['githome']
+
+    # resolved like the server does, which lowercases the name
+    try:
+        name = gh.get_user_by_name(user).name
+    except UserNotFoundError as e:
+        log.critical(str(e))
+        abort(1)
+
+    rel_path = sanitize_path(path)
+    click.echo('{} {}'.format(
+        format_rights(gh.rules.rights(name, rel_path)), rel_path))
+
+
+@cli.group('repo', help='Manage the repository registry')
+def repo_group():
+    pass
+
+
+@repo_group.command('scan',
+                    help='Update the repository registry from the '
+                         'repositories on disk')
+@click.option('--processes', type=click.IntRange(1), metavar='N',
+              help='Number of processes examining repositories. Defaults to '
+                   'the number of CPUs.')
+@click.pass_obj
+def scan_repos(obj, processes):
+    gh = obj['githome']
+
+    counts = gh.scan_repos(processes=processes)
+    gh.save()
+    log.info('Scanned repositories: {}'.format(', '.join(
+        '{} {}'.format(n, what) for what, n in sorted(counts.items()))))
+
+
+@repo_group.command('install-hooks',
+                    help='Install the post-receive hook, which reports pushes '
+                         'to the server, in all repositories')
+@click.pass_obj
+def install_hooks(obj):
+    gh = obj['githome']
+
+    installed, foreign = gh.install_hooks()
+    log.info('Installed hook in {} repositories'.format(installed))
+    if foreign:
+        log.warning('{} repositories have their own post-receive hook, '
+                    'pushes to them are not recorded'.format(foreign))
+
+
+@repo_group.command('list',
+                    help='List repositories, as of the last scan')
+@click.option('--format', type=click.Choice(['text', 'json']),
+              default='text', help='Output format.')
+@click.pass_obj
+def list_repos(obj, format):
+    gh = obj['githome']
+
+    def fmt_time(value):
+        return value.strftime('%Y-%m-%d %H:%M') if value else '-'
+
+    if format == 'json':
+        import json
+
+        # a JSON array, written one repository at a time
+        sep = '['
+        for repo in gh.iter_repos():
+            doc = dict(repo._asdict())
+            for field in ('created', 'last_push', 'scanned'):
+                if doc[field] is not None:
+                    doc[field] = doc[field].isoformat()
+            click.echo(sep + json.dumps(doc, sort_keys=True))
+            sep = ','
+        click.echo(']' if sep == ',' else '[]')
+        return
+
+    for repo in gh.iter_repos():
+        click.echo('{:40s} {:>12} {:>5} {:16s} {}'.format(
+            repo.path,
+            '-' if repo.size is None else repo.size,
+            '-' if repo.packs is None else repo.packs,
+            fmt_time(repo.last_push),
+            repo.creator or '-',
+        ))
+
+
+@cli.command('export-authz',
+             help='Export users, keys and configuration for import-authz on '
+                  'other nodes')
+@click.option('--since', default=0, metavar='VERSION',
+              help='Only export changes after this version, as printed by a '
+                   'previous export. By default, everything is exported.')
+@click.argument('output', type=click.File('wb'), default='-')
+@click.pass_obj
+def export_authz(obj, since, output):
+    from .exc import InvalidExport
+    from .replica import export_authz, prune_log
+
+    gh = obj['githome']
+
+    try:
+        version = export_authz(gh, output, since=since)
+    except InvalidExport as e:
+        log.critical('Export failed: {}'.format(e))
+        abort(1)
+    log.info('Exported version {}'.format(version))
+
+    removed = prune_log(gh)
+    gh.save()
+    if removed:
+        log.info('Removed {} old change log entries'.format(removed))
+
+
+@cli.command('import-authz',
+             help='Import users, keys and configuration exported by '
+                  'export-authz')
+@click.argument('input', type=click.File('rb'), default='-')
+@click.pass_obj
+def import_authz(obj, input):
+    from .exc import InvalidExport
+    from .replica import import_authz
+
+    gh = obj['githome']
+
+    try:
+        import_authz(gh, input)
+    except InvalidExport as e:
+        log.critical('Import failed: {}'.format(e))
+        abort(1)
 
 
 @cli.group('config', help='Adjust configuration and settings')
@@ -236,7 +723,7 @@ def config_group():
 def set_config(obj, key, value):
     gh = obj['githome']
 
-    gh.config.cset(key, value)
+    gh.set_config(key, value)
     gh.save()
 
     log.info('Configuration set: {}={}'.format(key, value))
@@ -246,6 +733,8 @@ def set_config(obj, key, value):
                       help='Display configuration values in .ini format')
 @click.pass_obj
 def show_config(obj):
+    from sqlacfg.format import ini_format
+
     gh = obj['githome']
 
     click.echo(ini_format(gh.config))
@@ -261,6 +750,10 @@ def show_config(obj):
 @click.argument('dir', required=False)
 @click.pass_obj
 def init(obj, config, dir, force):
+    from sqlacfg.format import ini_format
+
+    from .home import GitHome
+
     path = obj['githome_path'] if dir is None else pathlib.Path(dir)
 
     if path.exists():
@@ -271,15 +764,8 @@ def init(obj, config, dir, force):
         path.mkdir(parents=True)
         log.info('Created {}'.format(path))
 
-    # initialize
-    gh = GitHome.initialize(path)
+    # initialize, with the additional configuration options
+    gh = GitHome.initialize(path, config)
     log.info('Initialized new githome in {}'.format(path))
 
-    # set configuration options
-    for name, value in config:
-        gh.config.cset(name, value)
-
-    if config:
-        gh.save()
-
     log.debug('Configuration:\n{}'.format(ini_format(gh.config)))
@@ -0,0 +1,177 @@
+"""Configuration access through snapshots.
+
+sqlacfg's :class:`~sqlacfg.Config` queries the database on every access of a
+setting. Here, all settings are instead loaded in a single query into an
+immutable :class:`ConfigSnapshot`, which serves all reads until the
+configuration changes.
+
+Every write through :class:`SnapshotConfig` increments the
+``githome.config_version`` setting in the same transaction. Other processes,
+like a long-running server, call :meth:`SnapshotConfig.refresh` to reload
+their snapshot, which only reads that one setting unless it has changed.
+"""
+
+from collections import Mapping
+
+from sqlacfg import Config, ConfigSection
+
+
+class ConfigSnapshot(Mapping):
+    """An immutable mapping of section names to mappings of settings.
+
+    :param sections: A dictionary of dictionaries, which must not be changed
+                     afterwards.
+    :param version: The configuration version the snapshot was taken at.
+    """
+
+    def __init__(self, sections, version):
+        self._sections = sections
+        self.version = version
+
+    def __getitem__(self, name):
+        return SectionSnapshot(self._sections[name])
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    def __len__(self):
+        return len(self._sections)
+
+
+class SectionSnapshot(Mapping):
+    """A read-only view of a section's settings."""
+
+    def __init__(self, settings):
+        self._settings = settings
+
+    def __getitem__(self, key):
+        return self._settings[key]
+
+    def __iter__(self):
+        return iter(self._settings)
+
+    def __len__(self):
+        return len(self._settings)
+
+
+class SnapshotConfig(Config):
+    """A :class:`~sqlacfg.Config` that reads from a :class:`ConfigSnapshot`.
+
+    The snapshot is taken on first use and after every write in this
+    process; writes of other processes are picked up by :meth:`refresh`.
+    Sections returned by ``config[name]`` are :class:`SnapshotSection`
+    instances, which read from the snapshot and write through to the
+    database.
+    """
+
+    VERSION_SECTION = 'githome'
+    VERSION_KEY = 'config_version'
+
+    def __init__(self, model, session):
+        super(SnapshotConfig, self).__init__(model, session)
+        self._snapshot = None
+
+    @property
+    def snapshot(self):
+        """The current :class:`ConfigSnapshot`."""
+        if self._snapshot is None:
+            self._snapshot = self.load()
+        return self._snapshot
+
+    def load(self):
+        """Load all settings in a single query.
+
+        Unflushed writes of the session are included, like with every other
+        query.
+        """
+        model = self.model
+        sections = {}
+        version = None
+
+        qry = self.session.query(model.section, model.key, model.data)
+        for section, key, data in qry:
+            value = model._cfg_deserializer(data)
+            sections.setdefault(section, {})[key] = value
+
+            if (section, key) == (self.VERSION_SECTION, self.VERSION_KEY):
+                version = value
+
+        return ConfigSnapshot(sections, version)
+
+    def version(self):
+        """Read the configuration version from the database."""
+        cs = (self.session.query(self.model.data)
+                          .filter_by(section=self.VERSION_SECTION,
+                                     key=self.VERSION_KEY)
+                          .first())
+        return None if cs is None else self.model._cfg_deserializer(cs.data)
+
+    def refresh(self):
+        """Take a new snapshot if the configuration has changed.
+
+        :return: ``True`` if a new snapshot was taken.
+        """
+        if (self._snapshot is not None
+                and self.version() == self._snapshot.version):
+            return False
+
+        self._snapshot = self.load()
+        return True
+
+    def changed(self):
+        """Increment the configuration version and drop the snapshot.
+
+        Called after each write.
+        """
+        versions = ConfigSection(self.model, self.session,
+                                 self.VERSION_SECTION)
+        versions[self.VERSION_KEY] = (self.version() or 0) + 1
+        self._snapshot = None
+
+    def __iter__(self):
+        return iter(self.snapshot)
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def __contains__(self, name):
+        return name in self.snapshot
+
+    def __getitem__(self, name):
+        return SnapshotSection(self, name)
+
+
+class SnapshotSection(ConfigSection):
+    """A section of a :class:`SnapshotConfig`."""
+
+    def __init__(self, config, section):
+        super(SnapshotSection, self).__init__(config.model, config.session,
+                                              section)
+        self.config = config
+
+    @property
+    def _settings(self):
+        return self.config.snapshot.get(self.section, {})
+
+    def __getitem__(self, key):
+        return self._settings[key]
+
+    def __setitem__(self, key, value):
+        super(SnapshotSection, self).__setitem__(key, value)
+        self.config.changed()
+
+    def __delitem__(self, key):
+        super(SnapshotSection, self).__delitem__(key)
+        self.config.changed()
+
+    def __iter__(self):
+        return iter(self._settings)
+
+    def __len__(self):
+        return len(self._settings)
+
+    def iteritems(self):
+        return self._settings.iteritems()
+
+    def itervalues(self):
+        return self._settings.itervalues()
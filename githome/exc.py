@@ -16,3 +16,15 @@ class PermissionDenied(GitHomeError):
 
 class NoSuchRepository(GitHomeError):
     pass
+
+
+class ProtocolError(GitHomeError):
+    pass
+
+
+class InvalidExport(GitHomeError):
+    pass
+
+
+class Throttled(PermissionDenied):
+    pass
@@ -1,17 +1,30 @@
 #include <libgen.h>
 #include <errno.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <unistd.h>
 #include <string.h>
+#include <arpa/inet.h>
 #include <sys/socket.h>
+#include <sys/time.h>
 #include <sys/types.h>
 #include <sys/un.h>
 
 
-#define MAX_ARGS 32
-#define ARG_LEN 1024
 #define CMD_ENV_VAR "SSH_ORIGINAL_COMMAND"
+#define REQUEST_ID_ENV_VAR "GITHOME_REQUEST_ID"
+#define USER_ENV_VAR "GITHOME_USER"
+#define MAX_LINE 4096
+/* seconds a push report may take, a stuck server must not hold up pushes */
+#define PUSH_TIMEOUT 5
+
+/* protocol, see githome/proto.py */
+#define PROTO_MAGIC "\0GH"
+#define PROTO_MAGIC_LEN 3
+#define PROTO_VERSION 1
+#define HEADER_LEN 8
+#define MAX_PAYLOAD (64 * 1024)
 
 
 void exit_error(char *msg) {
@@ -36,14 +49,8 @@ int send_all(int socket, void *buf, size_t len) {
 }
 
 
-void send_str_fail(int socket, char *s) {
-  if (! s) {
-    exit_error("attempted to send NULL string");
-  }
-
-  size_t len = strlen(s);
-
-  switch(send_all(socket, s, len)) {
+void send_all_fail(int socket, void *buf, size_t len) {
+  switch(send_all(socket, buf, len)) {
     case 1:
       return;
     case 0:
@@ -56,30 +63,6 @@ void send_str_fail(int socket, char *s) {
 }
 
 
-int readline(int fd, char *buf, size_t n) {
-  ssize_t r, total = 0;
-
-  do {
-    r = read(fd, buf, 1);
-
-    if (r == -1) {
-        if (errno == EINTR) continue;  /* retry */
-        return -1;
-    }
-
-    if (r == 1) {
-      if (*buf == '\n') break;
-      ++buf;
-      total += r;
-    }
-  } while(r && total + 1 < n);
-
-  *buf = '\0';
-
-  return total;
-}
-
-
 void print_args(int argc, char **argv) {
   int i;
 
@@ -99,28 +82,102 @@ void* malloc_fail(size_t size) {
 }
 
 
-void check_status(int fd) {
-  char buffer[1024];
+/* a message being assembled or parsed; the payload follows the header */
+struct message {
+  char buf[HEADER_LEN + MAX_PAYLOAD];
+  size_t len;
+};
+
+
+int field_fits(struct message *msg, char *name, char *value) {
+  return msg->len + strlen(name) + strlen(value) + 2 <= MAX_PAYLOAD;
+}
+
+
+void add_field(struct message *msg, char *name, char *value) {
+  size_t nlen = strlen(name), vlen = strlen(value);
+
+  if (! field_fits(msg, name, value))
+    exit_error("request too large");
+
+  char *p = msg->buf + HEADER_LEN + msg->len;
+  memcpy(p, name, nlen);
+  p[nlen] = '=';
+  memcpy(p + nlen + 1, value, vlen);
+  p[nlen + vlen + 1] = '\0';
+
+  msg->len += nlen + vlen + 2;
+}
+
+
+void send_message_fail(int fd, struct message *msg) {
+  uint32_t len = htonl((uint32_t) msg->len);
+
+  memcpy(msg->buf, PROTO_MAGIC, PROTO_MAGIC_LEN);
+  msg->buf[PROTO_MAGIC_LEN] = PROTO_VERSION;
+  memcpy(msg->buf + PROTO_MAGIC_LEN + 1, &len, sizeof(len));
+
+  send_all_fail(fd, msg->buf, HEADER_LEN + msg->len);
+}
+
+
+/* read a whole message. the buffer is large enough for any valid message,
+ * so usually a single read() suffices */
+void recv_message_fail(int fd, struct message *msg) {
+  size_t have = 0, need = HEADER_LEN;
   ssize_t r;
+  uint32_t len;
+
+  while (have < need) {
+    r = read(fd, msg->buf + have, sizeof(msg->buf) - have);
+
+    if (r == -1) {
+      if (errno == EINTR) continue;  /* retry */
+      perror("failed to read");
+      exit(EXIT_FAILURE);
+    }
 
-  r = readline(fd, buffer, sizeof(buffer));
+    if (r == 0)
+      exit_error("remote end closed connection unexpectedly");
 
-  if (r == 0)
-    exit_error("remote end closed connection unexpectedly\n");
+    have += r;
 
-  if (r < 0)
-    exit_error("read status");
+    if (need == HEADER_LEN && have >= HEADER_LEN) {
+      if (memcmp(msg->buf, PROTO_MAGIC, PROTO_MAGIC_LEN))
+        exit_error("unexpected reply");
 
-  if (r < 2)
-    exit_error("response too short");
+      if (msg->buf[PROTO_MAGIC_LEN] != PROTO_VERSION)
+        exit_error("unsupported protocol version");
 
-  if (! strncmp("E ", buffer, 2))
-    exit_error(buffer+2);
+      memcpy(&len, msg->buf + PROTO_MAGIC_LEN + 1, sizeof(len));
+      len = ntohl(len);
 
-  if (strncmp("OK", buffer, 2))
-    exit_error("unexpected reply");
+      if (len > MAX_PAYLOAD)
+        exit_error("reply too large");
+
+      need = HEADER_LEN + len;
+    }
+  }
+
+  if (have > need)
+    exit_error("unexpected data after reply");
+
+  msg->len = need - HEADER_LEN;
+
+  if (msg->len && msg->buf[HEADER_LEN + msg->len - 1] != '\0')
+    exit_error("malformed reply");
+}
 
-  // we got an OK!
+
+/* number of fields in a received message */
+int count_fields(struct message *msg) {
+  int n = 0;
+  size_t i;
+
+  for (i = 0; i < msg->len; ++i)
+    if (msg->buf[HEADER_LEN + i] == '\0') ++n;
+
+  return n;
 }
 
 
@@ -145,64 +202,236 @@ int connect_socket_fail(char *path) {
 }
 
 
+/* AuthorizedKeysCommand mode: print the authorized_keys line for a key, if
+ * any. sshd runs this as "gh_client -k SOCKET %u %k" */
+int authorized_keys(char *socket_path, char *user, char *key) {
+  int sock;
+  static struct message msg;
+
+  add_field(&msg, "op", "keys");
+  add_field(&msg, "user", user);
+  add_field(&msg, "key", key);
+
+  sock = connect_socket_fail(socket_path);
+  send_message_fail(sock, &msg);
+
+  recv_message_fail(sock, &msg);
+  close(sock);
+
+  char *field = msg.buf + HEADER_LEN, *end = field + msg.len, *value;
+  char *status = NULL, *error = "unknown error", *request_id = "unknown";
+
+  for (; field < end; field = value + strlen(value) + 1) {
+    value = strchr(field, '=');
+    if (! value)
+      exit_error("malformed reply");
+    *value++ = '\0';
+
+    if (! strcmp(field, "status"))
+      status = value;
+    else if (! strcmp(field, "message"))
+      error = value;
+    else if (! strcmp(field, "request_id"))
+      request_id = value;
+    else if (! strcmp(field, "line"))
+      fputs(value, stdout);
+  }
+
+  if (! status)
+    exit_error("unexpected reply");
+
+  if (strcmp(status, "ok")) {
+    fprintf(stderr, "%s (request %s)\n", error, request_id);
+    exit(EXIT_FAILURE);
+  }
+
+  return 0;
+}
+
+
+void start_push(struct message *msg, char *repo) {
+  char *user = getenv(USER_ENV_VAR), *request_id = getenv(REQUEST_ID_ENV_VAR);
+
+  msg->len = 0;
+  add_field(msg, "op", "push");
+  add_field(msg, "repo", repo);
+  if (user)
+    add_field(msg, "user", user);
+  if (request_id)
+    add_field(msg, "request_id", request_id);
+}
+
+
+/* send a push report, never failing. the reply carries nothing of interest,
+ * but waiting for the server to close the connection keeps it from writing
+ * into a closed socket */
+void send_push(char *socket_path, struct message *msg) {
+  int sock;
+  ssize_t n;
+  struct sockaddr_un srv;
+  struct timeval timeout = { PUSH_TIMEOUT, 0 };
+  char buf[256];
+  uint32_t len = htonl((uint32_t) msg->len);
+
+  sock = socket(AF_UNIX, SOCK_STREAM, 0);
+  if (sock < 0)
+    return;
+
+  setsockopt(sock, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout));
+  setsockopt(sock, SOL_SOCKET, SO_SNDTIMEO, &timeout, sizeof(timeout));
+
+  srv.sun_family = AF_UNIX;
+  strncpy(srv.sun_path, socket_path, sizeof(srv.sun_path) - 1);
+  srv.sun_path[sizeof(srv.sun_path) - 1] = '\0';
+
+  memcpy(msg->buf, PROTO_MAGIC, PROTO_MAGIC_LEN);
+  msg->buf[PROTO_MAGIC_LEN] = PROTO_VERSION;
+  memcpy(msg->buf + PROTO_MAGIC_LEN + 1, &len, sizeof(len));
+
+  if (connect(sock, (struct sockaddr*) &srv, sizeof(srv)) == 0
+      && send_all(sock, msg->buf, HEADER_LEN + msg->len) == 1)
+    while ((n = read(sock, buf, sizeof(buf))) > 0
+           || (n < 0 && errno == EINTR));
+
+  close(sock);
+}
+
+
+/* post-receive hook mode: report the ref updates of a push, read from stdin
+ * as "OLD NEW REF" lines, to the server. git runs the hook in the
+ * repository, so it is identified by the working directory. a push is
+ * never failed, if the server cannot be reached it simply goes unrecorded.
+ * runs as "gh_client -p SOCKET" */
+int report_push(char *socket_path) {
+  static struct message msg;
+  char line[MAX_LINE], repo[MAX_LINE];
+  int updates = 0;
+
+  if (! getcwd(repo, sizeof(repo)))
+    return 0;
+
+  start_push(&msg, repo);
+  while (fgets(line, sizeof(line), stdin)) {
+    line[strcspn(line, "\n")] = '\0';
+    if (! *line)
+      continue;
+
+    /* too many updates for one message, send them in several */
+    if (! field_fits(&msg, "update", line)) {
+      send_push(socket_path, &msg);
+      start_push(&msg, repo);
+      updates = 0;
+    }
+
+    add_field(&msg, "update", line);
+    ++updates;
+  }
+
+  if (updates)
+    send_push(socket_path, &msg);
+
+  return 0;
+}
+
+
+void usage(char *name) {
+  fprintf(stderr, "usage: %s [-n] SOCKET KEY_FINGERPRINT\n"
+                  "       %s -k SOCKET USER KEY\n"
+                  "       %s -p SOCKET\n", name, name, name);
+  exit(EXIT_FAILURE);
+}
+
+
 int main(int argc, char **argv) {
-  int sock, c, dry_run = 0;
+  int sock, c, dry_run = 0, keys = 0, push = 0;
+  static struct message msg;
 
   /* parse options */
-  while((c = getopt(argc, argv,  "n")) != -1) {
+  while((c = getopt(argc, argv,  "nkp")) != -1) {
     switch(c) {
       case 'n':
         dry_run = 1;
       break;
+      case 'k':
+        keys = 1;
+      break;
+      case 'p':
+        push = 1;
+      break;
     }
   }
 
-  if (argc != optind + 2) {
-    fprintf(stderr, "usage: %s [-n] SOCKET KEY_FINGERPRINT\n", basename(argv[0]));
-    exit(EXIT_FAILURE);
+  if (push) {
+    if (argc != optind + 1)
+      usage(basename(argv[0]));
+
+    return report_push(argv[optind]);
   }
 
-  sock = connect_socket_fail(argv[optind]);
+  if (keys) {
+    if (argc != optind + 3)
+      usage(basename(argv[0]));
 
-  /* send the fingerprint */
-  send_str_fail(sock, argv[optind + 1]);
-  send_str_fail(sock, "\n");
+    return authorized_keys(argv[optind], argv[optind + 1], argv[optind + 2]);
+  }
+
+  if (argc != optind + 2)
+    usage(basename(argv[0]));
 
-  /* send command */
   char *env_cmd = getenv(CMD_ENV_VAR);
   if (! env_cmd) {
     exit_error("Environment variable " CMD_ENV_VAR " not set.");
   }
-  send_str_fail(sock, env_cmd);
-  send_str_fail(sock, "\n");
 
-  /* read status */
-  check_status(sock);
+  /* send request */
+  add_field(&msg, "op", "auth");
+  add_field(&msg, "fingerprint", argv[optind + 1]);
+  add_field(&msg, "command", env_cmd);
 
-  /* read returned arguments */
-  /* extra space for zero-termination of argument list */
-  char **nargv = malloc_fail(sizeof(char*) * (MAX_ARGS + 1));
+  sock = connect_socket_fail(argv[optind]);
+  send_message_fail(sock, &msg);
 
-  ssize_t r;
-  int nargc = 0;
+  /* read reply */
+  recv_message_fail(sock, &msg);
+  close(sock);
 
-  for(;;) {
-    char *buffer = malloc_fail(sizeof(char) * ARG_LEN);
+  /* parse reply. values point into the message buffer */
+  char *field = msg.buf + HEADER_LEN, *end = field + msg.len, *value;
+  char *status = NULL, *error = "unknown error", *request_id = "unknown";
+  int nargc = 0;
 
-    r = readline(sock, buffer, ARG_LEN);
+  /* extra space for zero-termination of argument list */
+  char **nargv = malloc_fail(sizeof(char*) * (count_fields(&msg) + 1));
+
+  for (; field < end; field = value + strlen(value) + 1) {
+    value = strchr(field, '=');
+    if (! value)
+      exit_error("malformed reply");
+    *value++ = '\0';
+
+    if (! strcmp(field, "status"))
+      status = value;
+    else if (! strcmp(field, "message"))
+      error = value;
+    else if (! strcmp(field, "request_id"))
+      request_id = value;
+    else if (! strcmp(field, "arg"))
+      nargv[nargc++] = value;
+    else if (! strcmp(field, "env") && putenv(value))
+      exit_error("could not set environment variable");
+  }
+  nargv[nargc] = (char*) 0;
 
-    if (r == 0) break;
+  if (! status)
+    exit_error("unexpected reply");
 
-    if (r < 0) {
-      perror("failed to read");
-      return EXIT_FAILURE;
-    };
+  if (strcmp(status, "ok")) {
+    fprintf(stderr, "%s (request %s)\n", error, request_id);
+    exit(EXIT_FAILURE);
+  }
 
-    nargv[nargc] = buffer;
-    ++nargc;
-  };
-  nargv[nargc] = (char*) 0;
-  close(sock);
+  if (setenv(REQUEST_ID_ENV_VAR, request_id, 1))
+    exit_error("could not set environment variable");
 
   if (dry_run) {
     print_args(nargc, nargv);
@@ -211,11 +440,10 @@ int main(int argc, char **argv) {
     if (nargc < 1)
       exit_error("validation failed; too few arguments returned");
 
-    /* finally, execute program */
-    if (! execvp(nargv[0], nargv)) {
-       perror("execvp");
-       return EXIT_FAILURE;
-    }
+    /* finally, execute program. execvp only returns on failure */
+    execvp(nargv[0], nargv);
+    perror("execvp");
+    return EXIT_FAILURE;
   }
 
   return 0;
@@ -1,33 +1,72 @@
-from binascii import hexlify, unhexlify
-from contextlib import closing
+from base64 import b64encode
+from binascii import hexlify
+from collections import OrderedDict
+from datetime import datetime
+import errno
+from itertools import groupby
+from operator import itemgetter
 import os
 from pathlib import Path
-import shlex
-import subprocess
+from pipes import quote
+import re
+import socket
 import sys
 import uuid
 
 from future.utils import raise_from
 import logbook
-from sqlacfg import Config
-from sqlalchemy import create_engine, Table, Column, String
+from sqlalchemy import bindparam, select, MetaData, Table, Column, String
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
-import trollius as asyncio
-from trollius import From
 
-from .model import Base, User, PublicKey, ConfigSetting
-from .util import block_update, sanitize_path
-from .exc import (UserNotFoundError, KeyNotFoundError, PermissionDenied,
-                  NoSuchRepository, GitHomeError)
+from .authz import (ANYONE, DEFAULT_RULES, RULES_PATH, SNAPSHOT_PATH,
+                    RuleSet, build_command, check_command, write_rules,
+                    write_snapshot)
+from .config import SnapshotConfig
+from .model import Base, User, PublicKey, ConfigSetting, Repository, Rule
+from .repos import (HOOK_PATH, REPOS_PATH, TEMPLATE_PATH, RepoStore,
+                    repo_stats)
+from .storage import create_engine
+from .util import (MAX_PARAMS, atomic_open, chunks, iter_block_update,
+                   key_type)
+from .exc import UserNotFoundError, KeyNotFoundError, GitHomeError
 
 
 log = logbook.Logger('githome')
 
 
 class GitHome(object):
-    REPOS_PATH = 'repos'
+    REPOS_PATH = REPOS_PATH
     DB_PATH = 'githome.sqlite'
+    AUTHZ_PATH = SNAPSHOT_PATH
+    RULES_PATH = RULES_PATH
+    TEMPLATE_PATH = TEMPLATE_PATH
+    # marks hooks written by githome, other hooks are never replaced
+    HOOK_MARKER = '# githome post-receive hook'
+    # settings the hook is written from, see hook_script()
+    HOOK_CONFIG = ('local.gh_client_executable', 'local.gh_client_socket')
+    # written by run_server(), holds the process id of the running server
+    PID_PATH = 'githome.pid'
+    NOTIFY_TIMEOUT = 1
+    # beyond this many changed keys, authorized_keys is rebuilt instead of
+    # patched
+    MAX_KEY_CHANGES = 500
+    # beyond this many changed keys, authorized_keys is indexed instead of
+    # searched once per key
+    INDEX_KEY_CHANGES = 50
+    # keys inserted per statement by add_keys()
+    KEY_BATCH_SIZE = 1000
+    # rows written per statement by scan_repos()
+    REPO_BATCH_SIZE = 1000
+    # tags of lines in authorized_keys, see authorized_keys_tag()
+    AUTHORIZED_KEYS_TAG = re.compile(r' githome:\S+\n')
+    AUTHORIZED_KEYS_OPTIONS = ','.join([
+        'no-agent-forwarding',
+        'no-port-forwarding',
+        'no-pty',
+        'no-user-rc',
+        'no-x11-forwarding',
+    ])
 
     @property
     def dsn(self):
@@ -35,22 +74,141 @@ class GitHome(object):
 
     def __init__(self, path):
         self.path = Path(path)
-        self.bind = create_engine(self.dsn)
-        self.session = scoped_session(sessionmaker(bind=self.bind))
-        self.config = Config(ConfigSetting, self.session)
+        self.repos = RepoStore(self.path / self.REPOS_PATH,
+                               self.path / self.TEMPLATE_PATH)
         self._update_authkeys = False
+        self._update_rules = False
+        self._update_hooks = False
+
+        # fingerprints of keys added or removed since authorized_keys was
+        # last updated
+        self._keys_added = set()
+        self._keys_removed = set()
+
+        # created on first use, many commands never touch the database
+        self._bind = None
+        self._session = None
+        self._read_session = None
+        self._config = None
+        self._rules = None
+
+    @property
+    def bind(self):
+        if self._bind is None:
+            self._bind = create_engine(self.dsn)
+        return self._bind
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = scoped_session(sessionmaker(bind=self.bind))
+        return self._session
+
+    @property
+    def read_session(self):
+        """The session configuration and rules are read through. The same
+        as :attr:`session`, unless changed by :meth:`use_read_only`."""
+        if self._read_session is None:
+            return self.session
+        return self._read_session
+
+    def use_read_only(self, bind):
+        """Read configuration and rules through ``bind``, e.g. a read-only
+        engine, from now on. Other queries and all writes still go through
+        :attr:`session`, so the configuration can no longer be changed.
+        """
+        self._read_session = scoped_session(sessionmaker(bind=bind))
+        self._config = None
+        self._rules = None
+
+        # do not keep a read transaction open on the writable connection
+        self.session.remove()
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = SnapshotConfig(ConfigSetting, self.read_session)
+        return self._config
 
     def save(self):
         self.session.commit()
 
+        if self._update_rules:
+            self._update_rules = False
+            self.write_rules()
+            if not self._update_authkeys:
+                self.reload_server()
+
         if self._update_authkeys:
             self._update_authkeys = False
+            self.write_authz_snapshot()
+            self.reload_server()
 
             if not self.config['local']['update_authorized_keys']:
                 log.info('Not updating authorized_keys, disabled in config')
+                self._keys_added.clear()
+                self._keys_removed.clear()
             else:
                 self.update_authorized_keys()
 
+        if self._update_hooks:
+            self._update_hooks = False
+            installed, foreign = self.install_hooks()
+            log.info('Updated hook in {} repositories'.format(installed))
+
+    def set_config(self, name, value):
+        """Set a configuration value.
+
+        Changing a setting the post-receive hook is written from reinstalls
+        the hook on the next :meth:`save`.
+
+        :param name: The name, in the form of ``section.key``.
+        """
+        self.config.cset(name, value)
+        if name in self.HOOK_CONFIG:
+            self._update_hooks = True
+
+    def server_running(self):
+        """Check whether a server is running, without connecting to its
+        socket, which would start a socket-activated server."""
+        try:
+            with open(str(self.path / self.PID_PATH)) as f:
+                pid = int(f.read())
+            os.kill(pid, 0)
+        except (IOError, ValueError):
+            return False
+        except OSError as e:
+            # running as someone else
+            return e.errno == errno.EPERM
+        return True
+
+    def reload_server(self):
+        """Make a running server reload users, keys and configuration
+        right away, instead of on its next poll."""
+        if self.server_running():
+            self.notify_server('RELOAD')
+
+    def notify_server(self, request):
+        """Send a control request to a running server.
+
+        If no server is running, the request is silently dropped.
+
+        :param request: The request, e.g. ``'RELOAD'``.
+        :return: The server's reply or ``None``, if it could not be reached.
+        """
+        path = self.path / self.config['local']['gh_client_socket']
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.NOTIFY_TIMEOUT)
+
+        try:
+            sock.connect(str(path))
+            sock.sendall(request + '\n')
+            return sock.makefile().read()
+        except socket.error as e:
+            log.debug('Could not notify server at {}: {}'.format(path, e))
+        finally:
+            sock.close()
+
     def create_user(self, name):
         user = User(name=name)
         self.session.add(user)
@@ -58,11 +216,60 @@ class GitHome(object):
 
     def delete_user(self, name):
         user = self.get_user_by_name(name)
+        for key in user.public_keys:
+            self._key_removed(key.fingerprint)
         self.session.delete(user)
         self._update_authkeys = True
 
         return True
 
+    def iter_rules(self):
+        """Iterate over ``(id, user, pattern, rights)`` of all rules, in the
+        order they were added."""
+        return self.read_session.query(Rule.id, Rule.user, Rule.pattern,
+                                       Rule.rights).order_by(Rule.id)
+
+    @property
+    def rules(self):
+        """The rules, compiled into a :class:`~githome.authz.RuleSet`."""
+        if self._rules is None:
+            self._rules = RuleSet(row[1:] for row in self.iter_rules())
+        return self._rules
+
+    def add_rule(self, user, pattern, rights):
+        """Grant ``user``, or everyone if it is ``'*'``, ``rights`` to all
+        repositories matching ``pattern``.
+
+        :raise ValueError: If the user name, pattern or rights are invalid.
+        """
+        if user != ANYONE:
+            user = User.check_name(user)
+        RuleSet([(user, pattern, rights)])
+
+        rule = Rule(user=user, pattern=pattern, rights=rights)
+        self.session.add(rule)
+        self.rules_changed()
+        return rule
+
+    def delete_rule(self, rule_id):
+        rule = self.session.query(Rule).get(rule_id)
+        if rule is None:
+            raise GitHomeError('No rule with id {}'.format(rule_id))
+        self.session.delete(rule)
+        self.rules_changed()
+
+    def rules_changed(self):
+        """Recompile the rules and have :meth:`save` write them for
+        ``githome-shell``."""
+        self._rules = None
+        self._update_rules = True
+
+    def write_rules(self):
+        """Rewrite the rules file used by ``githome-shell``."""
+        with atomic_open(self.path / self.RULES_PATH) as out:
+            write_rules(out, (row[1:] for row in self.iter_rules()))
+        log.debug('Wrote rules')
+
     def iter_users(self, order_by=User.name):
         qry = self.session.query(User)
         if order_by:
@@ -83,28 +290,394 @@ class GitHome(object):
         key.user = user
         self.session.add(key)
 
+        self._keys_removed.discard(key.fingerprint)
+        self._keys_added.add(key.fingerprint)
         self._update_authkeys = True
         return pkey
 
+    def add_keys(self, entries, create_users=False, skip_existing=False):
+        """Add many keys at once.
+
+        Unlike calling :meth:`add_key` for each key, owners and existing keys
+        are looked up with one query per :data:`~githome.util.MAX_PARAMS`
+        names or fingerprints and keys are inserted in batches, bypassing the
+        ORM.
+
+        :param entries: An iterable of ``(user name, pkey)`` tuples.
+        :param create_users: Create missing users instead of failing.
+        :param skip_existing: Skip keys already in the database instead of
+                              failing.
+        :return: A tuple of the number of keys added and skipped.
+        """
+        owners = OrderedDict()
+        for name, pkey in entries:
+            name = name.lower()
+            fingerprint = hexlify(pkey.fingerprint)
+
+            owner, _ = owners.setdefault(fingerprint, (name, pkey))
+            if owner != name:
+                raise GitHomeError('Key {} given for both {} and {}'.format(
+                    pkey.readable_fingerprint, owner, name))
+
+        keys, users = PublicKey.__table__, User.__table__
+
+        existing = set()
+        for fingerprints in chunks(owners, MAX_PARAMS):
+            existing.update(fp for (fp,) in self.session.execute(
+                select([keys.c.fingerprint])
+                .where(keys.c.fingerprint.in_(fingerprints))
+            ))
+        if existing and not skip_existing:
+            raise GitHomeError('{} key(s) already in database, e.g. {}'.format(
+                len(existing), next(iter(existing))))
+
+        added = [fp for fp in owners if fp not in existing]
+        names = set(owners[fp][0] for fp in added)
+        user_ids = {}
+        for chunk in chunks(names, MAX_PARAMS):
+            user_ids.update((name, uid) for uid, name in self.session.execute(
+                select([users.c.id, users.c.name])
+                .where(users.c.name.in_(chunk))
+            ))
+
+        missing = sorted(names - set(user_ids))
+        if missing and not create_users:
+            raise UserNotFoundError('User(s) not found: {}'.format(
+                ', '.join(missing)))
+
+        new_users = [self.create_user(name) for name in missing]
+        self.session.flush()
+        user_ids.update((user.name, user.id) for user in new_users)
+
+        for batch in chunks(added, self.KEY_BATCH_SIZE):
+            self.session.execute(keys.insert(), [
+                {'fingerprint': fp, 'user_id': user_ids[owners[fp][0]],
+                 'data': owners[fp][1].data}
+                for fp in batch
+            ])
+
+        self.keys_changed(added=added)
+        return len(added), len(existing)
+
+    def iter_user_keys(self, batch_size=1000):
+        """Iterate over ``(user name, [key blob, ...])`` tuples of all users,
+        ordered by name.
+
+        Users and keys are loaded in a single query and streamed in batches
+        of ``batch_size`` rows.
+        """
+        qry = (self.session.query(User.name, PublicKey.data)
+                           .outerjoin(PublicKey, PublicKey.user_id == User.id)
+                           .order_by(User.name, PublicKey.fingerprint)
+                           .yield_per(batch_size))
+
+        for name, rows in groupby(qry, key=itemgetter(0)):
+            yield name, [data for _, data in rows if data is not None]
+
+    def iter_user_fingerprints(self, limit=None, offset=0, keys=True,
+                               batch_size=1000):
+        """Iterate over ``(user id, user name, [fingerprint, ...])`` tuples,
+        ordered by name.
+
+        Fingerprints are hex-encoded, as stored, and are loaded in the same
+        query as the users; nothing is added to the session.
+
+        :param limit: Maximum number of users.
+        :param offset: Number of users to skip.
+        :param keys: Whether to load fingerprints at all.
+        """
+        qry = self.session.query(User.id, User.name).order_by(User.name)
+        if limit is not None or offset:
+            qry = qry.limit(limit).offset(offset)
+
+        if not keys:
+            for uid, name in qry.yield_per(batch_size):
+                yield uid, name, []
+            return
+
+        page = qry.subquery()
+        qry = (self.session.query(page.c.id, page.c.name,
+                                  PublicKey.fingerprint)
+               .outerjoin(PublicKey, PublicKey.user_id == page.c.id)
+               .order_by(page.c.name, PublicKey.fingerprint)
+               .yield_per(batch_size))
+
+        for (uid, name), rows in groupby(qry, key=itemgetter(0, 1)):
+            yield uid, name, [fp for _, _, fp in rows if fp is not None]
+
+    def import_users(self, entries, sync=False):
+        """Create users and add their keys in bulk.
+
+        All users and key fingerprints are loaded in one query; users and
+        keys are then deleted and inserted in batches, bypassing the ORM.
+
+        :param entries: An iterable of ``(user name, [pkey, ...])`` tuples.
+                        A user may appear more than once.
+        :param sync: Make the database match ``entries``: delete users not
+                     listed and keys not listed for their owner. Otherwise,
+                     users and keys are only added.
+        :return: A dictionary counting created and deleted users and added
+                 and removed keys.
+        """
+        wanted = OrderedDict()
+        owners = {}
+        for name, pkeys in entries:
+            name = User.check_name(name)
+            user_keys = wanted.setdefault(name, OrderedDict())
+
+            for pkey in pkeys:
+                fingerprint = hexlify(pkey.fingerprint)
+                owner = owners.setdefault(fingerprint, name)
+                if owner != name:
+                    raise GitHomeError('Key {} given for both {} and {}'
+                                       .format(pkey.readable_fingerprint,
+                                               owner, name))
+                user_keys[fingerprint] = pkey
+
+        keys, users = PublicKey.__table__, User.__table__
+
+        user_ids = {}
+        current = {}
+        for uid, name, fingerprint in self.session.execute(
+                select([users.c.id, users.c.name, keys.c.fingerprint])
+                .select_from(users.outerjoin(keys))):
+            user_ids[name] = uid
+            if fingerprint is not None:
+                current[fingerprint] = name
+
+        # keys owned by someone else are moved when syncing
+        removed = set()
+        for fingerprint, name in current.items():
+            wanted_owner = owners.get(fingerprint)
+            if wanted_owner is None:
+                if sync:
+                    removed.add(fingerprint)
+            elif wanted_owner != name:
+                if not sync:
+                    raise GitHomeError('Key {} already belongs to {}'.format(
+                        fingerprint, name))
+                removed.add(fingerprint)
+
+        deleted = sorted(set(user_ids) - set(wanted)) if sync else []
+        created = [name for name in wanted if name not in user_ids]
+        added = [fp for fp in owners
+                 if fp not in current or fp in removed]
+
+        for batch in chunks(removed, MAX_PARAMS):
+            self.session.execute(keys.delete()
+                                     .where(keys.c.fingerprint.in_(batch)))
+        for batch in chunks(deleted, MAX_PARAMS):
+            self.session.execute(users.delete()
+                                      .where(users.c.name.in_(batch)))
+
+        for batch in chunks(created, MAX_PARAMS):
+            self.session.execute(users.insert(),
+                                 [{'name': name} for name in batch])
+            user_ids.update((name, uid) for uid, name in self.session.execute(
+                select([users.c.id, users.c.name])
+                .where(users.c.name.in_(batch))
+            ))
+
+        for batch in chunks(added, self.KEY_BATCH_SIZE):
+            self.session.execute(keys.insert(), [
+                {'fingerprint': fp, 'user_id': user_ids[owners[fp]],
+                 'data': wanted[owners[fp]][fp].data}
+                for fp in batch
+            ])
+
+        self.keys_changed(added=added, removed=removed)
+        return {
+            'created users': len(created),
+            'deleted users': len(deleted),
+            'added keys': len(added),
+            'removed keys': len(removed),
+        }
+
     def delete_key(self, fingerprint):
-        self.session.delete(self.get_key_by_fingerprint(fingerprint))
+        key = self.get_key_by_fingerprint(fingerprint)
+        self._key_removed(key.fingerprint)
+        self.session.delete(key)
         self._update_authkeys = True
 
-    def get_repo(self, rel_path, create=False):
-        path = self.path / self.REPOS_PATH / rel_path
-
-        if not path.exists() or not path.is_dir():
-            if create:
-                # create the repo
-                path.mkdir(parents=True)
-                subprocess.check_call([
-                    'git', 'init', '--quiet', '--bare',
-                    '--shared=0600', str(path),
-                ])
-            else:
-                raise NoSuchRepository('Repository {} no found and not '
-                                       'creating.'.format(rel_path))
-        return path.absolute()
+    def keys_changed(self, added=(), removed=()):
+        """Record keys added or removed without :meth:`add_key` or
+        :meth:`delete_key`, e.g. by bulk operations, so :meth:`save` updates
+        authorized_keys accordingly.
+
+        :param added: Hex-encoded fingerprints of added keys.
+        :param removed: Hex-encoded fingerprints of removed keys. A key that
+                        was replaced is both removed and added.
+        """
+        for fingerprint in removed:
+            self._key_removed(fingerprint)
+        self._keys_added.update(added)
+        self._update_authkeys = True
+
+    def _key_removed(self, fingerprint):
+        if fingerprint in self._keys_added:
+            # never made it into authorized_keys
+            self._keys_added.discard(fingerprint)
+        else:
+            self._keys_removed.add(fingerprint)
+
+    def get_repo(self, rel_path, create=False, creator=None):
+        """Return the absolute path of a repository, see
+        :meth:`~githome.repos.RepoStore.get`. A newly created repository is
+        registered, see :meth:`register_repo`.
+
+        :param creator: Name of the user creating the repository.
+        """
+        existed = self.repos.path(rel_path).is_dir()
+        path = self.repos.get(rel_path, create=create)
+
+        if not existed:
+            self.register_repo(rel_path, creator)
+        return path
+
+    def register_repo(self, rel_path, creator=None):
+        """Add a newly created repository to the registry, unless it is
+        already listed."""
+        repos = Repository.__table__
+        self.session.execute(repos.insert().prefix_with('OR IGNORE'), {
+            'path': str(rel_path),
+            'creator': creator,
+            'created': datetime.utcnow(),
+        })
+
+    def iter_repos(self, batch_size=1000):
+        """Iterate over all registered repositories, ordered by path.
+
+        Rows are streamed in batches of ``batch_size`` and are not added to
+        the session.
+        """
+        repos = Repository.__table__
+        return (self.session.query(*repos.c).order_by(repos.c.path)
+                            .yield_per(batch_size))
+
+    def scan_repos(self, processes=None):
+        """Reconcile the repository registry with the filesystem.
+
+        Repositories are found by a single walk of the repository directory;
+        their statistics (see :func:`~githome.repos.repo_stats`), which
+        require walking every repository, are gathered by a pool of
+        ``processes`` processes, by default one per CPU. Rows are then
+        inserted, updated and deleted in batches.
+
+        :return: A dictionary counting added, updated and removed
+                 repositories.
+        """
+        from multiprocessing import Pool
+
+        paths = sorted(self.repos.iter_repos())
+
+        pool = Pool(processes)
+        try:
+            stats = pool.map(repo_stats,
+                             [str(self.repos.path(p)) for p in paths],
+                             chunksize=max(1, min(64, len(paths) // 32)))
+        finally:
+            pool.close()
+            pool.join()
+
+        repos = Repository.__table__
+        known = set(p for (p,) in self.session.execute(
+            select([repos.c.path])))
+        now = datetime.utcnow()
+
+        rows = []
+        for rel_path, (size, packs, last_push) in zip(paths, stats):
+            rows.append({
+                'path': rel_path,
+                'size': size,
+                'packs': packs,
+                'last_push': (None if last_push is None
+                              else datetime.utcfromtimestamp(last_push)),
+                'scanned': now,
+            })
+
+        added = [row for row in rows if row['path'] not in known]
+        updated = [dict(row, _path=row['path']) for row in rows
+                   if row['path'] in known]
+        removed = known - set(paths)
+
+        for batch in chunks(added, self.REPO_BATCH_SIZE):
+            self.session.execute(repos.insert(), batch)
+        update = (repos.update().where(repos.c.path == bindparam('_path'))
+                  .values(size=bindparam('size'), packs=bindparam('packs'),
+                          last_push=bindparam('last_push'),
+                          scanned=bindparam('scanned')))
+        for batch in chunks(updated, self.REPO_BATCH_SIZE):
+            self.session.execute(update, batch)
+        for batch in chunks(removed, MAX_PARAMS):
+            self.session.execute(repos.delete()
+                                      .where(repos.c.path.in_(batch)))
+
+        return {'added': len(added), 'updated': len(updated),
+                'removed': len(removed)}
+
+    def hook_script(self):
+        """Return the post-receive hook that reports pushes to the server.
+
+        The hook hands the ref updates to ``gh_client -p``, so no Python
+        interpreter is started per push. If ``gh_client`` is missing or the
+        server is not running, the push is not recorded, but never fails.
+        """
+        client = quote(self.config['local']['gh_client_executable'])
+        sock = quote(str((self.path / self.config['local']['gh_client_socket'])
+                         .absolute()))
+        return ('#!/bin/sh\n'
+                '{marker}, reports pushes to the server\n'
+                'test -x {client} || exit 0\n'
+                'exec {client} -p {sock}\n').format(
+                    marker=self.HOOK_MARKER, client=client, sock=sock)
+
+    def install_hook(self, path, script=None):
+        """Install the post-receive hook in a repository or template.
+
+        A hook that was not written by githome is left alone.
+
+        :param path: Path of the repository.
+        :return: ``True`` if the hook was installed or is up to date.
+        """
+        script = script or self.hook_script()
+        hook = path / HOOK_PATH
+
+        try:
+            with open(str(hook)) as f:
+                current = f.read()
+        except IOError:
+            current = None
+        if current is not None and self.HOOK_MARKER not in current:
+            log.warning('Not replacing foreign hook {}'.format(hook))
+            return False
+
+        if current != script:
+            if not hook.parent.exists():
+                hook.parent.mkdir(parents=True)
+            with atomic_open(hook, perms=0o755) as out:
+                out.write(script)
+        return True
+
+    def write_repo_template(self):
+        """Write the template directory of new repositories, which installs
+        the post-receive hook, see :meth:`hook_script`."""
+        self.install_hook(self.path / self.TEMPLATE_PATH)
+
+    def install_hooks(self):
+        """Install the post-receive hook in the template, all existing
+        repositories and the pool.
+
+        :return: A tuple of the number of repositories the hook is installed
+                 in and the number of repositories with foreign hooks.
+        """
+        script = self.hook_script()
+        self.install_hook(self.path / self.TEMPLATE_PATH, script)
+
+        paths = [self.repos.path(p) for p in self.repos.iter_repos()]
+        paths.extend(self.repos.iter_pool())
+
+        installed = sum(self.install_hook(p, script) for p in paths)
+        return installed, len(paths) - installed
 
     def get_user_by_name(self, name):
         try:
@@ -121,101 +694,225 @@ class GitHome(object):
             raise_from(KeyNotFoundError('Key {} not found'.format(hexlify
                        (fingerprint))), e)
 
+    def iter_authorized_keys(self, fingerprints=None):
+        """Iterate over the lines of the githome block in authorized_keys.
+
+        Keys and their owners are loaded in a single query and streamed,
+        the configuration is only read once. Every line ends in a comment
+        tagging it with the key's fingerprint, see :meth:`authorized_keys_tag`.
+
+        :param fingerprints: Only include keys with these hex-encoded
+                             fingerprints.
+        """
+        prefix, by_name = self.authorized_keys_command()
+
+        keys, users = PublicKey.__table__, User.__table__
+        qry = (select([keys.c.fingerprint, keys.c.data, users.c.name])
+               .select_from(keys.join(users)))
+        if fingerprints is not None:
+            qry = qry.where(keys.c.fingerprint.in_(fingerprints))
+
+        for fingerprint, data, name in self.session.execute(qry):
+            yield self.format_authorized_key(prefix, by_name, fingerprint,
+                                             name, data)
+
+    def authorized_keys_command(self):
+        """Return the forced command for authorized_keys lines.
+
+        The configuration is only read once, the result is meant to be passed
+        on to :meth:`format_authorized_key`.
+
+        :return: A tuple of the quoted command prefix and a flag that is
+                 ``True`` if the command takes the user name instead of the
+                 key's fingerprint as its last argument.
+        """
+        local = self.config.snapshot['local']
+        path = str(self.path.absolute())
+
+        # the last argument is either the key's fingerprint or the user name
+        if local['use_gh_client']:
+            spath = self.path / local['gh_client_socket']
+            args = [local['gh_client_executable'], str(spath.absolute())]
+            by_name = False
+        elif local.get('githome_shell_executable'):
+            args = [local['githome_shell_executable'], path]
+            by_name = False
+        else:
+            args = [local['githome_executable'], '--githome', path, 'shell']
+            by_name = True
+
+        prefix = ''.join("'{}' ".format(p) for p in args).replace('"', r'\"')
+        return prefix, by_name
+
+    @classmethod
+    def format_authorized_key(cls, prefix, by_name, fingerprint, name, data):
+        """Return the authorized_keys line of a key.
+
+        :param prefix: See :meth:`authorized_keys_command`.
+        :param by_name: See :meth:`authorized_keys_command`.
+        :param fingerprint: The key's hex-encoded fingerprint.
+        :param name: The name of the key's owner.
+        :param data: The key's binary blob.
+        """
+        return 'command="{}\'{}\'",{} {} {}{}'.format(
+            prefix, name if by_name else fingerprint,
+            cls.AUTHORIZED_KEYS_OPTIONS, key_type(data), b64encode(data),
+            cls.authorized_keys_tag(fingerprint)
+        )
+
+    @staticmethod
+    def authorized_keys_tag(fingerprint):
+        """Return the end of the authorized_keys line of a key.
+
+        The key comment identifies the line, so it can be found again without
+        parsing the key.
+        """
+        return ' githome:{}\n'.format(fingerprint)
+
     def get_authorized_keys_block(self):
-        pkeys = []
-        for key in self.session.query(PublicKey):
-            if self.config['local']['use_gh_client']:
-                pkey = key.as_pkey()
-                spath = (self.path / self.config['local']['gh_client_socket'])
-                args = [self.config['local']['gh_client_executable'],
-                        str(spath.absolute()),
-                        hexlify(pkey.fingerprint)]
-            else:
-                args = [
-                    self.config['local']['githome_executable'],
-                ]
-
-                args.extend([
-                    '--githome',
-                    str(self.path.absolute()),
-                    'shell',
-                    key.user.name,
-                ])
-
-            full_cmd = ' '.join("'{}'".format(p) for p in args)
-
-            opts = {
-                'command': full_cmd,
-                'no-agent-forwarding': True,
-                'no-port-forwarding': True,
-                'no-pty': True,
-                'no-user-rc': True,
-                'no-x11-forwarding': True,
-            }
-            pkey = key.as_pkey(options=opts)
-
-            pkeys.append(pkey)
-
-        return ''.join(pkey.to_pubkey_line() + '\n' for pkey in pkeys)
-
-    def update_authorized_keys(self):
+        return ''.join(self.iter_authorized_keys())
+
+    def iter_key_owners(self):
+        """Iterate over ``(fingerprint, user id, user name)`` for all keys.
+
+        Rows are loaded in a single query, without creating ORM instances.
+        """
+        keys, users = PublicKey.__table__, User.__table__
+        qry = (select([keys.c.fingerprint, users.c.id, users.c.name])
+               .select_from(keys.join(users)))
+        return self.session.execute(qry)
+
+    def write_authz_snapshot(self):
+        """Rewrite the snapshot used by ``githome-shell`` to authorize keys.
+
+        See :mod:`githome.authz`.
+        """
+        with atomic_open(self.path / self.AUTHZ_PATH, binary=True) as out:
+            write_snapshot(out, self.iter_key_owners())
+        log.debug('Wrote authorization snapshot')
+
+    def update_authorized_keys(self, full=False):
+        """Update the githome block in the authorized_keys file.
+
+        Usually, only the lines of keys added or removed since the last
+        update are changed. If that is not possible, e.g. because a removed
+        key cannot be found in the file, the block is rebuilt from scratch.
+
+        The file is replaced atomically, sshd never sees a partial file.
+
+        :param full: Always rebuild the whole block, e.g. after configuration
+                     changes.
+        """
+        added, removed = self._keys_added, self._keys_removed
+        self._keys_added, self._keys_removed = set(), set()
+
         ak = Path(self.config['local']['authorized_keys_file'])
         if not ak.exists():
             log.error('Refusing to update non-existant authorized_keys file: '
                       '{}'.format(ak))
             return
 
-        start_marker = (self.config['local']['authorized_keys_start_marker']
-                        .format(self.config['githome']['id']))
-        end_marker = (self.config['local']['authorized_keys_start_marker']
-                      .format(self.config['githome']['id']))
+        # markers are native strings like the file's contents, searching
+        # with unicode markers would decode the whole file every time
+        start_marker = str(self.config['local']['authorized_keys_start_marker']
+                           .format(self.config['githome']['id']))
+        end_marker = str(self.config['local']['authorized_keys_start_marker']
+                         .format(self.config['githome']['id']))
 
-        old = ak.open().read()
+        with open(str(ak)) as f:
+            old = f.read()
 
-        ak.open('wb').write(block_update(
-            start_marker,
-            end_marker,
-            old,
-            self.get_authorized_keys_block(),
+        pieces = None
+        if not full:
+            pieces = self._patch_authorized_keys(old, start_marker, end_marker,
+                                                 added, removed)
+
+        with atomic_open(ak) as out:
+            if pieces is not None:
+                out.writelines(pieces)
+            else:
+                out.writelines(iter_block_update(
+                    start_marker,
+                    end_marker,
+                    old,
+                    self.iter_authorized_keys(),
+                ))
+        log.info('Updated {} ({}{} added, {} removed)'.format(
+            ak, 'rebuilt, ' if pieces is None else '', len(added),
+            len(removed)
         ))
-        log.info('Updated {}'.format(ak))
 
-    def authorize_command(self, user, command):
-        CMD_WHITELIST = [
-            'git-upload-pack',
-            'git-receive-pack',
-            'git-upload-archive',
-        ]
-
-        if not command[0] in CMD_WHITELIST:
-            raise PermissionDenied(
-                '{} is not a whitelisted command.'.format(command[0])
-            )
-
-        if len(command) < 2:
-            raise PermissionDenied(
-                'Missing repository parameter'
-            )
-
-        # FIXME: check user read rights to repository
-        # FIXME: check if user may create repositories
-        can_create = True
-
-        repo_path = self.get_repo(sanitize_path(command[1]), create=can_create)
-        # FIXME: if necessary, check write rights to repository
-
-        if command[0] == 'git-upload-pack':
-            return [command[0], '--strict',   # do not try /.git
-                    str(repo_path)]
-        elif command[0] == 'git-receive-pack':
-            return [command[0], str(repo_path)]
-        elif command[0] == 'git-upload-archive':
-            return [command[0], str(repo_path)]
+    def _patch_authorized_keys(self, buf, start_marker, end_marker, added,
+                               removed):
+        """Apply added and removed keys to the githome block in ``buf``.
+
+        :return: A list of strings making up the new file or ``None``, if the
+                 block must be rebuilt instead.
+        """
+        if len(added) + len(removed) > self.MAX_KEY_CHANGES:
+            return None
+
+        try:
+            start = buf.index(start_marker) + len(start_marker)
+            end = buf.index(end_marker, start)
+        except ValueError:
+            return None
+
+        # few changes are looked up one by one, each a single find() over the
+        # block. many would rescan it as often, so all tagged lines are
+        # indexed in a single pass instead
+        if len(added) + len(removed) > self.INDEX_KEY_CHANGES:
+            lines = {}
+            for match in self.AUTHORIZED_KEYS_TAG.finditer(buf, start, end):
+                lines[match.group()] = (
+                    buf.rfind('\n', start - 1, match.start()) + 1,
+                    match.end())
+            find_line = lines.get
         else:
-            raise GitHomeError(
-                'Command {} is whitelisted, but not explicitly handled.'
-                .format(command[0])
-            )
+            def find_line(tag):
+                pos = buf.find(tag, start, end)
+                if pos < 0:
+                    return None
+                return buf.rfind('\n', start - 1, pos) + 1, pos + len(tag)
+
+        # locate lines to remove through their tags. a missing tag means the
+        # line was written by an older version or the file is out of sync
+        cuts = []
+        for fingerprint in removed:
+            span = find_line(self.authorized_keys_tag(fingerprint))
+            if span is None:
+                log.debug('Key {} not found in authorized_keys'
+                          .format(fingerprint))
+                return None
+            cuts.append(span)
+
+        cuts.sort()
+        pieces = []
+        pos = 0
+        for cut_start, cut_end in cuts:
+            pieces.append(buf[pos:cut_start])
+            pos = cut_end
+        pieces.append(buf[pos:end])
+
+        # replaced keys were cut above and must be written again
+        cut_tags = set(self.authorized_keys_tag(fp) for fp in removed)
+        for line in self.iter_authorized_keys(added) if added else ():
+            # skip keys already added by someone else
+            tag = line[line.rindex(' '):]
+            if tag in cut_tags or find_line(tag) is None:
+                pieces.append(line)
+
+        pieces.append(buf[end:])
+        return pieces
+
+    def authorize_command(self, user, command):
+        name, rel_path, can_create = check_command(user, command, self.rules)
+        repo_path = self.get_repo(rel_path, create=can_create,
+                                  creator=user.name)
+        # registers a new repository
+        self.session.commit()
+
+        return build_command(name, repo_path)
 
     @classmethod
     def check(cls, path):
@@ -226,11 +923,12 @@ class GitHome(object):
         return (path / cls.DB_PATH).exists()
 
     @classmethod
-    def initialize(cls, path):
+    def initialize(cls, path, initial_cfg=()):
         """Initialize new githome at path.
 
         :param path: A :class:`~pathlib.Path`.
-        :param initial_cfg:: Additional configuration settings.
+        :param initial_cfg: Additional configuration settings, as pairs of
+                            name and value.
         """
         # create paths
         (path / cls.REPOS_PATH).mkdir()
@@ -242,12 +940,12 @@ class GitHome(object):
         Base.metadata.create_all(bind=gh.bind)
 
         # create alembic metadata table
-        avtable = Table('alembic_version', Base.metadata,
+        avtable = Table('alembic_version', MetaData(),
                         Column('version_num', String(32), nullable=False)
                         )
         avtable.create(bind=gh.bind)
         qry = (avtable.insert()
-                      .values(version_num='4160ccb58402'))
+                      .values(version_num='b7d3e9f1a2c5'))
         with gh.bind.begin() as con:
             con.execute(qry)
 
@@ -258,6 +956,9 @@ class GitHome(object):
             os.path.expanduser('~/.ssh/authorized_keys')
         )
         local['githome_executable'] = str(Path(sys.argv[0]).absolute())
+        local['githome_shell_executable'] = str(
+            Path(sys.argv[0]).absolute().with_name('githome-shell')
+        )
         local['authorized_keys_start_marker'] = (
             '# -- added by githome {}, do not remove these markers --\n'
         )
@@ -271,74 +972,33 @@ class GitHome(object):
 
         gh.config['githome']['id'] = str(uuid.uuid4())
 
+        for user, pattern, rights in DEFAULT_RULES:
+            gh.add_rule(user, pattern, rights)
+
+        # before the template is written, which depends on them
+        for name, value in initial_cfg:
+            gh.config.cset(name, value)
+
         gh.save()
+        gh.write_authz_snapshot()
+        gh.write_repo_template()
 
         return gh
 
     def __repr__(self):
         return '{0.__class__.__name__}(path={0.path!r})'.format(self)
 
-    def run_server(self, debug=False):
-        @asyncio.coroutine
-        def gh_server():
-            socket = str(self.path / self.config['local']['gh_client_socket'])
-
-            log.info('Server socket: {}'.format(socket))
-            if os.path.exists(socket):
-                log.debug('Removing stale socket')
-                os.unlink(socket)
-
-            yield From(asyncio.start_unix_server(gh_proto, socket))
-
-        @asyncio.coroutine
-        def gh_proto(client_reader, client_writer):
-            con_id = uuid.uuid4()
-            log = logbook.Logger('client-{}'.format(con_id))
-            log.debug('connected')
-
-            with closing(client_writer._transport):
-                keyfp = (yield From(client_reader.readline())).strip()
+    def run_server(self, debug=False, workers=0, **kwargs):
+        from .server import GitHomeServer, Supervisor
 
-                if not keyfp:
-                    log.warning('unexpected connection close')
-                    return
-
-                cmd = (yield From(client_reader.readline())).strip()
-                log.debug('Read command: {!r}'.format(cmd))
-
-                try:
-                    key = self.get_key_by_fingerprint(unhexlify(keyfp))
-                    user = key.user
-                    log.info('authenticated as {}'.format(user.name))
-
-                    # check if user is allowed to execute command
-                    clean_command = self.authorize_command(user,
-                                                           shlex.split(cmd))
-                except Exception as e:
-                    # deny on every exception, no exceptions!
-                    log.warning('permission denied: {}'.format(e))
-                    yield From(client_writer.write('E access denied\n'))
-                    return
-                else:
-                    # wrapped in else, for defensive reasons
-                    log.info('Authorized for {!r}'.format(clean_command))
-
-                    # write OK byte
-                    yield From(client_writer.write('OK\n'))
-
-                    # actualy reply
-                    for part in clean_command:
-                        yield From(client_writer.write(part + '\n'))
-
-        loop = asyncio.get_event_loop()
-
-        # debug
-        loop.set_debug(debug)
-
-        # start server
-        loop.run_until_complete(gh_server())
+        pid_path = self.path / self.PID_PATH
+        with atomic_open(pid_path, perms=0o644) as out:
+            out.write('{}\n'.format(os.getpid()))
 
         try:
-            loop.run_forever()
+            if workers:
+                Supervisor(self, workers, **kwargs).run(debug=debug)
+            else:
+                GitHomeServer(self, **kwargs).run(debug=debug)
         finally:
-            loop.close()
+            os.unlink(str(pid_path))
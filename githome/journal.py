@@ -0,0 +1,211 @@
+"""Journal of pushes.
+
+``gh_client`` execs ``git-receive-pack``, so the server never sees a push
+finish. Instead, repositories carry a post-receive hook, see
+:meth:`~githome.home.GitHome.hook_script`, that reports the updated refs
+over the server's socket with ``gh_client -p``.
+
+Reports are only appended to :class:`PushJournal` in memory and answered
+right away, so the hook, and with it the push, never waits for the
+database. Every ``interval`` seconds, pending events are written in a single
+transaction, as rows of :class:`~githome.model.PushEvent`, and the last push
+time of each repository is updated. Writes that fail are retried with the
+next batch; if the database stays unavailable, at most ``max_pending``
+events are kept and the rest are dropped.
+
+Other consumers, like :mod:`githome.maintenance`, read the ``push_events``
+table.
+"""
+
+from collections import deque
+from datetime import datetime, timedelta
+
+import logbook
+from sqlalchemy import bindparam, func
+import trollius as asyncio
+from trollius import From
+
+from .model import PushEvent, Repository
+from .util import chunks
+
+
+log = logbook.Logger('journal')
+
+
+class PushJournal(object):
+    """Write-behind buffer of :class:`~githome.model.PushEvent` rows.
+
+    :param gh: The :class:`~githome.home.GitHome` to write to.
+    :param run_blocking: Function running a blocking function on a thread
+                         pool, returning a future, see
+                         :meth:`~githome.server.GitHomeServer.run_blocking`.
+    :param metrics: A :class:`~githome.metrics.Registry` to add metrics to.
+    :param interval: Seconds between writes.
+    :param max_pending: Maximum number of events waiting to be written.
+    :param retention: Days to keep events for. ``None`` keeps them forever.
+    """
+
+    #: Rows inserted per statement.
+    BATCH_SIZE = 1000
+    #: Seconds between removals of expired events.
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, gh, run_blocking, metrics, interval=1.0,
+                 max_pending=100000, retention=90):
+        self.gh = gh
+        self.run_blocking = run_blocking
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retention = retention
+        self.pending = deque()
+        self._last_prune = None
+
+        self.pushes = metrics.counter(
+            'githome_pushes_total',
+            'Number of pushes reported by the post-receive hook.',
+        )
+        self.ref_updates = metrics.counter(
+            'githome_ref_updates_total',
+            'Number of refs updated by reported pushes.',
+        )
+        self.dropped = metrics.counter(
+            'githome_journal_dropped_total',
+            'Number of ref updates dropped because too many were pending.',
+        )
+        self.pending_events = metrics.gauge(
+            'githome_journal_pending',
+            'Number of ref updates waiting to be written.',
+        )
+
+    def append(self, rel_path, updates, user=None, request_id=None,
+               time=None):
+        """Add a push to the journal.
+
+        :param rel_path: Path of the repository, relative to the repository
+                         root.
+        :param updates: Tuples of old object id, new object id and ref name.
+        :param user: Name of the pushing user.
+        :param request_id: Id of the connection that authorized the push.
+        :return: The number of events added.
+        """
+        time = time or datetime.utcnow()
+        rows = [{'time': time, 'repo': str(rel_path), 'user': user,
+                 'ref': ref, 'old': old, 'new': new,
+                 'request_id': request_id}
+                for old, new, ref in updates]
+
+        room = self.max_pending - len(self.pending)
+        if len(rows) > room:
+            self.dropped.inc(len(rows) - max(room, 0))
+            rows = rows[:max(room, 0)]
+
+        self.pending.extend(rows)
+        self.pending_events.set(len(self.pending))
+        self.pushes.inc()
+        self.ref_updates.inc(len(rows))
+        return len(rows)
+
+    def take(self, limit=None):
+        """Remove and return up to ``limit`` pending events, oldest first."""
+        count = len(self.pending) if limit is None else limit
+        rows = []
+        while self.pending and len(rows) < count:
+            rows.append(self.pending.popleft())
+        self.pending_events.set(len(self.pending))
+        return rows
+
+    def requeue(self, rows):
+        """Put events that could not be written back in front of the
+        pending ones, keeping at most :attr:`max_pending` events."""
+        room = max(self.max_pending - len(self.pending), 0)
+        if len(rows) > room:
+            self.dropped.inc(len(rows) - room)
+            # the oldest ones go first
+            rows = rows[len(rows) - room:]
+
+        self.pending.extendleft(reversed(rows))
+        self.pending_events.set(len(self.pending))
+
+    def write(self, rows):
+        """Insert events and update the last push time of their
+        repositories, in a single transaction."""
+        events, repos = PushEvent.__table__, Repository.__table__
+
+        last_push = {}
+        for row in rows:
+            last_push[row['repo']] = max(row['time'],
+                                         last_push.get(row['repo'],
+                                                       row['time']))
+
+        try:
+            for batch in chunks(rows, self.BATCH_SIZE):
+                self.gh.session.execute(events.insert(), batch)
+
+            update = (repos.update()
+                      .where(repos.c.path == bindparam('_path'))
+                      .values(last_push=func.max(
+                          func.coalesce(repos.c.last_push,
+                                        bindparam('last_push')),
+                          bindparam('last_push'))))
+            self.gh.session.execute(update, [
+                {'_path': path, 'last_push': time}
+                for path, time in sorted(last_push.items())
+            ])
+            self.gh.session.commit()
+        except Exception:
+            self.gh.session.rollback()
+            raise
+
+    def prune(self, now=None):
+        """Remove events older than :attr:`retention` days.
+
+        :return: The number of removed events.
+        """
+        now = now or datetime.utcnow()
+        events = PushEvent.__table__
+        try:
+            result = self.gh.session.execute(events.delete().where(
+                events.c.time < now - timedelta(days=self.retention)))
+            self.gh.session.commit()
+        except Exception:
+            self.gh.session.rollback()
+            raise
+        return result.rowcount
+
+    def flush(self):
+        """Write all pending events, blocking. Used when shutting down."""
+        rows = self.take()
+        if rows:
+            self.write(rows)
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            yield From(asyncio.sleep(self.interval))
+
+            # taken on the event loop, which appends to the same queue
+            rows = self.take()
+            if rows:
+                try:
+                    yield From(self.run_blocking(self.write, rows))
+                except Exception as e:
+                    log.error('Could not write push events: {}'.format(e))
+                    self.requeue(rows)
+                else:
+                    log.debug('Wrote {} push events'.format(len(rows)))
+
+            if self.retention is None:
+                continue
+
+            now = datetime.utcnow()
+            if (self._last_prune is None or (now - self._last_prune)
+                    .total_seconds() >= self.PRUNE_INTERVAL):
+                self._last_prune = now
+                try:
+                    removed = yield From(self.run_blocking(self.prune, now))
+                except Exception as e:
+                    log.error('Could not remove old push events: {}'
+                              .format(e))
+                else:
+                    if removed:
+                        log.info('Removed {} old push events'.format(removed))
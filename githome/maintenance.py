@@ -0,0 +1,285 @@
+"""Background maintenance of repositories.
+
+Pushes leave loose objects and small packs behind, which make every clone
+and fetch slower. :class:`MaintenanceScheduler` runs inside the server and
+repacks repositories that have been pushed to since they were last
+maintained:
+
+* ``git gc`` removes unreachable loose objects and repacks everything into a
+  single pack with a reachability bitmap, which lets ``upload-pack`` count
+  objects to send without walking history.
+* ``git commit-graph write`` speeds up the walks that remain, e.g. for
+  negotiating what a fetching client already has. It is optional: git
+  versions without commit-graphs only log a warning.
+
+Maintenance runs at the lowest CPU priority and, if ``ionice`` is
+available, the idle I/O class, so it yields to serving clients. At most
+``concurrency`` repositories are maintained at a time.
+"""
+
+from datetime import datetime
+from distutils.spawn import find_executable
+import os
+
+import logbook
+from sqlalchemy import func, or_, select
+import trollius as asyncio
+from trollius import From, Return
+
+from .model import PushEvent, Repository
+from .repos import repo_stats
+
+
+log = logbook.Logger('maintenance')
+
+
+#: Git command repacking a repository. Maintenance fails if it does.
+GC = ['-c', 'repack.writeBitmaps=true', 'gc', '--quiet']
+
+#: Git commands run after :data:`GC`, in order. They only speed up reads, a
+#: failure is logged and the repository still counts as maintained.
+OPTIONAL_STEPS = [
+    ['commit-graph', 'write', '--reachable'],
+]
+
+
+def priority(pushes, last_push, maintained, now):
+    """Rank a repository for maintenance.
+
+    Every push since the last maintenance counts as much as a day passing
+    since then. A push known only from the repository's last push time, as
+    recorded by a scan, counts once.
+
+    :param pushes: Number of pushes seen since the last maintenance.
+    :param last_push: Time of the last push, or ``None``.
+    :param maintained: Time of the last maintenance, or ``None``.
+    :param now: The current time.
+    :return: The priority, higher is more urgent, or ``None`` if the
+             repository has not changed since its last maintenance.
+    """
+    if not pushes and last_push is not None and (maintained is None
+                                                 or last_push > maintained):
+        pushes = 1
+    if not pushes:
+        return None
+
+    since = maintained or last_push or now
+    return pushes + (now - since).total_seconds() / 86400.0
+
+
+class MaintenanceScheduler(object):
+    """Maintains repositories, most urgent first, see :func:`priority`.
+
+    Every ``interval`` seconds, repositories are ranked and as many as there
+    are free slots are maintained. Repositories maintained less than
+    ``min_interval`` seconds ago are left alone, so a busy repository is not
+    repacked after every push. Neither are repositories whose maintenance
+    failed less than ``min_interval`` seconds ago; failures are not stored,
+    so they are retried after a restart.
+
+    Pushes are counted from the ``push_events`` table, see
+    :mod:`githome.journal`, and those reported through :meth:`pushed` that
+    have not been written yet. Repositories without a post-receive hook are
+    picked up through their last push time once ``githome repo scan`` has
+    recorded it.
+
+    :param gh: The :class:`~githome.home.GitHome` whose repositories to
+               maintain.
+    :param run_blocking: Function running a blocking function on a thread
+                         pool, returning a future, see
+                         :meth:`~githome.server.GitHomeServer.run_blocking`.
+    :param metrics: A :class:`~githome.metrics.Registry` to add metrics to.
+    :param concurrency: Maximum number of repositories maintained at once.
+    :param interval: Seconds between scheduling runs.
+    :param min_interval: Minimum number of seconds between two maintenance
+                         runs of the same repository.
+    :param niceness: Niceness of the git processes.
+    :param ionice: Run git in the idle I/O scheduling class, if ``ionice``
+                   is installed.
+    """
+
+    def __init__(self, gh, run_blocking, metrics, concurrency=1,
+                 interval=60.0, min_interval=3600.0, niceness=19,
+                 ionice=True):
+        self.gh = gh
+        self.run_blocking = run_blocking
+        self.concurrency = concurrency
+        self.interval = interval
+        self.min_interval = min_interval
+        self.niceness = niceness
+        self.ionice = find_executable('ionice') if ionice else None
+
+        # relative path -> pushes since the last maintenance
+        self.pushes = {}
+        self.running = set()
+        # relative path -> time of the last failed maintenance
+        self.failed = {}
+
+        self.runs = {}
+        for result in ('ok', 'failed'):
+            self.runs[result] = metrics.counter(
+                'githome_maintenance_runs_total',
+                'Number of repository maintenance runs, by result.',
+                result=result,
+            )
+        self.in_progress = metrics.gauge(
+            'githome_maintenance_in_progress',
+            'Number of repositories currently being maintained.',
+        )
+
+    def pushed(self, rel_path):
+        """Record a push to a repository."""
+        rel_path = str(rel_path)
+        self.pushes[rel_path] = self.pushes.get(rel_path, 0) + 1
+
+    def candidates(self, pushes, running):
+        """Return the paths of repositories due for maintenance, most urgent
+        first.
+
+        :param pushes: A copy of :attr:`pushes`.
+        :param running: Paths of repositories being maintained, or not to be
+                        maintained for other reasons.
+        """
+        now = datetime.utcnow()
+        repos, events = Repository.__table__, PushEvent.__table__
+        rows = {path: (last_push, maintained)
+                for path, last_push, maintained in self.gh.session.execute(
+                    select([repos.c.path, repos.c.last_push,
+                            repos.c.maintained]))}
+
+        # the ref updates of one push share its request id, if known, or at
+        # least their time
+        push_id = func.coalesce(events.c.request_id, events.c.time)
+        journaled = self.gh.session.execute(
+            select([events.c.repo, func.count(push_id.distinct())])
+            .select_from(events.outerjoin(
+                repos, repos.c.path == events.c.repo))
+            .where(or_(repos.c.maintained.is_(None),
+                       events.c.time > repos.c.maintained))
+            .group_by(events.c.repo))
+        # pushes reported to this process may be in both
+        pushes = dict(pushes)
+        for path, count in journaled:
+            pushes[path] = max(pushes.get(path, 0), count)
+        self.gh.session.commit()
+
+        ranked = []
+        for path in set(rows) | set(pushes):
+            last_push, maintained = rows.get(path, (None, None))
+            if path in running or (
+                    maintained is not None and
+                    (now - maintained).total_seconds() < self.min_interval):
+                continue
+
+            prio = priority(pushes.get(path, 0), last_push, maintained, now)
+            if prio is not None:
+                ranked.append((prio, path))
+
+        ranked.sort(reverse=True)
+        return [path for _, path in ranked]
+
+    def backoff(self, now=None):
+        """Return the paths of repositories whose maintenance failed less
+        than :attr:`min_interval` seconds ago."""
+        now = now or datetime.utcnow()
+        for path, time in list(self.failed.items()):
+            if (now - time).total_seconds() >= self.min_interval:
+                del self.failed[path]
+        return set(self.failed)
+
+    def command(self, path, step):
+        cmd = ['git', '--git-dir', str(path)] + step
+        if self.ionice:
+            cmd = [self.ionice, '-c', '3'] + cmd
+        return cmd
+
+    def record(self, rel_path):
+        """Store the time of a repository's successful maintenance, along
+        with its size and number of packs afterwards.
+
+        Repositories missing from the registry, e.g. those created by
+        ``githome-shell``, are added, so they are not maintained again right
+        away.
+        """
+        repos = Repository.__table__
+        try:
+            size, packs, _ = repo_stats(str(self.gh.repos.path(rel_path)))
+            self.gh.register_repo(rel_path)
+            self.gh.session.execute(
+                repos.update().where(repos.c.path == rel_path)
+                     .values(maintained=datetime.utcnow(), size=size,
+                             packs=packs))
+            self.gh.session.commit()
+        except Exception as e:
+            self.gh.session.rollback()
+            log.error('Could not record maintenance of {}: {}'.format(
+                rel_path, e))
+
+    @asyncio.coroutine
+    def git(self, path, step):
+        """Run a git command on a repository, returning its exit status."""
+        niceness = self.niceness
+        proc = yield From(asyncio.create_subprocess_exec(
+            *self.command(path, step),
+            preexec_fn=lambda: os.nice(niceness)
+        ))
+        status = yield From(proc.wait())
+        raise Return(status)
+
+    @asyncio.coroutine
+    def maintain(self, rel_path):
+        """Run :data:`GC` and the :data:`OPTIONAL_STEPS` on a repository."""
+        path = self.gh.repos.path(rel_path)
+
+        self.running.add(rel_path)
+        self.in_progress.inc()
+        # pushes from now on need another run
+        self.pushes.pop(rel_path, None)
+        try:
+            status = yield From(self.git(path, GC))
+            if status != 0:
+                log.error('Maintenance of {} failed, git {} exited with '
+                          'status {}'.format(rel_path, ' '.join(GC), status))
+                self.runs['failed'].inc()
+                self.failed[rel_path] = datetime.utcnow()
+                return
+
+            # repacked, which is what matters
+            self.runs['ok'].inc()
+            yield From(self.run_blocking(self.record, rel_path))
+
+            for step in OPTIONAL_STEPS:
+                status = yield From(self.git(path, step))
+                if status != 0:
+                    log.warning('Skipped git {} on {}, exited with status {}'
+                                .format(' '.join(step), rel_path, status))
+            log.info('Maintained {}'.format(rel_path))
+        except Exception as e:
+            log.error('Maintenance of {} failed: {}'.format(rel_path, e))
+            self.runs['failed'].inc()
+            self.failed[rel_path] = datetime.utcnow()
+        finally:
+            self.running.discard(rel_path)
+            self.in_progress.dec()
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            yield From(asyncio.sleep(self.interval))
+
+            free = self.concurrency - len(self.running)
+            if free <= 0:
+                continue
+
+            try:
+                # copied, the dictionary changes while ranking on another
+                # thread
+                due = yield From(self.run_blocking(
+                    self.candidates, dict(self.pushes),
+                    self.running | self.backoff()))
+            except Exception as e:
+                log.error('Could not schedule maintenance: {}'.format(e))
+                continue
+
+            for rel_path in due[:free]:
+                asyncio.ensure_future(self.maintain(rel_path))
@@ -0,0 +1,184 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from .util import atomic_open
+
+
+#: Default histogram buckets, in seconds. Spans from the cost of a dictionary
+#: lookup on a fast machine to a slow ``git init`` on an SD card.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def samples(self):
+        """Iterate over ``(name suffix, extra labels, value)`` tuples."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args):
+        super(Counter, self).__init__(*args)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield '', (), self.value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    @contextmanager
+    def track(self):
+        """Increase the gauge for the duration of a ``with`` block."""
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of a ``with`` block."""
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(default_timer() - start)
+
+    def quantile(self, q):
+        """Estimate a quantile from the buckets.
+
+        Like Prometheus' ``histogram_quantile()``, values are assumed to be
+        distributed evenly inside a bucket.
+
+        :param q: The quantile, between 0 and 1.
+        :return: The estimated value or ``None``, if nothing was observed.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+
+    def samples(self):
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            yield '_bucket', (('le', _format_value(bound)),), total
+        yield '_sum', (), self.sum
+        yield '_count', (), self.count
+
+
+class Registry(object):
+    """A collection of metrics that can be rendered in the Prometheus text
+    exposition format.
+
+    Metrics sharing a name form a family and must only differ in their
+    labels.
+
+    :param labels: Labels added to every sample, e.g. to tell apart several
+                   processes writing to the same collector.
+    """
+
+    def __init__(self, **labels):
+        self.labels = tuple(sorted(labels.items()))
+        self.families = OrderedDict()
+
+    def _add(self, cls, name, help, labels, **kwargs):
+        metric = cls(name, help, self.labels + tuple(sorted(labels.items())),
+                     **kwargs)
+        self.families.setdefault(name, []).append(metric)
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._add(Counter, name, help, labels)
+
+    def gauge(self, name, help, **labels):
+        return self._add(Gauge, name, help, labels)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._add(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for name, metrics in self.families.items():
+            lines.append('# HELP {} {}'.format(name, metrics[0].help))
+            lines.append('# TYPE {} {}'.format(name, metrics[0].type))
+
+            for metric in metrics:
+                for suffix, extra, value in metric.samples():
+                    lines.append('{}{}{} {}'.format(
+                        name, suffix, _format_labels(metric.labels + extra),
+                        _format_value(value)
+                    ))
+
+        return ''.join(line + '\n' for line in lines)
+
+
+def write_metrics(path, text):
+    """Atomically replace ``path`` with rendered metrics.
+
+    Suitable for the node exporter's textfile collector, which must never see
+    a partially written file.
+    """
+    with atomic_open(path, perms=0o644) as out:
+        out.write(text)
@@ -1,7 +1,8 @@
 from binascii import hexlify
 
 from sqlacfg import ConfigSettingMixin
-from sqlalchemy import Column, Integer, String, ForeignKey, LargeBinary
+from sqlalchemy import (BigInteger, Column, DateTime, DDL, Index, Integer,
+                        String, ForeignKey, LargeBinary, event)
 from sqlalchemy.orm import sessionmaker, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 from sshkeys import Key as SSHKey
@@ -18,11 +19,19 @@ class User(Base):
     name = Column(String, unique=True, nullable=False)
 
     def __init__(self, name, **kwargs):
+        super(User, self).__init__(name=self.check_name(name), **kwargs)
+
+    @staticmethod
+    def check_name(name):
+        """Return the normalized form of a user name.
+
+        :raise ValueError: If the name is invalid.
+        """
         name = name.lower()
         if not name.isalnum() or not name[0].isalpha():
             raise ValueError('Name must be alphanumeric and start with a '
                              'letter')
-        super(User, self).__init__(name=name, **kwargs)
+        return name
 
 
 class PublicKey(Base):
@@ -43,5 +52,113 @@ class PublicKey(Base):
         return SSHKey(self.data, comment, options)
 
 
+class Rule(Base):
+    """Grants a user, or everyone, rights to repositories matching a pattern,
+    see :class:`~githome.authz.RuleSet`."""
+    __tablename__ = 'rules'
+
+    id = Column(Integer, primary_key=True)
+    # a user name or '*' for everyone
+    user = Column(String, nullable=False)
+    pattern = Column(String, nullable=False)
+    rights = Column(String, nullable=False)
+
+
+class Repository(Base):
+    """A repository, as last seen by ``githome repo scan`` or created by
+    githome.
+
+    Sizes, pack counts and push times are only as current as the last scan.
+    """
+    __tablename__ = 'repositories'
+
+    # relative to the repository root, as returned by sanitize_path()
+    path = Column(String, primary_key=True)
+    # name of the user who created it, if created through githome
+    creator = Column(String)
+    created = Column(DateTime)
+    last_push = Column(DateTime)
+    # bytes of all objects
+    size = Column(BigInteger)
+    packs = Column(Integer)
+    scanned = Column(DateTime)
+    # see githome.maintenance
+    maintained = Column(DateTime)
+
+
+class PushEvent(Base):
+    """A ref updated by a push, as reported by the post-receive hook, see
+    :mod:`githome.journal`."""
+    __tablename__ = 'push_events'
+    __table_args__ = (Index('ix_push_events_repo_time', 'repo', 'time'),)
+
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, nullable=False)
+    # relative to the repository root, like Repository.path
+    repo = Column(String, nullable=False)
+    # name of the pushing user, if known
+    user = Column(String)
+    ref = Column(String, nullable=False)
+    old = Column(String, nullable=False)
+    new = Column(String, nullable=False)
+    # request id of the authorizing connection, see githome.proto
+    request_id = Column(String)
+
+
 class ConfigSetting(Base, ConfigSettingMixin):
     __tablename__ = 'config'
+
+
+class AuthzLog(Base):
+    """Log of changes to users, keys and configuration, filled by triggers.
+
+    Each row names a changed user (by id), key (by fingerprint), rule (by id)
+    or setting (as ``section.key``); see :mod:`githome.replica`.
+    """
+    __tablename__ = 'authz_log'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    version = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    ident = Column(String, nullable=False)
+
+
+def _log_trigger(table, op, kind, *idents):
+    return DDL(
+        'CREATE TRIGGER authz_log_{table}_{op} AFTER {OP} ON {table} '
+        'BEGIN {inserts} END'.format(
+            table=table, op=op.lower(), OP=op,
+            inserts=' '.join(
+                "INSERT INTO authz_log (kind, ident) VALUES ('{}', {});"
+                .format(kind, ident) for ident in idents
+            )
+        )
+    )
+
+
+AUTHZ_LOG_TRIGGERS = [
+    _log_trigger('users', 'INSERT', 'user', 'NEW.id'),
+    _log_trigger('users', 'UPDATE', 'user', 'OLD.id', 'NEW.id'),
+    _log_trigger('users', 'DELETE', 'user', 'OLD.id'),
+    _log_trigger('public_keys', 'INSERT', 'key', 'NEW.fingerprint'),
+    _log_trigger('public_keys', 'UPDATE', 'key', 'OLD.fingerprint',
+                 'NEW.fingerprint'),
+    _log_trigger('public_keys', 'DELETE', 'key', 'OLD.fingerprint'),
+    _log_trigger('config', 'INSERT', 'config',
+                 "NEW.section || '.' || NEW.key"),
+    _log_trigger('config', 'UPDATE', 'config',
+                 "OLD.section || '.' || OLD.key",
+                 "NEW.section || '.' || NEW.key"),
+    _log_trigger('config', 'DELETE', 'config',
+                 "OLD.section || '.' || OLD.key"),
+]
+
+RULE_LOG_TRIGGERS = [
+    _log_trigger('rules', 'INSERT', 'rule', 'NEW.id'),
+    _log_trigger('rules', 'UPDATE', 'rule', 'OLD.id', 'NEW.id'),
+    _log_trigger('rules', 'DELETE', 'rule', 'OLD.id'),
+]
+
+# the triggers need all tables to exist
+for _trigger in AUTHZ_LOG_TRIGGERS + RULE_LOG_TRIGGERS:
+    event.listen(Base.metadata, 'after_create', _trigger)
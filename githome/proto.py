@@ -0,0 +1,100 @@
+"""Framed protocol between ``gh_client`` and the server.
+
+Every message starts with an eight byte header: the magic ``\\0GH``, a
+protocol version byte and the length of the payload as an unsigned 32-bit
+big-endian integer. The payload is a sequence of ``name=value`` fields, each
+terminated by a ``NUL`` byte. Fields may be repeated, their order is
+preserved.
+
+A request carries an ``op`` field naming the operation, the reply a
+``status`` field that is either ``ok`` or ``error``; errors come with a
+``message``. For ``op=auth``, the request contains the key's ``fingerprint``
+and the ``command`` to run, the reply one ``arg`` field per argument of the
+command to execute and any number of ``env`` fields in the form
+``NAME=VALUE`` to set in its environment. For ``op=push``, sent by the
+post-receive hook, the request contains the absolute path of the ``repo``,
+the pushing ``user`` and ``request_id`` of the authorizing connection, if
+known, and one ``update`` field of the form ``OLD NEW REF`` per updated
+ref. Each reply carries the server's ``request_id`` for the connection, to
+correlate client errors with the server log.
+
+Since the magic starts with a ``NUL`` byte, which can never start a line of
+the original line-based protocol, the server tells both apart by the first
+byte sent.
+"""
+
+import struct
+
+from .exc import ProtocolError
+
+
+MAGIC = b'\x00GH'
+VERSION = 1
+HEADER = struct.Struct('!3sBI')
+
+#: Maximum size of a payload. Must match ``MAX_PAYLOAD`` in ``gh_client.c``.
+MAX_PAYLOAD = 64 * 1024
+
+
+def unpack_header(data):
+    """Parse a message header.
+
+    :param data: The first :attr:`HEADER.size` bytes of a message.
+    :return: A tuple of protocol version and payload length.
+    """
+    magic, version, length = HEADER.unpack(data)
+
+    if magic != MAGIC:
+        raise ProtocolError('Not a githome protocol message')
+
+    if version != VERSION:
+        raise ProtocolError('Unsupported protocol version {}'.format(version))
+
+    if length > MAX_PAYLOAD:
+        raise ProtocolError('Message too large ({} bytes)'.format(length))
+
+    return version, length
+
+
+class Message(list):
+    """A list of ``(name, value)`` fields."""
+
+    def get(self, name, default=None):
+        """Return the value of the first field named ``name``."""
+        for n, v in self:
+            if n == name:
+                return v
+        return default
+
+    def get_all(self, name):
+        """Return the values of all fields named ``name``."""
+        return [v for n, v in self if n == name]
+
+    def encode(self):
+        """Serialize message, including its header."""
+        parts = []
+        for name, value in self:
+            if '=' in name or '\0' in name or '\0' in value:
+                raise ProtocolError('Invalid field {!r}'.format(name))
+            parts.append('{}={}\0'.format(name, value))
+
+        payload = ''.join(parts)
+        if len(payload) > MAX_PAYLOAD:
+            raise ProtocolError('Message too large ({} bytes)'.format(
+                len(payload)))
+
+        return HEADER.pack(MAGIC, VERSION, len(payload)) + payload
+
+    @classmethod
+    def decode(cls, payload):
+        """Parse a payload, without its header."""
+        if payload and not payload.endswith('\0'):
+            raise ProtocolError('Unterminated field')
+
+        msg = cls()
+        for field in payload.split('\0')[:-1]:
+            name, sep, value = field.partition('=')
+            if not sep:
+                raise ProtocolError('Invalid field {!r}'.format(field))
+            msg.append((name, value))
+        return msg
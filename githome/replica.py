@@ -0,0 +1,486 @@
+"""Sharing users, keys, access rules and configuration between githomes.
+
+One githome, the source, exports its users, keys, rules and configuration;
+any number of replicas import them. Exports are either *full*, containing
+everything, or *deltas* of the changes since a version of the source.
+
+Versions are those of the ``authz_log`` table, which triggers fill with the
+user id, key fingerprint, rule id or configuration setting affected by every
+change (see :class:`~githome.model.AuthzLog`). A delta contains the current
+state of everything named in the log since the given version, or the fact
+that it was deleted, so applying a delta more than once does no harm.
+
+Only the newest ``replica.log_retention`` entries of the log are kept, see
+:func:`prune_log`. Deltas since versions older than that cannot be exported
+anymore; replicas that fell that far behind need a full export.
+
+An export is a gzip-compressed file of JSON documents, one per line. The
+first line is a header::
+
+    {"format": "githome-authz", "format_version": 1, "source": ID,
+     "since": VERSION, "version": VERSION, "full": BOOLEAN}
+
+followed by deletions, users, keys, rules and settings, each a document with a
+``type`` field. The last line holds the SHA-256 checksum of all lines before
+it, ``{"sha256": HEX}``.
+
+Configuration settings that only make sense on the node they are set on,
+like paths, are neither exported nor overwritten by imports, see
+:data:`LOCAL_SECTIONS`.
+"""
+
+from base64 import b64decode, b64encode
+import gzip
+import hashlib
+import json
+import zlib
+
+import logbook
+from sqlalchemy import func, select
+
+from .exc import InvalidExport
+from .model import AuthzLog, ConfigSetting, PublicKey, Rule, User
+from .util import MAX_PARAMS, chunks
+
+
+log = logbook.Logger('replica')
+
+
+FORMAT = 'githome-authz'
+FORMAT_VERSION = 1
+
+#: Configuration sections that are never exported or imported.
+LOCAL_SECTIONS = ('local', 'sqlite', 'replica')
+
+#: Settings outside of :data:`LOCAL_SECTIONS` that are specific to a node.
+LOCAL_SETTINGS = (('githome', 'id'), ('githome', 'config_version'))
+
+#: Default number of change log entries to keep, see :func:`prune_log`.
+LOG_RETENTION = 100000
+
+#: Rows inserted per statement on import. The fingerprints of a batch of keys
+#: are looked up in a single query, so it must not exceed ``MAX_PARAMS``.
+BATCH_SIZE = MAX_PARAMS
+
+
+def is_local(section, key):
+    return section in LOCAL_SECTIONS or (section, key) in LOCAL_SETTINGS
+
+
+def current_version(session):
+    """Return the latest version of the change log, ``0`` if it is empty."""
+    return session.execute(
+        select([func.max(AuthzLog.__table__.c.version)])
+    ).scalar() or 0
+
+
+def prune_log(gh):
+    """Remove all but the newest ``replica.log_retention`` entries of the
+    change log, by default :data:`LOG_RETENTION`. The newest entry is always
+    kept, so versions never go back.
+
+    :return: The number of removed entries.
+    """
+    keep = max(gh.config['replica'].get('log_retention', LOG_RETENTION), 1)
+    log_table = AuthzLog.__table__
+    return gh.session.execute(log_table.delete().where(
+        log_table.c.version <= current_version(gh.session) - keep
+    )).rowcount
+
+
+class ExportWriter(object):
+    """Writes lines of an export and keeps their checksum."""
+
+    def __init__(self, out):
+        self.out = out
+        self.hash = hashlib.sha256()
+
+    def write(self, doc):
+        line = json.dumps(doc, sort_keys=True, separators=(',', ':')) + '\n'
+        self.hash.update(line)
+        self.out.write(line)
+
+    def close(self):
+        self.out.write(json.dumps({'sha256': self.hash.hexdigest()}) + '\n')
+
+
+def user_doc(row):
+    return {'type': 'user', 'id': row.id, 'name': row.name}
+
+
+def key_doc(row):
+    return {'type': 'key', 'fingerprint': row.fingerprint,
+            'user_id': row.user_id, 'data': b64encode(row.data)}
+
+
+def rule_doc(row):
+    return {'type': 'rule', 'id': row.id, 'user': row.user,
+            'pattern': row.pattern, 'rights': row.rights}
+
+
+def config_doc(row):
+    return {'type': 'config', 'section': row.section, 'key': row.key,
+            'data': row.data}
+
+
+def iter_full(session):
+    users = User.__table__
+    for row in session.execute(select([users]).order_by(users.c.id)):
+        yield user_doc(row)
+
+    keys = PublicKey.__table__
+    for row in session.execute(select([keys])):
+        yield key_doc(row)
+
+    rules = Rule.__table__
+    for row in session.execute(select([rules]).order_by(rules.c.id)):
+        yield rule_doc(row)
+
+    config = ConfigSetting.__table__
+    for row in session.execute(select([config])):
+        if not is_local(row.section, row.key):
+            yield config_doc(row)
+
+
+def iter_delta(session, since):
+    changes = {'user': set(), 'key': set(), 'rule': set(), 'config': set()}
+
+    log_table = AuthzLog.__table__
+    qry = (select([log_table.c.kind, log_table.c.ident]).distinct()
+           .where(log_table.c.version > since))
+    for kind, ident in session.execute(qry):
+        changes[kind].add(ident)
+
+    users = User.__table__
+    found = {}
+    for ids in chunks(changes['user'], MAX_PARAMS):
+        qry = select([users]).where(users.c.id.in_([int(i) for i in ids]))
+        for row in session.execute(qry):
+            found[str(row.id)] = row
+
+    keys = PublicKey.__table__
+    found_keys = {}
+    for fps in chunks(changes['key'], MAX_PARAMS):
+        for row in session.execute(
+                select([keys]).where(keys.c.fingerprint.in_(fps))):
+            found_keys[row.fingerprint] = row
+
+    rules = Rule.__table__
+    found_rules = {}
+    for ids in chunks(changes['rule'], MAX_PARAMS):
+        qry = select([rules]).where(rules.c.id.in_([int(i) for i in ids]))
+        for row in session.execute(qry):
+            found_rules[str(row.id)] = row
+
+    config = ConfigSetting.__table__
+    settings = {}
+    for row in session.execute(select([config])):
+        settings['{}.{}'.format(row.section, row.key)] = row
+
+    # deletions first, so an import never sees two users with the same name
+    for fingerprint in sorted(changes['key'] - set(found_keys)):
+        yield {'type': 'delete', 'kind': 'key', 'ident': fingerprint}
+    for ident in sorted(changes['user'] - set(found)):
+        yield {'type': 'delete', 'kind': 'user', 'ident': ident}
+    for ident in sorted(changes['rule'] - set(found_rules)):
+        yield {'type': 'delete', 'kind': 'rule', 'ident': ident}
+    for name in sorted(changes['config']):
+        section, _, key = name.partition('.')
+        if name not in settings and not is_local(section, key):
+            yield {'type': 'delete', 'kind': 'config', 'ident': name}
+
+    for ident in sorted(found, key=int):
+        yield user_doc(found[ident])
+    for fingerprint in sorted(found_keys):
+        yield key_doc(found_keys[fingerprint])
+    for ident in sorted(found_rules, key=int):
+        yield rule_doc(found_rules[ident])
+    for name in sorted(changes['config']):
+        row = settings.get(name)
+        if row is not None and not is_local(row.section, row.key):
+            yield config_doc(row)
+
+
+def export_authz(gh, out, since=0):
+    """Write an export of ``gh`` to the binary file ``out``.
+
+    :param since: Only export changes after this version. ``0`` exports
+                  everything.
+    :return: The version of the export.
+    """
+    session = gh.session
+
+    # changes committed while exporting may end up in this export already,
+    # but are exported again by the next delta, which is harmless
+    version = current_version(session)
+
+    full = since <= 0
+    if not full:
+        oldest = session.execute(
+            select([func.min(AuthzLog.__table__.c.version)])).scalar()
+        if oldest is not None and since < oldest - 1:
+            raise InvalidExport('Changes since version {} have been pruned '
+                                'from the log, export everything '
+                                'instead'.format(since))
+    with gzip.GzipFile(fileobj=out, mode='wb') as gz:
+        writer = ExportWriter(gz)
+        writer.write({
+            'format': FORMAT,
+            'format_version': FORMAT_VERSION,
+            'source': gh.config['githome']['id'],
+            'since': 0 if full else since,
+            'version': version,
+            'full': full,
+        })
+
+        for doc in (iter_full(session) if full
+                    else iter_delta(session, since)):
+            writer.write(doc)
+
+        writer.close()
+
+    return version
+
+
+def iter_gzip_lines(infile, chunk_size=64 * 1024):
+    """Iterate over the lines of a gzip-compressed file, which, unlike with
+    :class:`gzip.GzipFile`, need not be seekable, e.g. a pipe."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buf = ''
+
+    while True:
+        data = infile.read(chunk_size)
+        if not data:
+            break
+
+        lines = (buf + decompressor.decompress(data)).split('\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    buf += decompressor.flush()
+    if buf:
+        yield buf
+
+
+def iter_export(infile):
+    """Parse an export, checking its checksum.
+
+    :return: An iterator over all documents, starting with the header. The
+             checksum is verified once the last document has been read.
+    """
+    hash = hashlib.sha256()
+    checksum = None
+
+    try:
+        for line in iter_gzip_lines(infile):
+            if checksum is not None:
+                raise InvalidExport('Data after checksum')
+
+            doc = json.loads(line)
+            if 'sha256' in doc and 'type' not in doc:
+                checksum = doc['sha256']
+                continue
+
+            hash.update(line)
+            yield doc
+    except (zlib.error, ValueError) as e:
+        raise InvalidExport('Could not read export: {}'.format(e))
+
+    if checksum is None:
+        raise InvalidExport('Export is incomplete, checksum missing')
+    if checksum != hash.hexdigest():
+        raise InvalidExport('Checksum mismatch')
+
+
+class Importer(object):
+    """Applies the documents of an export to a githome.
+
+    Users, keys and rules are written in batches; configuration settings are
+    written through :attr:`GitHome.config` once everything else has been
+    applied.
+    """
+
+    def __init__(self, gh):
+        self.gh = gh
+        self.session = gh.session
+        self.pending = []
+        self.pending_type = None
+        self.settings = []
+        self.added = set()
+        self.removed = set()
+        self.rules_changed = False
+        self.counts = {}
+
+    def clear(self):
+        """Remove all users, keys, rules and settings, before a full
+        import."""
+        keys = PublicKey.__table__
+        for (fingerprint,) in self.session.execute(
+                select([keys.c.fingerprint])):
+            self.removed.add(fingerprint)
+
+        self.session.execute(keys.delete())
+        self.session.execute(User.__table__.delete())
+        self.session.execute(Rule.__table__.delete())
+        self.rules_changed = True
+
+        for name, section in self.gh.config.items():
+            for key in list(section):
+                if not is_local(name, key):
+                    self.settings.append(('delete', name, key, None))
+
+    def apply(self, doc):
+        kind = doc.get('type')
+        if kind != self.pending_type:
+            self.flush()
+            self.pending_type = kind
+
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+        if kind == 'delete':
+            self.delete(doc['kind'], doc['ident'])
+        elif kind == 'user':
+            self.pending.append({'id': doc['id'], 'name': doc['name']})
+        elif kind == 'key':
+            self.added.add(doc['fingerprint'])
+            self.pending.append({'fingerprint': doc['fingerprint'],
+                                 'user_id': doc['user_id'],
+                                 'data': b64decode(doc['data'])})
+        elif kind == 'rule':
+            self.rules_changed = True
+            self.pending.append({'id': doc['id'], 'user': doc['user'],
+                                 'pattern': doc['pattern'],
+                                 'rights': doc['rights']})
+        elif kind == 'config':
+            if not is_local(doc['section'], doc['key']):
+                self.settings.append(('set', doc['section'], doc['key'],
+                                      json.loads(doc['data'])))
+        else:
+            raise InvalidExport('Unknown document type {!r}'.format(kind))
+
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def delete(self, kind, ident):
+        if kind == 'key':
+            keys = PublicKey.__table__
+            self.session.execute(keys.delete()
+                                     .where(keys.c.fingerprint == ident))
+            self.removed.add(ident)
+        elif kind == 'user':
+            keys, users = PublicKey.__table__, User.__table__
+            for (fingerprint,) in self.session.execute(
+                    select([keys.c.fingerprint])
+                    .where(keys.c.user_id == int(ident))):
+                self.removed.add(fingerprint)
+            self.session.execute(keys.delete()
+                                     .where(keys.c.user_id == int(ident)))
+            self.session.execute(users.delete()
+                                      .where(users.c.id == int(ident)))
+        elif kind == 'rule':
+            rules = Rule.__table__
+            self.session.execute(rules.delete()
+                                      .where(rules.c.id == int(ident)))
+            self.rules_changed = True
+        elif kind == 'config':
+            section, _, key = ident.partition('.')
+            if not is_local(section, key):
+                self.settings.append(('delete', section, key, None))
+        else:
+            raise InvalidExport('Unknown kind {!r}'.format(kind))
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        table = {'user': User.__table__,
+                 'key': PublicKey.__table__,
+                 'rule': Rule.__table__}[self.pending_type]
+
+        if self.pending_type == 'key':
+            # existing keys are replaced, their old lines must go
+            keys = PublicKey.__table__
+            for (fingerprint,) in self.session.execute(
+                    select([keys.c.fingerprint]).where(
+                        keys.c.fingerprint.in_(
+                            [row['fingerprint'] for row in self.pending]))):
+                self.removed.add(fingerprint)
+
+        self.session.execute(table.insert().prefix_with('OR REPLACE'),
+                             self.pending)
+        self.pending = []
+
+    def finish(self):
+        self.flush()
+
+        for op, section, key, value in self.settings:
+            if op == 'set':
+                self.gh.config[section][key] = value
+            elif key in self.gh.config[section]:
+                del self.gh.config[section][key]
+
+
+def import_authz(gh, infile):
+    """Apply an export to ``gh`` and save it.
+
+    The import is applied in a single transaction, which is rolled back if
+    the export turns out to be invalid. Deltas must continue where the last
+    import from the same source left off.
+
+    :param infile: A binary file with an export.
+    :return: The header of the export.
+    """
+    docs = iter_export(infile)
+    try:
+        header = next(docs)
+    except StopIteration:
+        raise InvalidExport('Export is empty')
+
+    if header.get('format') != FORMAT:
+        raise InvalidExport('Not a githome authorization export')
+    if header.get('format_version') != FORMAT_VERSION:
+        raise InvalidExport('Unsupported format version {}'.format(
+            header.get('format_version')))
+
+    replica = gh.config['replica']
+    if not header['full']:
+        if replica.get('source') != header['source']:
+            raise InvalidExport('Delta of {} cannot be applied, import a '
+                                'full export first'.format(header['source']))
+        if replica.get('version', 0) < header['since']:
+            raise InvalidExport(
+                'Delta starts at version {}, but only version {} was '
+                'imported; import a full export or a delta since {}'.format(
+                    header['since'], replica.get('version', 0),
+                    replica.get('version', 0)))
+
+    importer = Importer(gh)
+    try:
+        if header['full']:
+            importer.clear()
+
+        for doc in docs:
+            importer.apply(doc)
+        importer.finish()
+    except (InvalidExport, KeyError, TypeError) as e:
+        gh.session.rollback()
+        if isinstance(e, InvalidExport):
+            raise
+        raise InvalidExport('Malformed document: {}'.format(e))
+
+    replica['source'] = header['source']
+    replica['version'] = header['version']
+
+    gh.keys_changed(added=importer.added, removed=importer.removed)
+    if importer.rules_changed:
+        gh.rules_changed()
+    gh.save()
+
+    log.info('Imported {} of {} (version {} to {}): {}'.format(
+        'full export' if header['full'] else 'delta', header['source'],
+        header['since'], header['version'],
+        ', '.join('{} {}'.format(n, kind)
+                  for kind, n in sorted(importer.counts.items())) or 'empty'
+    ))
+    return header
@@ -0,0 +1,192 @@
+import errno
+import os
+import subprocess
+
+from pathlib import Path
+
+from .exc import NoSuchRepository
+
+
+# this module is used by githome-shell and must only import the standard
+# library
+
+
+REPOS_PATH = 'repos'
+#: Template directory of new repositories, holding the post-receive hook
+#: that reports pushes to the server, see
+#: :meth:`~githome.home.GitHome.write_repo_template`.
+TEMPLATE_PATH = 'template'
+#: Path of the hook inside a repository or the template.
+HOOK_PATH = os.path.join('hooks', 'post-receive')
+
+
+def init_repo_args(path, template=None):
+    """Return the command line used to initialize a new repository.
+
+    :param path: Path of the repository to create.
+    :param template: Template directory to copy into the repository.
+    """
+    args = ['git', 'init', '--quiet', '--bare', '--shared=0600']
+    if template is not None:
+        args.append('--template={}'.format(template))
+    return args + [str(path)]
+
+
+def is_repo(path):
+    """Check whether ``path`` looks like a bare repository."""
+    return (os.path.isfile(os.path.join(path, 'HEAD'))
+            and os.path.isdir(os.path.join(path, 'objects')))
+
+
+def repo_stats(path):
+    """Gather statistics of a repository from the filesystem.
+
+    Files removed while walking the repository, e.g. by ``git gc``, are
+    skipped.
+
+    :param path: Path of the repository, as a string.
+    :return: A tuple of the size of all objects in bytes, the number of packs
+             and the time of the most recent change to a ref, as a UNIX
+             timestamp, or ``None``.
+    """
+    size = packs = 0
+    for dirpath, _, filenames in os.walk(os.path.join(path, 'objects')):
+        for name in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                continue
+            if name.endswith('.pack'):
+                packs += 1
+
+    # refs are updated by every push, either as loose files or, after a
+    # gc, in packed-refs
+    mtimes = []
+    candidates = [os.path.join(path, 'packed-refs')]
+    for dirpath, _, filenames in os.walk(os.path.join(path, 'refs')):
+        candidates.extend(os.path.join(dirpath, name) for name in filenames)
+    for candidate in candidates:
+        try:
+            mtimes.append(os.lstat(candidate).st_mtime)
+        except OSError:
+            pass
+
+    return size, packs, max(mtimes) if mtimes else None
+
+
+class RepoStore(object):
+    """The repositories inside a directory.
+
+    Besides repositories, the directory contains a pool of pre-initialized
+    repositories that can be claimed when a new repository is created.
+
+    :param root: The directory holding all repositories.
+    :param template: Template directory for new repositories. Ignored, until
+                     it exists.
+    """
+
+    # sanitize_path() never outputs a '~', so the pool cannot be accessed
+    # by clients
+    POOL_PATH = '~pool'
+
+    def __init__(self, root, template=None):
+        self.root = Path(root)
+        self.template = None if template is None else Path(template)
+
+    def path(self, rel_path):
+        return self.root / rel_path
+
+    def init_args(self, path):
+        """Return the command line used to initialize a new repository at
+        ``path``, see :func:`init_repo_args`."""
+        template = None
+        if self.template is not None and self.template.is_dir():
+            template = self.template.absolute()
+        return init_repo_args(path, template)
+
+    @property
+    def pool_path(self):
+        return self.root / self.POOL_PATH
+
+    def iter_pool(self):
+        """Iterate over pre-initialized repositories that can be claimed.
+
+        Repositories in the pool that are still being initialized have names
+        starting with a ``.`` and are skipped.
+        """
+        try:
+            names = os.listdir(str(self.pool_path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+
+        for name in names:
+            if not name.startswith('.'):
+                yield self.pool_path / name
+
+    def claim(self, path):
+        """Move a repository from the pool to ``path``.
+
+        Since the move is an atomic ``rename()``, concurrent claims never
+        receive the same repository.
+
+        :param path: Path of the new repository.
+        :return: ``True`` if ``path`` is a repository now, ``False`` if the
+                 pool was empty.
+        """
+        for candidate in self.iter_pool():
+            if not path.parent.exists():
+                path.parent.mkdir(parents=True)
+
+            try:
+                os.rename(str(candidate), str(path))
+            except OSError as e:
+                if e.errno in (errno.EEXIST, errno.ENOTEMPTY):
+                    # someone else created the repository in the meantime
+                    return True
+                if e.errno != errno.ENOENT:
+                    raise
+                # claimed by someone else, try the next one
+            else:
+                return True
+
+        return False
+
+    def iter_repos(self):
+        """Iterate over the paths of all repositories, relative to the root.
+
+        Directories ending in ``.git`` that are repositories are not
+        descended into; the pool is skipped.
+        """
+        root = str(self.root)
+        for dirpath, dirnames, _ in os.walk(root):
+            if dirpath == root and self.POOL_PATH in dirnames:
+                dirnames.remove(self.POOL_PATH)
+
+            for name in list(dirnames):
+                if name.endswith('.git') and is_repo(
+                        os.path.join(dirpath, name)):
+                    dirnames.remove(name)
+                    yield os.path.relpath(os.path.join(dirpath, name), root)
+
+    def get(self, rel_path, create=False):
+        """Return the absolute path of a repository.
+
+        :param rel_path: Sanitized path of the repository, relative to the
+                         root.
+        :param create: Create the repository if it does not exist, preferably
+                       by claiming one from the pool.
+        """
+        path = self.path(rel_path)
+
+        if not path.exists() or not path.is_dir():
+            if create:
+                # create the repo, unless we can get one from the pool
+                if not self.claim(path):
+                    path.mkdir(parents=True)
+                    subprocess.check_call(self.init_args(path))
+            else:
+                raise NoSuchRepository('Repository {} no found and not '
+                                       'creating.'.format(rel_path))
+        return path.absolute()
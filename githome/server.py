@@ -0,0 +1,939 @@
+from base64 import b64decode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+import errno
+from functools import partial
+from hashlib import md5
+import os
+import pwd
+import shlex
+import signal
+import socket
+import time
+from timeit import default_timer
+import uuid
+
+import logbook
+import trollius as asyncio
+from trollius import From, Return
+
+from .authz import RuleSet, build_command, check_command, sanitize_path
+from .cache import KeyIndex, RateLimiter
+from .exc import (GitHomeError, KeyNotFoundError, NoSuchRepository,
+                  PermissionDenied, ProtocolError, Throttled)
+from .journal import PushJournal
+from .maintenance import MaintenanceScheduler
+from .metrics import Registry, write_metrics
+from .proto import HEADER, MAGIC, Message, unpack_header
+from .replica import prune_log
+from .storage import create_engine
+
+
+log = logbook.Logger('server')
+
+
+#: Maximum number of pending connections. Once exceeded, clients fail to
+#: connect instead of waiting, so it is sized for bursts of many clients.
+BACKLOG = 1024
+
+#: First file descriptor passed by systemd, see ``sd_listen_fds(3)``.
+SD_LISTEN_FDS_START = 3
+
+
+def inherited_socket():
+    """Return the listening socket passed in by systemd socket activation.
+
+    The ``LISTEN_*`` variables are removed from the environment, so they are
+    not passed on to child processes.
+
+    :return: A socket or ``None``, if no socket was passed to this process.
+    """
+    pid = os.environ.pop('LISTEN_PID', None)
+    fds = os.environ.pop('LISTEN_FDS', None)
+    os.environ.pop('LISTEN_FDNAMES', None)
+
+    if pid is None or fds is None or int(pid) != os.getpid():
+        return None
+
+    if int(fds) != 1:
+        raise GitHomeError('Expected exactly one socket from systemd, got '
+                           '{}'.format(fds))
+
+    sock = socket.fromfd(SD_LISTEN_FDS_START, socket.AF_UNIX,
+                         socket.SOCK_STREAM)
+    os.close(SD_LISTEN_FDS_START)
+
+    log.info('Using socket passed in by systemd')
+    return sock
+
+
+def bind_socket(path, backlog=BACKLOG):
+    """Create a listening unix domain socket.
+
+    A stale socket file left behind at ``path`` is removed first.
+
+    :param path: Filesystem path of the socket.
+    :param backlog: Maximum number of pending connections.
+    """
+    log.info('Server socket: {}'.format(path))
+    if os.path.exists(path):
+        log.debug('Removing stale socket')
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+
+class GitHomeServer(object):
+    """Authorization server for ``gh_client``.
+
+    Keys are looked up in an in-memory :class:`~githome.cache.KeyIndex`,
+    which is reloaded whenever the database changes. Changes are detected by
+    polling every ``poll_interval`` seconds or immediately when a client sends
+    a ``reload`` request or the process receives ``SIGHUP``. The
+    configuration snapshot (see :mod:`githome.config`) and the access rules
+    (see :class:`~githome.authz.RuleSet`) are refreshed along with it.
+
+    Clients may speak either the framed protocol described in
+    :mod:`githome.proto` or the original line-based one, in which the client
+    sends the key fingerprint and the command on one line each and receives
+    ``OK`` followed by one line per argument or an ``E``-prefixed error.
+    Control requests use a single line, such as ``RELOAD``.
+
+    Besides authorizing commands, the server can stand in for the
+    authorized_keys file: in answer to a ``keys`` request, sent by ``gh_client
+    -k`` when run as sshd's ``AuthorizedKeysCommand``, it returns the
+    authorized_keys line of the presented key, looked up in the same index.
+    Keys are only returned for logins as the user running the server.
+
+    Pushes are reported by the post-receive hook of each repository with a
+    ``push`` request, sent by ``gh_client -p``. They are added to a
+    :class:`~githome.journal.PushJournal` and written to the database in the
+    background.
+
+    The event loop itself only handles socket I/O. Anything that may block,
+    like database or filesystem access, is run on a thread pool of at most
+    ``threads`` threads, while new repositories are initialized by
+    asynchronous subprocesses.
+
+    To keep ``git init`` off the critical path of the first push to a new
+    repository, the server keeps up to ``pool_size`` pre-initialized
+    repositories around (see :meth:`~githome.repos.RepoStore.claim`) and
+    refills the pool in the background whenever one is claimed.
+
+    Latencies of each stage of handling a connection, as well as connection
+    counts, are collected in :attr:`metrics`. They are returned in the
+    Prometheus text format upon a ``stats`` request and, if ``metrics_file``
+    is given, written to that file every ``metrics_interval`` seconds.
+
+    :param gh: The :class:`~githome.home.GitHome` to serve.
+    :param poll_interval: Seconds between checks for database changes.
+    :param threads: Maximum number of threads for blocking operations.
+    :param pool_size: Number of pre-initialized repositories to keep. ``0``
+                      disables the pool.
+    :param metrics_file: Path to periodically write metrics to.
+    :param metrics_interval: Seconds between writes of ``metrics_file``.
+    :param idle_timeout: If given, exit after this many seconds without any
+                         connections. Best combined with socket activation,
+                         which starts the server again on the next
+                         connection.
+    :param worker: Number of the worker, if the server is one of several
+                   run by a :class:`Supervisor`. The supervisor is asked to
+                   reload all workers upon a ``RELOAD`` request and the worker
+                   number is added to the metrics file name and labels.
+    :param failure_rate: Failed authorizations per second allowed for each
+                         key and each user, once ``failure_burst`` failures
+                         have been used up. Beyond that, requests with the
+                         key or of the user are denied without further
+                         checks and counted as throttled.
+    :param failure_burst: Number of failed authorizations allowed in a row.
+    :param unknown_keys: Number of unknown fingerprints to remember. Requests
+                         with those keys are denied right away until the
+                         key index is reloaded.
+    :param maintenance_jobs: Maximum number of repositories to maintain at
+                             once, see :mod:`githome.maintenance`. ``0``
+                             disables maintenance. With several workers,
+                             only the first one maintains repositories.
+    :param maintenance_interval: Seconds between looking for repositories
+                                 to maintain.
+    :param journal_interval: Seconds between writes of reported pushes, see
+                             :class:`~githome.journal.PushJournal`.
+    :param journal_retention: Days to keep reported pushes for. ``None``
+                              keeps them forever.
+    """
+
+    #: Seconds between removals of old change log entries, see
+    #: :func:`~githome.replica.prune_log`.
+    PRUNE_INTERVAL = 3600
+
+    #: Stages of handling a connection, in order.
+    STAGES = ('read', 'lookup', 'authorize', 'repo', 'write')
+
+    #: Control requests in the line-based protocol and their operations.
+    LEGACY_CONTROL = {
+        'RELOAD': 'reload',
+        'STATS': 'stats',
+    }
+
+    #: Exceptions that mean a client was denied access, as opposed to
+    #: something going wrong while serving it.
+    DENIED = (KeyNotFoundError, PermissionDenied, NoSuchRepository,
+              ValueError)
+
+    def __init__(self, gh, poll_interval=1.0, threads=4, pool_size=2,
+                 metrics_file=None, metrics_interval=15.0, idle_timeout=None,
+                 worker=None, failure_rate=1.0, failure_burst=20,
+                 unknown_keys=10000, maintenance_jobs=1,
+                 maintenance_interval=60.0, journal_interval=1.0,
+                 journal_retention=90):
+        self.gh = gh
+        self.poll_interval = poll_interval
+        self.pool_size = pool_size
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.idle_timeout = idle_timeout
+        self.worker = worker
+        self.last_active = time.time()
+        self._filling_pool = False
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.loop = None
+        self.system_user = pwd.getpwuid(os.getuid()).pw_name
+        # git runs hooks in the repository, which is reported by its real
+        # path
+        self.repos_root = os.path.realpath(str(gh.repos.root))
+
+        # forced command of the lines returned to AuthorizedKeysCommand, see
+        # GitHome.authorized_keys_command(). set by refresh_config()
+        self.ak_command = None
+
+        # compiled access rules and the rows they were compiled from. set by
+        # refresh_rules()
+        self.rules = None
+        self._rule_rows = None
+
+        # the index is refreshed from the thread pool, so its connection
+        # cannot be tied to the thread it was created in. reads go through
+        # read-only connections, which never hold up writers; the server's
+        # few writes, like those of the push journal, are committed right
+        # away
+        self.read_bind = create_engine(
+            gh.dsn, read_only=True, connect_args={'check_same_thread': False}
+        )
+        self.index = KeyIndex(self.read_bind, unknown_size=unknown_keys)
+        gh.use_read_only(self.read_bind)
+
+        # failed authorizations, by fingerprint and by user name
+        self.key_failures = RateLimiter(failure_rate, failure_burst)
+        self.user_failures = RateLimiter(failure_rate, failure_burst)
+
+        self.handlers = {
+            'auth': self.handle_auth,
+            'keys': self.handle_keys,
+            'push': self.handle_push,
+            'reload': self.handle_reload,
+            'stats': self.handle_stats,
+        }
+
+        if worker is None:
+            self.metrics = Registry()
+        else:
+            self.metrics = Registry(worker=worker)
+            if metrics_file:
+                root, ext = os.path.splitext(metrics_file)
+                self.metrics_file = '{}.{}{}'.format(root, worker, ext)
+
+        self.stages = OrderedDict()
+        for stage in self.STAGES:
+            self.stages[stage] = self.metrics.histogram(
+                'githome_stage_seconds',
+                'Time spent in each stage of handling a connection.',
+                stage=stage,
+            )
+
+        self.connections = OrderedDict()
+        for result in ('accepted', 'denied', 'throttled', 'error'):
+            self.connections[result] = self.metrics.counter(
+                'githome_connections_total',
+                'Number of handled connections, by result.',
+                result=result,
+            )
+
+        self.key_lookups = OrderedDict()
+        for result in ('found', 'unknown', 'invalid'):
+            self.key_lookups[result] = self.metrics.counter(
+                'githome_key_lookups_total',
+                'Number of keys requests from AuthorizedKeysCommand, by '
+                'result.',
+                result=result,
+            )
+
+        self.in_flight = self.metrics.gauge(
+            'githome_connections_in_flight',
+            'Number of connections currently being handled.',
+        )
+
+        self.journal = PushJournal(gh, self.run_blocking, self.metrics,
+                                   interval=journal_interval,
+                                   retention=journal_retention)
+
+        self.maintenance = None
+        if maintenance_jobs and not worker:
+            self.maintenance = MaintenanceScheduler(
+                gh, self.run_blocking, self.metrics,
+                concurrency=maintenance_jobs, interval=maintenance_interval,
+            )
+
+    @property
+    def socket_path(self):
+        return str(self.gh.path / self.gh.config['local']['gh_client_socket'])
+
+    def run_blocking(self, func, *args, **kwargs):
+        """Run a blocking function on the thread pool.
+
+        :return: A future for the function's result.
+        """
+        return self.loop.run_in_executor(self.executor,
+                                         partial(func, *args, **kwargs))
+
+    def refresh_config(self, force=False):
+        """Take a new configuration snapshot if the configuration has
+        changed, and update everything derived from it.
+
+        :return: ``True`` if the configuration was reloaded.
+        """
+        try:
+            if not self.gh.config.refresh() and not force:
+                return False
+
+            self.ak_command = self.gh.authorized_keys_command()
+            return True
+        finally:
+            self.gh.read_session.remove()
+
+    def refresh_rules(self, force=False):
+        """Recompile the access rules if they have changed.
+
+        The rules table is small, so it is simply read again whenever the
+        database changes; compiling only happens if the rules differ.
+
+        :return: ``True`` if the rules were recompiled.
+        """
+        try:
+            rows = [tuple(row[1:]) for row in self.gh.iter_rules()]
+        finally:
+            self.gh.read_session.remove()
+        if rows == self._rule_rows and not force:
+            return False
+
+        self.rules = RuleSet(rows)
+        self._rule_rows = rows
+        return True
+
+    @asyncio.coroutine
+    def poll(self):
+        while True:
+            yield From(asyncio.sleep(self.poll_interval))
+
+            try:
+                if (yield From(self.run_blocking(self.index.refresh))):
+                    log.info('Database changed, reloaded key index')
+
+                    # the configuration lives in the same database
+                    if (yield From(self.run_blocking(self.refresh_config))):
+                        log.info('Reloaded configuration')
+                    if (yield From(self.run_blocking(self.refresh_rules))):
+                        log.info('Reloaded access rules')
+            except Exception as e:
+                # keep serving from the old index, the next poll will retry
+                log.error('Could not reload key index: {}'.format(e))
+
+    def prune_authz_log(self):
+        try:
+            removed = prune_log(self.gh)
+            self.gh.session.commit()
+        except Exception:
+            self.gh.session.rollback()
+            raise
+        finally:
+            self.gh.session.remove()
+        return removed
+
+    @asyncio.coroutine
+    def prune_logs(self):
+        while True:
+            try:
+                removed = yield From(self.run_blocking(self.prune_authz_log))
+            except Exception as e:
+                log.error('Could not prune change log: {}'.format(e))
+            else:
+                if removed:
+                    log.info('Removed {} old change log entries'.format(
+                        removed))
+
+            yield From(asyncio.sleep(self.PRUNE_INTERVAL))
+
+    @asyncio.coroutine
+    def serve(self, sock):
+        # start_unix_server() calls listen() again, with its own default
+        yield From(asyncio.start_unix_server(self.handle_client, sock=sock,
+                                             backlog=BACKLOG))
+
+    @asyncio.coroutine
+    def reload(self):
+        try:
+            yield From(self.run_blocking(self.index.refresh, force=True))
+            yield From(self.run_blocking(self.refresh_config, force=True))
+            yield From(self.run_blocking(self.refresh_rules, force=True))
+        except Exception as e:
+            log.error('Could not reload key index: {}'.format(e))
+        else:
+            log.info('Reloaded key index on request')
+
+    @asyncio.coroutine
+    def handle_reload(self, request, log):
+        yield From(self.reload())
+
+        # other workers are reloaded through the supervisor
+        if self.worker is not None:
+            os.kill(os.getppid(), signal.SIGHUP)
+
+        raise Return(Message([('status', 'ok')]))
+
+    @asyncio.coroutine
+    def handle_stats(self, request, log):
+        raise Return(Message([('status', 'ok'),
+                              ('text', self.metrics.render())]))
+
+    @asyncio.coroutine
+    def write_metrics(self):
+        while True:
+            try:
+                yield From(self.run_blocking(write_metrics, self.metrics_file,
+                                             self.metrics.render()))
+            except Exception as e:
+                log.error('Could not write metrics to {}: {}'.format(
+                    self.metrics_file, e))
+
+            yield From(asyncio.sleep(self.metrics_interval))
+
+    @contextmanager
+    def active(self):
+        with self.in_flight.track():
+            try:
+                yield
+            finally:
+                self.last_active = time.time()
+
+    @asyncio.coroutine
+    def exit_when_idle(self):
+        while True:
+            if self.in_flight.value or self._filling_pool:
+                idle = 0
+            else:
+                idle = time.time() - self.last_active
+
+            if idle >= self.idle_timeout:
+                log.info('No connections for {:.0f} seconds, exiting'
+                         .format(idle))
+                self.loop.stop()
+                return
+
+            yield From(asyncio.sleep(self.idle_timeout - idle))
+
+    @asyncio.coroutine
+    def init_repo(self, path):
+        args = yield From(self.run_blocking(self.gh.repos.init_args, path))
+        proc = yield From(asyncio.create_subprocess_exec(*args))
+        status = yield From(proc.wait())
+
+        if status != 0:
+            raise GitHomeError('Could not initialize repository {}, git '
+                               'exited with status {}'.format(path, status))
+
+    @asyncio.coroutine
+    def fill_pool(self):
+        """Initialize repositories until the pool is full."""
+        if self._filling_pool:
+            return
+
+        self._filling_pool = True
+        try:
+            while True:
+                pool = yield From(self.run_blocking(
+                    lambda: list(self.gh.repos.iter_pool())
+                ))
+                if len(pool) >= self.pool_size:
+                    break
+
+                # initialize under a hidden name, so no one claims a
+                # repository before git is done with it
+                name = uuid.uuid4().hex
+                tmp = self.gh.repos.pool_path / ('.' + name)
+
+                yield From(self.run_blocking(os.makedirs, str(tmp)))
+                yield From(self.init_repo(tmp))
+                yield From(self.run_blocking(
+                    os.rename, str(tmp), str(self.gh.repos.pool_path / name)
+                ))
+                log.debug('Added {} to repository pool'.format(name))
+        except Exception as e:
+            log.error('Could not fill repository pool: {}'.format(e))
+        finally:
+            self._filling_pool = False
+
+    def register_repo(self, rel_path, creator):
+        # a repository missing from the registry is added by the next scan,
+        # that is no reason to fail a push
+        try:
+            self.gh.register_repo(rel_path, creator)
+            self.gh.session.commit()
+        except Exception as e:
+            self.gh.session.rollback()
+            log.error('Could not register repository {}: {}'.format(rel_path,
+                                                                   e))
+        finally:
+            self.gh.session.remove()
+
+    @asyncio.coroutine
+    def get_repo(self, rel_path, create=False, creator=None):
+        """Asynchronous version of :meth:`~githome.home.GitHome.get_repo`."""
+        path = self.gh.repos.path(rel_path)
+
+        if not (yield From(self.run_blocking(path.is_dir))):
+            if not create:
+                raise NoSuchRepository('Repository {} no found and not '
+                                       'creating.'.format(rel_path))
+
+            if (yield From(self.run_blocking(self.gh.repos.claim, path))):
+                asyncio.ensure_future(self.fill_pool())
+                yield From(self.run_blocking(self.register_repo, rel_path,
+                                             creator))
+                raise Return(path.absolute())
+
+            try:
+                yield From(self.run_blocking(os.makedirs, str(path)))
+            except OSError as e:
+                # another client may be creating the same repository, running
+                # git init twice is harmless
+                if e.errno != errno.EEXIST:
+                    raise
+
+            yield From(self.init_repo(path))
+            yield From(self.run_blocking(self.register_repo, rel_path,
+                                         creator))
+
+        raise Return(path.absolute())
+
+    @asyncio.coroutine
+    def handle_auth(self, request, log):
+        fingerprint = request.get('fingerprint', '').lower()
+        user = None
+        try:
+            # clients that keep failing are turned away before doing any
+            # work and without logging every attempt
+            if fingerprint in self.index.unknown:
+                raise Throttled('Key {} not found, again'.format(fingerprint))
+            if not self.key_failures.allowed(fingerprint):
+                raise Throttled('Too many failures of key {}'.format(
+                    fingerprint))
+
+            with self.stages['lookup'].time():
+                user = self.index.lookup(fingerprint)
+            log.info('authenticated as {}'.format(user.name))
+
+            if not self.user_failures.allowed(user.name):
+                raise Throttled('Too many failures of user {}'.format(
+                    user.name))
+
+            # check if user is allowed to execute command
+            with self.stages['authorize'].time():
+                name, rel_path, can_create = check_command(
+                    user, shlex.split(request.get('command', '')), self.rules
+                )
+
+            with self.stages['repo'].time():
+                repo_path = yield From(self.get_repo(rel_path, can_create,
+                                                     user.name))
+            clean_command = build_command(name, repo_path)
+        except Exception as e:
+            # deny on every exception, no exceptions!
+            if isinstance(e, Throttled):
+                log.debug('permission denied: {}'.format(e))
+                self.connections['throttled'].inc()
+            else:
+                log.warning('permission denied: {}'.format(e))
+                self.key_failures.charge(fingerprint)
+                if user is not None:
+                    self.user_failures.charge(user.name)
+
+                if isinstance(e, self.DENIED):
+                    self.connections['denied'].inc()
+                else:
+                    self.connections['error'].inc()
+
+            raise Return(Message([('status', 'error'),
+                                  ('message', 'access denied')]))
+        else:
+            # wrapped in else, for defensive reasons
+            log.info('Authorized for {!r}'.format(clean_command))
+            self.connections['accepted'].inc()
+
+            reply = Message([('status', 'ok')])
+            reply.extend(('arg', part) for part in clean_command)
+            reply.append(('env', 'GITHOME_USER={}'.format(user.name)))
+            raise Return(reply)
+
+    @asyncio.coroutine
+    def handle_keys(self, request, log):
+        # an empty reply makes sshd fall back to the next source of keys, if
+        # any, so unknown keys are not errors
+        reply = Message([('status', 'ok')])
+
+        user = request.get('user')
+        if user != self.system_user:
+            log.warning('keys requested for user {!r}, ignoring'.format(user))
+            self.key_lookups['invalid'].inc()
+            raise Return(reply)
+
+        try:
+            data = b64decode(request.get('key', ''))
+        except (TypeError, ValueError) as e:
+            log.warning('invalid key: {}'.format(e))
+            self.key_lookups['invalid'].inc()
+            raise Return(reply)
+
+        fingerprint = md5(data).hexdigest()
+        try:
+            # sshd offers every key a client has, most of them unknown, which
+            # must not push out the keys remembered by failed authorizations
+            owner = self.index.lookup(fingerprint, remember=False)
+        except KeyNotFoundError:
+            log.info('key {} not found'.format(fingerprint))
+            self.key_lookups['unknown'].inc()
+            raise Return(reply)
+
+        log.info('key {} belongs to {}'.format(fingerprint, owner.name))
+        self.key_lookups['found'].inc()
+
+        prefix, by_name = self.ak_command
+        reply.append(('line', self.gh.format_authorized_key(
+            prefix, by_name, fingerprint, owner.name, data
+        )))
+        raise Return(reply)
+
+    def repo_rel_path(self, path):
+        """Return the path of a repository relative to the repository root,
+        given its absolute path, or ``None`` if it is not a repository
+        clients can access."""
+        if not os.path.isabs(path):
+            return None
+
+        rel_path = os.path.relpath(os.path.normpath(path), self.repos_root)
+        # rules out anything outside the root, as well as the pool
+        try:
+            if str(sanitize_path(rel_path)) == rel_path:
+                return rel_path
+        except ValueError:
+            pass
+        return None
+
+    @asyncio.coroutine
+    def handle_push(self, request, log):
+        rel_path = self.repo_rel_path(request.get('repo', ''))
+        if rel_path is None:
+            log.warning('push to invalid repository {!r}'.format(
+                request.get('repo')))
+            raise Return(Message([('status', 'error'),
+                                  ('message', 'invalid repository')]))
+
+        updates = []
+        for update in request.get_all('update'):
+            parts = update.split(' ', 2)
+            if len(parts) != 3:
+                log.warning('invalid ref update {!r}'.format(update))
+                continue
+            updates.append(parts)
+
+        # written later, the hook does not wait for the database
+        self.journal.append(rel_path, updates, user=request.get('user'),
+                            request_id=request.get('request_id'))
+        log.info('{} updated {} refs of {}'.format(
+            request.get('user', 'someone'), len(updates), rel_path))
+
+        if self.maintenance:
+            self.maintenance.pushed(rel_path)
+
+        raise Return(Message([('status', 'ok')]))
+
+    @asyncio.coroutine
+    def read_request(self, reader):
+        """Read a request in either protocol.
+
+        Requests in the line-based protocol are translated into their framed
+        equivalent.
+
+        :return: A tuple of a flag that is ``True`` for the framed protocol
+                 and the request :class:`~githome.proto.Message`, or
+                 ``None`` if the client closed the connection.
+        """
+        first = yield From(reader.read(1))
+
+        if first == MAGIC[:1]:
+            header = first + (yield From(reader.readexactly(HEADER.size - 1)))
+            _, length = unpack_header(header)
+            payload = yield From(reader.readexactly(length))
+            raise Return((True, Message.decode(payload)))
+
+        line = (first + (yield From(reader.readline()))).strip()
+        if not line:
+            raise Return((False, None))
+
+        if line in self.LEGACY_CONTROL:
+            raise Return((False, Message([('op', self.LEGACY_CONTROL[line])])))
+
+        cmd = (yield From(reader.readline())).strip()
+        raise Return((False, Message([
+            ('op', 'auth'), ('fingerprint', line), ('command', cmd),
+        ])))
+
+    @staticmethod
+    def encode_legacy(reply):
+        if reply.get('status') != 'ok':
+            return 'E {}\n'.format(reply.get('message'))
+
+        text = reply.get('text')
+        if text is not None:
+            return text
+
+        # OK line, followed by the actual reply
+        return 'OK\n' + ''.join(arg + '\n' for arg in reply.get_all('arg'))
+
+    @asyncio.coroutine
+    def handle_client(self, client_reader, client_writer):
+        con_id = uuid.uuid4()
+        log = logbook.Logger('client-{}'.format(con_id))
+        log.debug('connected')
+
+        with closing(client_writer._transport), self.active():
+            start = default_timer()
+            try:
+                framed, request = yield From(self.read_request(client_reader))
+            except (asyncio.IncompleteReadError, ProtocolError) as e:
+                log.warning('invalid request: {}'.format(e))
+                self.connections['error'].inc()
+                return
+
+            if request is None:
+                log.warning('unexpected connection close')
+                self.connections['error'].inc()
+                return
+
+            op = request.get('op')
+            log.debug('Read {} request: {!r}'.format(
+                'framed' if framed else 'line-based', request))
+
+            if op == 'auth':
+                self.stages['read'].observe(default_timer() - start)
+
+            if op in self.handlers:
+                reply = yield From(self.handlers[op](request, log))
+            else:
+                log.warning('unknown operation: {!r}'.format(op))
+                reply = Message([('status', 'error'),
+                                 ('message', 'unknown operation')])
+
+            reply.append(('request_id', str(con_id)))
+
+            start = default_timer()
+            client_writer.write(reply.encode() if framed
+                                else self.encode_legacy(reply))
+            yield From(client_writer.drain())
+
+            if op == 'auth':
+                self.stages['write'].observe(default_timer() - start)
+
+    def run(self, debug=False, sock=None):
+        """Serve clients until interrupted.
+
+        :param debug: Enable event loop debugging.
+        :param sock: A listening socket to accept connections on. If not
+                     given, the socket passed in by systemd is used or a new
+                     socket is bound.
+        """
+        if sock is None:
+            sock = inherited_socket() or bind_socket(self.socket_path)
+
+        self.loop = loop = asyncio.get_event_loop()
+
+        # debug
+        loop.set_debug(debug)
+
+        # load all keys before accepting the first connection
+        self.index.refresh(force=True)
+        self.refresh_config(force=True)
+        self.refresh_rules(force=True)
+        log.info('Loaded {} keys'.format(len(self.index.keys)))
+
+        # start server
+        loop.run_until_complete(self.serve(sock))
+        loop.add_signal_handler(signal.SIGHUP,
+                                lambda: asyncio.ensure_future(self.reload()))
+        # stopping the loop runs the cleanup below, which writes pending
+        # push events
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        tasks = [asyncio.ensure_future(self.poll())]
+        if self.pool_size:
+            asyncio.ensure_future(self.fill_pool())
+        if self.metrics_file:
+            tasks.append(asyncio.ensure_future(self.write_metrics()))
+        if self.idle_timeout:
+            tasks.append(asyncio.ensure_future(self.exit_when_idle()))
+        if self.maintenance:
+            tasks.append(asyncio.ensure_future(self.maintenance.run()))
+        tasks.append(asyncio.ensure_future(self.journal.run()))
+        # with several workers, one is enough
+        if not self.worker:
+            tasks.append(asyncio.ensure_future(self.prune_logs()))
+
+        try:
+            loop.run_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            loop.close()
+            self.executor.shutdown()
+            self.index.close()
+
+            try:
+                self.journal.flush()
+            except Exception as e:
+                log.error('Could not write push events: {}'.format(e))
+
+
+def exit_worker(signum, frame):
+    raise SystemExit(0)
+
+
+class Supervisor(object):
+    """Runs a server in several pre-forked worker processes.
+
+    The listening socket is created once by the supervising process, or
+    passed in by systemd, and shared by all workers, each accepting
+    connections on its own event loop. Workers that die are restarted on the
+    same socket.
+
+    :param gh: The :class:`~githome.home.GitHome` to serve.
+    :param workers: Number of worker processes.
+    :param restart_delay: Minimum number of seconds between two starts of the
+                          same worker, to avoid restarting a crashing worker
+                          in a tight loop.
+    :param server_args: Additional keyword arguments for each worker's
+                        :class:`GitHomeServer`.
+    """
+
+    def __init__(self, gh, workers, restart_delay=1.0, **server_args):
+        self.gh = gh
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.server_args = server_args
+        self.children = {}
+        self.started = {}
+        self.stopping = False
+
+    def spawn(self, slot, sock, debug):
+        # back off if this worker was just started
+        wait = self.started.get(slot, 0) + self.restart_delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        if self.stopping:
+            return
+        self.started[slot] = time.time()
+
+        pid = os.fork()
+        if pid:
+            log.info('Started worker {} (pid {})'.format(slot, pid))
+            self.children[pid] = slot
+            return
+
+        # worker process: never return into the supervisor's code
+        status = 1
+        try:
+            # the supervisor forwards SIGINT as SIGTERM, which ends the
+            # worker right away until its event loop handles it
+            signal.signal(signal.SIGTERM, exit_worker)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            # ignored until the worker's event loop handles it
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+            server = GitHomeServer(self.gh, worker=slot, **self.server_args)
+            server.run(debug, sock=sock)
+            status = 0
+        except SystemExit as e:
+            status = e.code
+        except BaseException as e:
+            log.critical('Worker {} crashed: {}'.format(slot, e))
+        finally:
+            os._exit(status)
+
+    def signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def reload(self, signum, frame):
+        log.debug('Reloading workers')
+        self.signal_children(signal.SIGHUP)
+
+    def stop(self, signum, frame):
+        log.info('Received signal {}, stopping workers'.format(signum))
+        self.stopping = True
+        self.signal_children(signal.SIGTERM)
+
+    def run(self, debug=False):
+        path = str(self.gh.path / self.gh.config['local']['gh_client_socket'])
+
+        # a socket passed in by systemd is owned by systemd, do not remove it
+        sock = inherited_socket()
+        if sock is None:
+            sock = bind_socket(path)
+        else:
+            path = None
+
+        # do not share any database connections with the workers
+        self.gh.session.remove()
+        self.gh.bind.dispose()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+
+        try:
+            for slot in range(self.workers):
+                self.spawn(slot, sock, debug)
+
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                slot = self.children.pop(pid, None)
+                if slot is None:
+                    continue
+
+                if not self.stopping:
+                    log.warning('Worker {} (pid {}) exited with status {}, '
+                                'restarting'.format(slot, pid, status))
+                    self.spawn(slot, sock, debug)
+        finally:
+            sock.close()
+            if path and os.path.exists(path):
+                os.unlink(path)
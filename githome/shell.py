@@ -0,0 +1,51 @@
+"""Fast replacement for ``githome shell``, run from ``authorized_keys``.
+
+Authorizes a key using the snapshot written by
+:meth:`~githome.home.GitHome.write_authz_snapshot`, checks the rules written by
+:meth:`~githome.home.GitHome.write_rules` and executes the requested command.
+Neither SQLAlchemy nor click are imported, nor is the database opened.
+"""
+
+import os
+import shlex
+import sys
+
+from pathlib import Path
+
+from .authz import (RULES_PATH, SNAPSHOT_PATH, RuleSet, Snapshot,
+                    build_command, check_command)
+from .repos import REPOS_PATH, TEMPLATE_PATH, RepoStore
+
+
+def fail(msg):
+    sys.stderr.write('{}\n'.format(msg))
+    sys.exit(1)
+
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+
+    if len(argv) != 3:
+        fail('usage: githome-shell GITHOME_PATH KEY_FINGERPRINT')
+
+    path, fingerprint = Path(argv[1]), argv[2]
+
+    try:
+        user = Snapshot(path / SNAPSHOT_PATH).lookup(fingerprint)
+
+        command = shlex.split(os.environ.get('SSH_ORIGINAL_COMMAND', ''))
+        rules = RuleSet.load(path / RULES_PATH)
+        name, rel_path, can_create = check_command(user, command, rules)
+
+        repo_path = RepoStore(path / REPOS_PATH, path / TEMPLATE_PATH).get(
+            rel_path, can_create)
+        cmd = build_command(name, repo_path)
+    except Exception as e:
+        fail(str(e))
+
+    os.environ['GITHOME_USER'] = user.name
+    os.execvp(cmd[0], cmd)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""SQLite connection settings.
+
+Every connection to the githome database is set up with the pragmas below.
+The defaults can be overridden in the ``sqlite`` section of the
+configuration, e.g. ``githome config set sqlite.busy_timeout 10000``. Since
+the configuration is stored in the database itself, the section is read with
+a plain query on the first connection of an engine; changes take effect the
+next time a process starts.
+
+``journal_mode``
+    ``wal`` lets readers, like the server, carry on while a command is
+    writing and lets writers commit while the server reads. The mode is
+    stored in the database file, so it is only changed by writable
+    connections.
+
+``busy_timeout``
+    Milliseconds to wait for a lock held by another connection before
+    failing with "database is locked".
+
+``mmap_size``
+    Bytes of the database file to access through memory-mapped I/O instead
+    of ``read()`` calls. ``0`` disables memory-mapping.
+
+``synchronous``
+    How often SQLite waits for data to reach the disk. ``full`` makes every
+    commit durable; with ``normal``, the most recent commits in WAL mode may
+    be lost on power failure, but the database is never corrupted.
+
+Engines created with ``read_only=True`` additionally set ``query_only``,
+so a bug in the server cannot modify the database.
+"""
+
+from collections import OrderedDict
+import json
+from numbers import Integral
+import sqlite3
+
+import logbook
+from sqlalchemy import create_engine as sa_create_engine, event
+
+
+log = logbook.Logger('storage')
+
+
+#: Configuration section holding the settings.
+SECTION = 'sqlite'
+
+DEFAULTS = OrderedDict([
+    ('journal_mode', 'wal'),
+    ('busy_timeout', 5000),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('synchronous', 'full'),
+])
+
+CHOICES = {
+    'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal'),
+    'synchronous': ('off', 'normal', 'full', 'extra'),
+}
+
+
+def validate(name, value):
+    """Check a setting.
+
+    :return: The value to use.
+    :raise ValueError: If the value is invalid.
+    """
+    if name in CHOICES:
+        value = str(value).lower()
+        if value not in CHOICES[name]:
+            raise ValueError('must be one of {}'.format(
+                ', '.join(CHOICES[name])))
+        return value
+
+    if isinstance(value, bool) or not isinstance(value, Integral) \
+            or value < 0:
+        raise ValueError('must be a non-negative integer')
+    return value
+
+
+def read_settings(dbapi_con):
+    """Read the settings from the ``sqlite`` configuration section.
+
+    Invalid settings are logged and replaced by their defaults, so a typo
+    cannot lock anyone out of the database.
+
+    :param dbapi_con: A :mod:`sqlite3` connection.
+    :return: An :class:`~collections.OrderedDict` of all settings.
+    """
+    settings = OrderedDict(DEFAULTS)
+
+    try:
+        rows = dbapi_con.execute('SELECT key, data FROM config '
+                                 'WHERE section = ?', (SECTION,)).fetchall()
+    except sqlite3.OperationalError:
+        # not initialized yet
+        return settings
+
+    for name, data in rows:
+        if name not in DEFAULTS:
+            log.warning('Ignoring unknown setting {}.{}'.format(SECTION,
+                                                                 name))
+            continue
+
+        try:
+            settings[name] = validate(name, json.loads(data))
+        except ValueError as e:
+            log.warning('Ignoring invalid setting {}.{}: {}'.format(
+                SECTION, name, e))
+
+    return settings
+
+
+def apply_settings(dbapi_con, settings, read_only=False):
+    """Set up a new connection.
+
+    :param dbapi_con: A :mod:`sqlite3` connection.
+    :param settings: Settings as returned by :func:`read_settings`.
+    :param read_only: Disallow changes to the database.
+    """
+    cur = dbapi_con.cursor()
+    try:
+        cur.execute('PRAGMA busy_timeout = {:d}'.format(
+            settings['busy_timeout']))
+
+        if not read_only:
+            mode, = cur.execute('PRAGMA journal_mode').fetchone()
+            if mode != settings['journal_mode']:
+                try:
+                    cur.execute('PRAGMA journal_mode = {}'.format(
+                        settings['journal_mode']))
+                except sqlite3.OperationalError as e:
+                    # needs exclusive access, try again next time
+                    log.warning('Could not change journal mode to {}: {}'
+                                .format(settings['journal_mode'], e))
+
+        cur.execute('PRAGMA mmap_size = {:d}'.format(settings['mmap_size']))
+        cur.execute('PRAGMA synchronous = {}'.format(settings['synchronous']))
+
+        if read_only:
+            cur.execute('PRAGMA query_only = 1')
+    finally:
+        cur.close()
+
+
+def create_engine(dsn, read_only=False, **kwargs):
+    """Create an engine whose connections are set up by
+    :func:`apply_settings`.
+
+    :param dsn: An SQLite database URL.
+    :param read_only: Make all connections read-only.
+    :param kwargs: Passed on to :func:`sqlalchemy.create_engine`.
+    """
+    engine = sa_create_engine(dsn, **kwargs)
+    settings = []
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_con, con_record):
+        if not settings:
+            settings.append(read_settings(dbapi_con))
+        apply_settings(dbapi_con, settings[0], read_only)
+
+    return engine
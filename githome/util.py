@@ -1,71 +1,117 @@
+from contextlib import contextmanager
+import os
 import re
+import struct
+import tempfile
 
 import click
-from pathlib import Path
 
+from .authz import sanitize_path  # noqa, used to live here
 
-def block_replace(start_marker, end_marker, buf, replacement):
-    start = buf.index(start_marker)
-    end = buf.index(end_marker, start + len(start_marker))
 
-    return buf[:start + len(start_marker)] + replacement + buf[end:]
+@contextmanager
+def atomic_open(path, perms=None, binary=False):
+    """Open a temporary file that replaces ``path`` once it is closed.
 
+    The file is written next to ``path`` and moved into place using
+    ``rename()``, so readers see either the old or the new contents, never a
+    partial file. It is synced to disk before, so a crash cannot leave an
+    empty or truncated file behind either. If the ``with`` block raises,
+    ``path`` is left untouched.
 
-def block_update(start_marker, end_marker, buf, content, pad='\n\n'):
-    if not buf:
-        pad = ''
+    :param path: Path of the file to replace.
+    :param perms: Permissions of the new file. If not given, the permissions
+                  of an existing file at ``path`` are kept.
+    :param binary: Open the file in binary mode.
+    """
+    path = os.path.realpath(str(path))
+    dirname, basename = os.path.split(path)
+
+    if perms is None:
+        try:
+            perms = os.stat(path).st_mode & 0o7777
+        except OSError:
+            perms = 0o600
+
+    fd, tmp = tempfile.mkstemp(prefix='.' + basename, dir=dirname)
     try:
-        return block_replace(start_marker, end_marker, buf, content)
-    except ValueError:
-        return buf + pad + start_marker + content + end_marker
+        with os.fdopen(fd, 'wb' if binary else 'w') as out:
+            yield out
+            out.flush()
+            os.fsync(out.fileno())
+        os.chmod(tmp, perms)
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    # make the rename itself durable
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 
-def sanitize_path(path, subchar='-', invalid_chars=r'[^a-zA-Z0-9-_.]',
-                  invalid_comps=('.', '..', '.git'), force_suffix='.git'):
-    """Sanitizes a path by making it relative and git safe.
+#: Maximum number of values passed to a single query. SQLite allows at most
+#: 999 parameters per query.
+MAX_PARAMS = 900
 
-    Any part coming in will be made relative first (by cutting leading
-    slashes). Invalid characters (see ``invalid_chars``) are removed and
-    replaced with ``subchar``. A suffix can be forced upon the path as well.
 
-    :param path: Path to sanitize (string or Path).
-    :param subchar: Character used to substitute illegal path components with.
-    :param invalid_chars: A regular expression that matches invalid characters.
-    :param invalid_comps: A collection of path components that are not allowed.
-    :param force_suffix: The suffix to force onto each path.
-    :return: A Path instance denoting a relative path.
-    """
-    unsafe = Path(path)
+def chunks(items, size):
+    """Split ``items`` into lists of at most ``size`` items."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 
-    # turn absolute path into a relative one by stripping the leading '/'
-    if unsafe.is_absolute():
-        unsafe = unsafe.relative_to(unsafe.anchor)
+def block_replace(start_marker, end_marker, buf, replacement):
+    start = buf.index(start_marker)
+    end = buf.index(end_marker, start + len(start_marker))
 
-    # every component must be alphanumeric
-    components = []
-    for p in unsafe.parts:
-        # remove invalid characters
-        clean = re.sub(invalid_chars, subchar, p)
+    return buf[:start + len(start_marker)] + replacement + buf[end:]
 
-        # if the name is empty, ignore it. this usually shouldn't happend with
-        # pathlib
-        if not clean:
-            continue
 
-        # if the name is potentially dangerous, reject it
-        if clean in invalid_comps:
-            raise ValueError('{} is a reserved path component'.format(clean))
+def block_update(start_marker, end_marker, buf, content, pad='\n\n'):
+    return ''.join(iter_block_update(start_marker, end_marker, buf, [content],
+                                     pad))
 
-        components.append(clean)
 
-    if not components:
-        raise ValueError('Path too short')
+def iter_block_update(start_marker, end_marker, buf, chunks, pad='\n\n'):
+    """Like :func:`block_update`, but the new content is an iterable of
+    strings and the result is returned in pieces, so neither has to be held in
+    memory as a whole."""
+    try:
+        start = buf.index(start_marker) + len(start_marker)
+        end = buf.index(end_marker, start)
+    except ValueError:
+        if buf:
+            yield buf + pad
+        yield start_marker
+        for chunk in chunks:
+            yield chunk
+        yield end_marker
+    else:
+        yield buf[:start]
+        for chunk in chunks:
+            yield chunk
+        yield buf[end:]
+
+
+def key_type(data):
+    """Return the type of an SSH public key, e.g. ``ssh-rsa``.
+
+    :param data: The key's binary blob.
+    """
+    length, = struct.unpack('!I', data[:4])
+    return data[4:4 + length]
 
-    # append a final suffix if not present
-    if force_suffix and not components[-1].endswith(force_suffix):
-        components[-1] += force_suffix
 
-    return Path(*components)
+def readable_fingerprint(fingerprint):
+    """Format a hex-encoded fingerprint like ``ssh-keygen -l`` does, e.g.
+    ``fa:9d:07:...``, without parsing the key."""
+    return ':'.join(fingerprint[i:i + 2]
+                    for i in range(0, len(fingerprint), 2))
 
 
 class ConfigValue(click.ParamType):
@@ -43,6 +43,7 @@ setup(
     entry_points={
         'console_scripts': [
             'githome = githome.cmd:cli',
+            'githome-shell = githome.shell:main',
         ],
     },
     cmdclass={
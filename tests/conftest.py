@@ -0,0 +1,20 @@
+from githome.home import GitHome
+from sshkeys import Key as SSHKey
+import pathlib
+import pytest
+
+
+@pytest.fixture
+def gh(tmpdir):
+    gh = GitHome.initialize(pathlib.Path(str(tmpdir)))
+
+    # never touch the real ~/.ssh/authorized_keys
+    gh.config['local']['authorized_keys_file'] = str(tmpdir / 'ak')
+    gh.save()
+
+    return gh
+
+
+@pytest.fixture
+def pkey():
+    return SSHKey.from_pubkey_file('test_rsa.key.pub')
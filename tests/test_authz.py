@@ -0,0 +1,117 @@
+from io import BytesIO
+import os
+
+from githome.authz import (CREATE, READ, WRITE, AuthUser, RuleSet, Snapshot,
+                           check_command, sanitize_path, write_snapshot)
+from githome.exc import KeyNotFoundError, PermissionDenied
+import pytest
+
+
+def make_snapshot(tmpdir, rows):
+    buf = BytesIO()
+    write_snapshot(buf, rows)
+
+    path = tmpdir / 'snapshot'
+    path.write_binary(buf.getvalue())
+    return Snapshot(str(path))
+
+
+def test_snapshot_lookup(tmpdir):
+    rows = [(os.urandom(16).encode('hex'), i, u'user{}'.format(i % 7))
+            for i in range(500)]
+    snapshot = make_snapshot(tmpdir, rows)
+
+    for fp, uid, name in rows:
+        user = snapshot.lookup(fp.upper())
+        assert user == (uid, name)
+
+    with pytest.raises(KeyNotFoundError):
+        snapshot.lookup('00' * 16)
+
+
+@pytest.mark.parametrize('fingerprint', ['', 'xyz', 'abc', '00' * 17])
+def test_snapshot_rejects_invalid_fingerprints(tmpdir, fingerprint):
+    snapshot = make_snapshot(tmpdir, [('11' * 16, 1, u'alice')])
+
+    with pytest.raises(KeyNotFoundError):
+        snapshot.lookup(fingerprint)
+
+
+def test_snapshot_updated_on_save(gh, pkey):
+    snapshot = Snapshot(gh.path / gh.AUTHZ_PATH)
+    with pytest.raises(KeyNotFoundError):
+        snapshot.lookup(pkey.fingerprint.encode('hex'))
+
+    gh.add_key(gh.create_user('alice'), pkey)
+    gh.save()
+
+    snapshot = Snapshot(gh.path / gh.AUTHZ_PATH)
+    assert snapshot.lookup(pkey.fingerprint.encode('hex')).name == 'alice'
+
+
+def test_rules():
+    rules = RuleSet([
+        ('*', 'pub/**', 'r'),
+        ('alice', 'pub/*', 'w'),
+        ('alice', 'alice/**', 'rwc'),
+        ('bob', 'team/*/shared', 'rw'),
+        ('bob', 'team/[ab]*', 'r'),
+    ])
+
+    def rights(user, path):
+        return rules.rights(user, sanitize_path(path))
+
+    assert rights('bob', 'pub/x') == READ
+    assert rights('bob', 'pub/a/b/c') == READ
+    assert rights('alice', 'pub/x') == READ | WRITE
+    assert rights('alice', 'pub/a/x') == READ
+    assert rights('alice', 'alice') == 0
+    assert rights('alice', 'alice/x') == READ | WRITE | CREATE
+    assert rights('bob', 'alice/x') == 0
+    assert rights('bob', 'team/foo/shared.git') == READ | WRITE
+    assert rights('bob', 'team/foo/other') == 0
+    assert rights('bob', 'team/bar') == READ
+    assert rights('bob', 'team/car') == 0
+
+
+@pytest.mark.parametrize('rule', [
+    ('alice', '', 'r'),
+    ('alice', 'a/../b', 'r'),
+    ('alice', 'a/**b', 'r'),
+    ('alice', 'a', 'rx'),
+])
+def test_invalid_rules(rule):
+    with pytest.raises(ValueError):
+        RuleSet([rule])
+
+
+def test_check_command_rights():
+    alice = AuthUser(1, 'alice')
+    rules = RuleSet([('*', '**', 'r'), ('alice', 'alice/*', 'w')])
+
+    assert check_command(alice, ['git-upload-pack', 'x'], rules)[2] is False
+    with pytest.raises(PermissionDenied):
+        check_command(alice, ['git-receive-pack', 'x'], rules)
+
+    name, rel_path, can_create = check_command(
+        alice, ['git-receive-pack', 'alice/x'], rules)
+    assert str(rel_path) == 'alice/x.git' and not can_create
+
+    rules.add('alice', 'alice/*', 'c')
+    assert check_command(alice, ['git-receive-pack', 'alice/x'], rules)[2]
+
+
+def test_rules_written_on_save(gh):
+    rules = RuleSet.load(gh.path / gh.RULES_PATH)
+    assert rules.rules == [('*', '**', 'rwc')]
+
+    for rule_id, _, _, _ in gh.iter_rules():
+        gh.delete_rule(rule_id)
+    gh.add_rule('Alice', 'alice/*', 'rw')
+    gh.save()
+
+    rules = RuleSet.load(gh.path / gh.RULES_PATH)
+    assert rules.rules == [('alice', 'alice/*', 'rw')]
+
+    with pytest.raises(PermissionDenied):
+        gh.authorize_command(AuthUser(1, 'bob'), ['git-upload-pack', 'x'])
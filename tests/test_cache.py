@@ -0,0 +1,103 @@
+from githome.cache import KeyIndex, LRUCache, RateLimiter
+from githome.exc import KeyNotFoundError
+import pytest
+
+
+def test_index_loads_keys(gh, pkey):
+    gh.add_key(gh.create_user('alice'), pkey)
+    gh.save()
+
+    index = KeyIndex(gh.bind)
+    assert index.refresh()
+
+    user = index.lookup(pkey.fingerprint.encode('hex'))
+    assert user.name == 'alice'
+
+
+def test_index_refreshes_only_on_change(gh, pkey):
+    user = gh.create_user('alice')
+    gh.save()
+
+    index = KeyIndex(gh.bind)
+    index.refresh()
+    assert not index.refresh()
+
+    with pytest.raises(KeyNotFoundError):
+        index.lookup(pkey.fingerprint.encode('hex'))
+
+    gh.add_key(user, pkey)
+    gh.save()
+
+    assert index.refresh()
+    assert index.lookup(pkey.fingerprint.encode('hex')).name == 'alice'
+
+
+def test_index_forgets_unknown_keys_on_reload(gh, pkey):
+    user = gh.create_user('alice')
+    gh.save()
+
+    index = KeyIndex(gh.bind, unknown_size=2)
+    index.refresh()
+    for fp in ('AA', 'bb', 'cc', pkey.fingerprint.encode('hex')):
+        with pytest.raises(KeyNotFoundError):
+            index.lookup(fp)
+    assert 'aa' not in index.unknown
+    assert pkey.fingerprint.encode('hex') in index.unknown
+
+    gh.add_key(user, pkey)
+    gh.save()
+    assert index.refresh()
+    assert len(index.unknown) == 0
+
+
+def test_index_ignores_unrelated_commits(gh, pkey):
+    gh.create_user('alice')
+    gh.save()
+
+    index = KeyIndex(gh.bind)
+    index.refresh()
+    with pytest.raises(KeyNotFoundError):
+        index.lookup(pkey.fingerprint.encode('hex'))
+
+    # bookkeeping, like that of the push journal, is not reloaded for
+    gh.register_repo('foo.git')
+    gh.session.commit()
+    assert not index.refresh()
+
+    # a reload that does not change the keys keeps the unknown ones
+    gh.config['repos']['default_branch'] = 'main'
+    gh.save()
+    assert index.refresh()
+    assert pkey.fingerprint.encode('hex') in index.unknown
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['a'] = 3
+    cache['c'] = 4
+
+    assert 'b' not in cache
+    assert (cache.get('a'), cache.get('c')) == (3, 4)
+
+
+def test_rate_limiter():
+    now = [0.0]
+    limiter = RateLimiter(rate=0.5, burst=2, clock=lambda: now[0])
+
+    assert limiter.allowed('a')
+    limiter.charge('a')
+    limiter.charge('a')
+    assert not limiter.allowed('a')
+    assert limiter.allowed('b')
+
+    now[0] = 1.0
+    assert not limiter.allowed('a')
+    now[0] = 2.0
+    assert limiter.allowed('a')
+
+    now[0] = 100.0
+    limiter.charge('a')
+    limiter.charge('a')
+    assert not limiter.allowed('a')
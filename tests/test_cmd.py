@@ -0,0 +1,100 @@
+import json
+import subprocess
+import sys
+
+from click.testing import CliRunner
+from githome.cmd import cli
+
+
+def test_cmd_imports_no_heavy_modules():
+    out = subprocess.check_output([sys.executable, '-c', '''
+import json, sys
+import githome.cmd
+json.dump([m for m, mod in sys.modules.items() if mod is not None], sys.stdout)
+'''])
+    loaded = set(m.split('.')[0] for m in json.loads(out))
+
+    assert not loaded & {'sqlalchemy', 'sqlacfg', 'sshkeys', 'trollius'}
+
+
+def test_commands_load_githome(gh):
+    runner = CliRunner()
+    args = ['--githome', str(gh.path)]
+
+    result = runner.invoke(cli, args + ['user', 'add', 'alice'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, args + ['user', 'list'])
+    assert result.exit_code == 0
+    assert 'alice' in result.output
+
+
+def test_invalid_githome(tmpdir):
+    result = CliRunner().invoke(cli, ['--githome', str(tmpdir), 'user',
+                                      'list'])
+    assert result.exit_code == 1
+
+
+def test_list_users(gh, pkey):
+    for name in ('carol', 'alice', 'bob'):
+        gh.create_user(name)
+    gh.add_key(gh.get_user_by_name('bob'), pkey)
+    gh.save()
+
+    args = ['--githome', str(gh.path), 'user', 'list']
+    result = CliRunner().invoke(cli, args + ['--keys'])
+    assert result.exit_code == 0
+    assert pkey.readable_fingerprint in result.output.splitlines()[1]
+
+    result = CliRunner().invoke(cli, args + ['--keys', '--format', 'json',
+                                             '--limit', '2', '--offset', '1'])
+    assert result.exit_code == 0
+    assert [(u['name'], u['keys']) for u in json.loads(result.output)] == [
+        ('bob', [pkey.readable_fingerprint]), ('carol', [])]
+
+    result = CliRunner().invoke(cli, args + ['--format', 'json',
+                                             '--offset', '3'])
+    assert json.loads(result.output) == []
+
+
+def test_init_writes_hook_from_config(tmpdir):
+    path = tmpdir / 'gh'
+    client = str(tmpdir / 'gh_client')
+    result = CliRunner().invoke(cli, [
+        'init', '-c', 'local.gh_client_executable', client,
+        '-c', 'local.authorized_keys_file', str(tmpdir / 'ak'), str(path),
+    ])
+    assert result.exit_code == 0
+
+    with open(str(path / 'template' / 'hooks' / 'post-receive')) as f:
+        assert 'exec {} -p '.format(client) in f.read()
+
+
+def test_check_rule_normalizes_user(gh):
+    gh.create_user('alice')
+    gh.add_rule('alice', 'shared/*', 'rw')
+    gh.save()
+    args = ['--githome', str(gh.path), 'rule', 'check']
+
+    result = CliRunner().invoke(cli, args + ['Alice', 'shared/x'])
+    assert result.exit_code == 0
+    assert result.output.split()[1] == 'shared/x.git'
+    assert result.output == CliRunner().invoke(
+        cli, args + ['alice', 'shared/x']).output
+
+    result = CliRunner().invoke(cli, args + ['bob', 'shared/x'])
+    assert result.exit_code == 1
+
+
+def test_import_keys_from_jsonl(gh, pkey, tmpdir):
+    source = tmpdir / 'keys.jsonl'
+    with open('test_rsa.key.pub') as f:
+        source.write(json.dumps({'user': 'alice', 'key': f.read()}) + '\n')
+
+    result = CliRunner().invoke(cli, [
+        '--githome', str(gh.path), 'key', 'import', '--create-users',
+        str(source),
+    ])
+    assert result.exit_code == 0
+    key = gh.get_key_by_fingerprint(pkey.fingerprint)
+    assert key.user.name == 'alice'
@@ -0,0 +1,56 @@
+from githome.home import GitHome
+from sqlalchemy import event
+from sqlacfg.format import ini_format
+
+
+def count_statements(gh):
+    statements = []
+    event.listen(gh.bind, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+    return statements
+
+
+def test_reads_come_from_snapshot(gh):
+    gh.config.snapshot
+    statements = count_statements(gh)
+
+    for _ in range(10):
+        gh.config['local']['use_gh_client']
+        dict(gh.config['local'].iteritems())
+
+    assert 'local' in gh.config
+    assert statements == []
+
+
+def test_write_bumps_version(gh):
+    version = gh.config.version()
+
+    gh.config.cset('local.foo', 'bar')
+    assert gh.config['local']['foo'] == 'bar'
+    assert gh.config.snapshot.version == version + 1
+
+    del gh.config['local']['foo']
+    assert 'foo' not in gh.config['local']
+    assert gh.config.version() == version + 2
+
+
+def test_refresh_picks_up_other_writers(gh):
+    other = GitHome(gh.path)
+    other.config.snapshot
+
+    gh.config.cset('local.foo', 'bar')
+    gh.save()
+
+    statements = count_statements(other)
+    assert 'foo' not in other.config['local']
+    assert other.config.refresh()
+    assert other.config['local']['foo'] == 'bar'
+
+    # only the version is read while nothing changes
+    del statements[:]
+    assert not other.config.refresh()
+    assert len(statements) == 1
+
+
+def test_ini_format(gh):
+    assert 'use_gh_client = True' in ini_format(gh.config)
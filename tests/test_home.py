@@ -0,0 +1,301 @@
+from githome.exc import GitHomeError, NoSuchRepository, UserNotFoundError
+from githome.repos import init_repo_args
+from sqlalchemy import event
+from sshkeys import Key as SSHKey
+import os
+import socket
+import subprocess
+import pytest
+
+
+@pytest.fixture
+def user(gh):
+    user = gh.create_user('alice')
+    gh.save()
+    return user
+
+
+def fill_pool(gh, n):
+    for i in range(n):
+        path = gh.repos.pool_path / 'slot{}'.format(i)
+        path.mkdir(parents=True)
+        subprocess.check_call(init_repo_args(path))
+
+
+@pytest.mark.parametrize('cmd', ['git-upload-pack', 'git-upload-archive'])
+def test_reading_does_not_create_repos(gh, user, cmd):
+    with pytest.raises(NoSuchRepository):
+        gh.authorize_command(user, [cmd, 'foo/bar'])
+
+    assert not gh.repos.path('foo').exists()
+
+
+def test_push_creates_repo(gh, user):
+    cmd = gh.authorize_command(user, ['git-receive-pack', 'foo/bar'])
+
+    assert cmd == ['git-receive-pack',
+                   str(gh.repos.path('foo/bar.git').absolute())]
+    assert (gh.repos.path('foo/bar.git') / 'HEAD').exists()
+
+
+def test_repo_registry(gh, user):
+    fill_pool(gh, 1)
+    gh.authorize_command(user, ['git-receive-pack', 'foo/bar'])
+
+    other = gh.repos.path('baz.git')
+    other.mkdir()
+    subprocess.check_call(init_repo_args(other))
+    blob = subprocess.check_output(['git', '--git-dir', str(other),
+                                    'hash-object', '-w', __file__]).strip()
+    subprocess.check_call(['git', '--git-dir', str(other), 'update-ref',
+                           'refs/tags/blob', blob])
+
+    assert [(r.path, r.creator) for r in gh.iter_repos()] == [
+        ('foo/bar.git', 'alice')]
+
+    assert gh.scan_repos(processes=2) == {'added': 1, 'updated': 1,
+                                          'removed': 0}
+    repos = {r.path: r for r in gh.iter_repos()}
+    assert sorted(repos) == ['baz.git', 'foo/bar.git']
+    assert repos['foo/bar.git'].creator == 'alice'
+    assert repos['baz.git'].size > 0 and repos['baz.git'].last_push
+
+    subprocess.check_call(['rm', '-rf', str(other)])
+    assert gh.scan_repos()['removed'] == 1
+
+
+def test_install_hooks(gh):
+    gh.write_repo_template()
+    new = gh.get_repo('new.git', create=True)
+    hook = new / 'hooks' / 'post-receive'
+    with open(str(hook)) as f:
+        assert f.read() == gh.hook_script()
+    assert os.access(str(hook), os.X_OK)
+
+    old = gh.repos.path('old.git')
+    old.mkdir()
+    subprocess.check_call(init_repo_args(old))
+    foreign = gh.repos.path('foreign.git')
+    foreign.mkdir()
+    subprocess.check_call(init_repo_args(foreign))
+    with open(str(foreign / 'hooks' / 'post-receive'), 'w') as f:
+        f.write('#!/bin/sh\n')
+
+    assert gh.install_hooks() == (2, 1)
+    with open(str(old / 'hooks' / 'post-receive')) as f:
+        assert f.read() == gh.hook_script()
+    with open(str(foreign / 'hooks' / 'post-receive')) as f:
+        assert f.read() == '#!/bin/sh\n'
+
+
+def test_config_change_reinstalls_hooks(gh):
+    gh.write_repo_template()
+    repo = gh.get_repo('foo.git', create=True)
+
+    gh.set_config('local.gh_client_executable', '/opt/gh_client')
+    gh.save()
+
+    for path in (repo, gh.path / gh.TEMPLATE_PATH):
+        with open(str(path / 'hooks' / 'post-receive')) as f:
+            assert 'exec /opt/gh_client -p ' in f.read()
+
+
+def test_claim_repo_from_pool(gh):
+    fill_pool(gh, 2)
+
+    assert gh.repos.claim(gh.repos.path('a/b.git'))
+    assert gh.repos.claim(gh.repos.path('c.git'))
+    assert not gh.repos.claim(gh.repos.path('d.git'))
+
+    assert (gh.repos.path('a/b.git') / 'HEAD').exists()
+    assert (gh.repos.path('c.git') / 'HEAD').exists()
+    assert not list(gh.repos.iter_pool())
+
+
+def test_claim_repo_skips_unfinished(gh):
+    (gh.repos.pool_path / '.unfinished').mkdir(parents=True)
+
+    assert not gh.repos.claim(gh.repos.path('a.git'))
+
+
+def test_authorized_keys_block(gh, user, pkey):
+    gh.add_key(user, pkey)
+    gh.save()
+
+    line, = gh.get_authorized_keys_block().splitlines()
+    parsed = SSHKey.from_pubkey_line(line)
+
+    assert parsed.data == pkey.data
+    assert parsed.options['no-pty']
+    assert parsed.options['command'].endswith(
+        "'{}'".format(pkey.fingerprint.encode('hex'))
+    )
+
+
+def test_authorized_keys_block_uses_constant_queries(gh, pkey):
+    for i in range(20):
+        key = SSHKey(pkey.data + str(i))
+        gh.add_key(gh.create_user('user{}'.format(i)), key)
+    gh.config['local']['use_gh_client'] = False
+    gh.config['local']['githome_shell_executable'] = ''
+    gh.save()
+
+    statements = []
+    event.listen(gh.bind, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+
+    assert len(gh.get_authorized_keys_block().splitlines()) == 20
+    assert len(statements) <= 2
+
+
+def test_update_authorized_keys_keeps_other_keys(gh, user, pkey):
+    ak = gh.path / 'ak'
+    ak.open('wb').write(b'ssh-rsa AAAA other@host\n')
+    gh.config['local']['authorized_keys_file'] = str(ak)
+
+    gh.add_key(user, pkey)
+    gh.save()
+
+    content = ak.open('rb').read()
+    assert content.startswith(b'ssh-rsa AAAA other@host\n')
+    assert pkey.fingerprint.encode('hex') in content
+
+
+def make_keys(pkey, n):
+    return [SSHKey(pkey.data + str(i)) for i in range(n)]
+
+
+def ak_fingerprints(gh):
+    content = (gh.path / 'ak').open('rb').read()
+    return [line.rsplit(' githome:', 1)[1] for line in content.splitlines()
+            if ' githome:' in line]
+
+
+@pytest.mark.parametrize('index_changes', [0, 50])
+def test_update_authorized_keys_incrementally(gh, user, pkey, monkeypatch,
+                                              index_changes):
+    # changed lines are found through an index or one by one
+    monkeypatch.setattr(gh, 'INDEX_KEY_CHANGES', index_changes)
+    (gh.path / 'ak').open('wb').write(b'')
+    gh.config['local']['authorized_keys_file'] = str(gh.path / 'ak')
+
+    keys = make_keys(pkey, 3)
+    for key in keys:
+        gh.add_key(user, key)
+    gh.save()
+
+    fps = [key.fingerprint.encode('hex') for key in keys]
+    assert sorted(ak_fingerprints(gh)) == sorted(fps)
+
+    gh.delete_key(keys[1].fingerprint)
+    gh.add_key(user, pkey)
+    gh.save()
+
+    assert ak_fingerprints(gh) == [fps[0], fps[2],
+                                   pkey.fingerprint.encode('hex')]
+    assert gh.get_authorized_keys_block().count('\n') == 3
+
+
+def test_update_authorized_keys_rebuilds_untagged(gh, user, pkey):
+    ak = gh.path / 'ak'
+    gh.config['local']['authorized_keys_file'] = str(ak)
+    gh.add_key(user, pkey)
+    gh.save()
+
+    # as written by older versions
+    ak.open('wb').write(ak.open('rb').read().replace(' githome:', ' x:'))
+
+    gh.delete_user('alice')
+    gh.save()
+
+    assert 'ssh-rsa' not in ak.open('rb').read()
+
+
+def test_add_keys(gh, user, pkey):
+    (gh.path / 'ak').open('wb').write(b'')
+    gh.config['local']['authorized_keys_file'] = str(gh.path / 'ak')
+
+    keys = make_keys(pkey, 5)
+    gh.add_key(user, keys[0])
+    gh.save()
+
+    statements = []
+    event.listen(gh.bind, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+
+    entries = [('alice', key) for key in keys] + [('Bob', pkey)]
+    with pytest.raises(GitHomeError):
+        gh.add_keys(entries, create_users=True)
+
+    added, skipped = gh.add_keys(entries, create_users=True,
+                                 skip_existing=True)
+    gh.session.commit()
+    assert (added, skipped) == (5, 1)
+    assert len(statements) <= 8
+
+    assert [k.fingerprint for k in gh.get_user_by_name('bob').public_keys] \
+        == [pkey.fingerprint.encode('hex')]
+    assert len(ak_fingerprints(gh)) == 1
+    gh.save()
+    assert len(ak_fingerprints(gh)) == 6
+
+
+def test_add_keys_checks_owners(gh, user, pkey):
+    with pytest.raises(UserNotFoundError):
+        gh.add_keys([('bob', pkey)])
+
+    with pytest.raises(GitHomeError):
+        gh.add_keys([('alice', pkey), ('bob', pkey)])
+
+
+def test_import_users(gh, user, pkey):
+    (gh.path / 'ak').open('wb').write(b'')
+    gh.config['local']['authorized_keys_file'] = str(gh.path / 'ak')
+
+    keys = make_keys(pkey, 3)
+    gh.add_key(user, keys[0])
+    gh.create_user('carol')
+    gh.save()
+
+    counts = gh.import_users([('Bob', keys[1:]), ('alice', [keys[0]])])
+    assert counts == {'created users': 1, 'deleted users': 0,
+                      'added keys': 2, 'removed keys': 0}
+    gh.save()
+
+    # moving a key needs a sync
+    with pytest.raises(GitHomeError):
+        gh.import_users([('alice', [keys[1]])])
+
+    counts = gh.import_users([('alice', keys[1:2]), ('bob', [])], sync=True)
+    assert counts == {'created users': 0, 'deleted users': 1,
+                      'added keys': 1, 'removed keys': 3}
+    gh.save()
+
+    assert list(gh.iter_user_keys()) == [('alice', [keys[1].data]),
+                                         ('bob', [])]
+    assert ak_fingerprints(gh) == [keys[1].fingerprint.encode('hex')]
+
+
+def test_save_notifies_running_server_only(gh):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(gh.path / gh.config['local']['gh_client_socket']))
+    listener.listen(1)
+    listener.settimeout(0.1)
+
+    # e.g. systemd listening for an idle server, which must not be woken
+    assert not gh.server_running()
+    gh.add_rule('alice', 'alice/*', 'rwc')
+    gh.save()
+    with pytest.raises(socket.timeout):
+        listener.accept()
+
+    with open(str(gh.path / gh.PID_PATH), 'w') as f:
+        f.write('{}\n'.format(os.getpid()))
+    assert gh.server_running()
+
+    # no reply, the connection is what counts
+    gh.NOTIFY_TIMEOUT = 0.1
+    gh.add_rule('bob', 'bob/*', 'rwc')
+    gh.save()
+    con, _ = listener.accept()
+    assert con.recv(100) == 'RELOAD\n'
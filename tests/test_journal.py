@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+from githome.journal import PushJournal
+from githome.maintenance import MaintenanceScheduler
+from githome.metrics import Registry
+import pytest
+
+
+ZERO, ONE = '0' * 40, '1' * 40
+NOW = datetime(2026, 10, 1, 12)
+
+
+@pytest.fixture
+def journal(gh):
+    return PushJournal(gh, None, Registry(), max_pending=4, retention=30)
+
+
+def events(gh):
+    return gh.session.execute(
+        'SELECT repo, user, ref, old, new, request_id FROM push_events '
+        'ORDER BY id').fetchall()
+
+
+def test_write(gh, journal):
+    gh.register_repo('a.git')
+    gh.session.commit()
+
+    journal.append('a.git', [(ZERO, ONE, 'refs/heads/master'),
+                             (ONE, ZERO, 'refs/heads/old')],
+                   user='alice', request_id='r1', time=NOW)
+    journal.append('b.git', [(ZERO, ONE, 'refs/tags/v1')], time=NOW)
+    assert journal.pending_events.value == 3
+
+    journal.flush()
+    assert journal.pending_events.value == 0
+    assert events(gh) == [
+        ('a.git', 'alice', 'refs/heads/master', ZERO, ONE, 'r1'),
+        ('a.git', 'alice', 'refs/heads/old', ONE, ZERO, 'r1'),
+        ('b.git', None, 'refs/tags/v1', ZERO, ONE, None),
+    ]
+
+    repo, = gh.iter_repos()
+    assert repo.last_push == NOW
+
+    # never moves back in time
+    journal.append('a.git', [(ONE, ZERO, 'refs/heads/x')],
+                   time=NOW - timedelta(days=1))
+    journal.flush()
+    repo, = gh.iter_repos()
+    assert repo.last_push == NOW
+
+
+def test_bounded(gh, journal):
+    update = (ZERO, ONE, 'refs/heads/master')
+    journal.append('a.git', [update] * 3)
+    journal.append('b.git', [update] * 3)
+    assert len(journal.pending) == 4
+    assert journal.dropped.value == 2
+
+    # failed writes are retried before newer events, as far as they fit
+    rows = journal.take(3)
+    journal.append('c.git', [update])
+    journal.requeue(rows)
+    assert [row['repo'] for row in journal.pending] == [
+        'a.git', 'a.git', 'b.git', 'c.git']
+    assert journal.dropped.value == 3
+
+
+def test_prune(gh, journal):
+    update = (ZERO, ONE, 'refs/heads/master')
+    journal.append('a.git', [update], time=NOW - timedelta(days=31))
+    journal.append('b.git', [update], time=NOW - timedelta(days=29))
+    journal.flush()
+
+    assert journal.prune(NOW) == 1
+    assert [row[0] for row in events(gh)] == ['b.git']
+
+
+def test_maintenance_counts_journaled_pushes(gh, journal):
+    scheduler = MaintenanceScheduler(gh, None, Registry())
+    gh.register_repo('a.git')
+    gh.register_repo('b.git')
+    gh.session.commit()
+
+    now = datetime.utcnow()
+    update = (ZERO, ONE, 'refs/heads/master')
+    # one push, reported in two parts
+    journal.append('a.git', [update], request_id='r1', time=now)
+    journal.append('a.git', [update], request_id='r1', time=now)
+    for i in range(3):
+        journal.append('b.git', [update], time=now - timedelta(minutes=i))
+    journal.flush()
+
+    assert scheduler.candidates({}, set()) == ['b.git', 'a.git']
+    # pushes known to the scheduler may not have been written yet
+    assert scheduler.candidates({'a.git': 5}, set()) == ['a.git', 'b.git']
+
+    # only pushes since the last maintenance count
+    gh.session.execute("UPDATE repositories SET maintained = :t "
+                       "WHERE path = 'b.git'",
+                       {'t': now - timedelta(seconds=90)})
+    gh.session.commit()
+    scheduler.min_interval = 0
+    assert scheduler.candidates({'a.git': 3}, set()) == ['a.git', 'b.git']
@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta
+import os
+import subprocess
+
+from githome import maintenance
+from githome.maintenance import MaintenanceScheduler, priority
+from githome.metrics import Registry
+import pytest
+import trollius as asyncio
+
+
+NOW = datetime(2026, 10, 1, 12)
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+
+def test_priority():
+    # nothing happened since the last maintenance
+    assert priority(0, None, None, NOW) is None
+    assert priority(0, NOW - DAY, NOW - HOUR, NOW) is None
+
+    # pushes recorded by a scan only
+    assert priority(0, NOW - HOUR, None, NOW) == pytest.approx(1 + 1 / 24.0)
+    assert priority(0, NOW - HOUR, NOW - DAY, NOW) == pytest.approx(2)
+
+    # every push counts as much as a day
+    assert priority(3, None, NOW - DAY, NOW) == pytest.approx(4)
+    assert priority(3, None, None, NOW) == 3
+
+
+@pytest.fixture
+def scheduler(gh):
+    loop = asyncio.get_event_loop()
+
+    def run_blocking(func, *args):
+        return loop.run_in_executor(None, func, *args)
+
+    return MaintenanceScheduler(gh, run_blocking, Registry(),
+                                min_interval=3600)
+
+
+def make_commit(path):
+    env = dict(os.environ, GIT_DIR=str(path), GIT_AUTHOR_NAME='a',
+               GIT_AUTHOR_EMAIL='a@example.com', GIT_COMMITTER_NAME='a',
+               GIT_COMMITTER_EMAIL='a@example.com')
+
+    def git(*args, **kwargs):
+        return subprocess.check_output(('git',) + args, env=env,
+                                       **kwargs).strip()
+
+    blob = git('hash-object', '-w', __file__)
+    tree_proc = subprocess.Popen(['git', 'mktree'], env=env,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    tree = tree_proc.communicate('100644 blob {}\ttest.py\n'.format(blob))[0]
+    commit = git('commit-tree', tree.strip(), '-m', 'test')
+    git('update-ref', 'refs/heads/master', commit)
+
+
+def test_candidates(gh, scheduler):
+    for name in ('a', 'b', 'c'):
+        gh.register_repo(name + '.git')
+    gh.session.commit()
+
+    gh.session.execute(
+        "UPDATE repositories SET maintained = :t WHERE path = 'c.git'",
+        {'t': datetime.utcnow()})
+    gh.session.commit()
+
+    pushes = {'a.git': 1, 'b.git': 2, 'c.git': 5, 'new.git': 1}
+    assert scheduler.candidates(pushes, set(['new.git'])) == ['b.git',
+                                                               'a.git']
+
+
+def test_maintain(gh, scheduler):
+    gh.get_repo('foo/bar.git', create=True, creator='alice')
+    gh.session.commit()
+    path = gh.repos.path('foo/bar.git')
+    make_commit(path)
+
+    scheduler.pushed('foo/bar.git')
+    assert scheduler.candidates(dict(scheduler.pushes), set()) == [
+        'foo/bar.git']
+
+    asyncio.get_event_loop().run_until_complete(
+        scheduler.maintain('foo/bar.git'))
+
+    packs = os.listdir(str(path / 'objects' / 'pack'))
+    assert any(name.endswith('.bitmap') for name in packs)
+    assert (path / 'objects' / 'info' / 'commit-graph').exists()
+    assert scheduler.runs['ok'].value == 1
+
+    # just maintained
+    assert scheduler.pushes == {}
+    assert scheduler.candidates({'foo/bar.git': 3}, set()) == []
+    repo, = gh.iter_repos()
+    assert repo.maintained is not None
+    assert repo.packs == 1 and repo.size > 0
+
+
+def test_optional_step_failures_are_recorded(gh, scheduler, monkeypatch):
+    # e.g. commit-graph on an older git
+    monkeypatch.setattr(maintenance, 'OPTIONAL_STEPS',
+                        [['no-such-command']])
+    gh.get_repo('foo.git', create=True)
+    gh.session.commit()
+    make_commit(gh.repos.path('foo.git'))
+
+    asyncio.get_event_loop().run_until_complete(
+        scheduler.maintain('foo.git'))
+
+    assert scheduler.runs['ok'].value == 1
+    assert scheduler.runs['failed'].value == 0
+    assert scheduler.backoff() == set()
+    repo, = gh.iter_repos()
+    assert repo.maintained is not None
+
+
+def test_record_registers_unknown_repos(gh, scheduler):
+    # e.g. created by githome-shell, never scanned
+    gh.session.execute(
+        "INSERT INTO push_events (time, repo, ref, old, new) "
+        "VALUES (:t, 'shell.git', 'refs/heads/master', '0', '1')",
+        {'t': datetime.utcnow() - timedelta(minutes=1)})
+    gh.session.commit()
+    assert scheduler.candidates({}, set()) == ['shell.git']
+
+    scheduler.record('shell.git')
+
+    repo, = gh.iter_repos()
+    assert repo.path == 'shell.git' and repo.maintained is not None
+    assert scheduler.candidates({}, set()) == []
+
+
+def test_failures_are_not_recorded(gh, scheduler):
+    gh.register_repo('broken.git')
+    gh.session.commit()
+    (gh.repos.root / 'broken.git').mkdir()
+
+    scheduler.pushed('broken.git')
+    asyncio.get_event_loop().run_until_complete(
+        scheduler.maintain('broken.git'))
+    assert scheduler.runs['failed'].value == 1
+
+    repo, = gh.iter_repos()
+    assert repo.maintained is None and repo.packs is None
+    assert scheduler.backoff() == set(['broken.git'])
+
+    scheduler.min_interval = 0
+    assert scheduler.backoff() == set()
@@ -0,0 +1,60 @@
+from githome.metrics import Registry
+import pytest
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_render_counter_family(registry):
+    ok = registry.counter('requests_total', 'Requests.', result='ok')
+    registry.counter('requests_total', 'Requests.', result='failed')
+    ok.inc()
+    ok.inc(2)
+
+    assert registry.render() == (
+        '# HELP requests_total Requests.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{result="ok"} 3\n'
+        'requests_total{result="failed"} 0\n'
+    )
+
+
+def test_render_histogram(registry):
+    h = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(5)
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        'latency_seconds_sum 5.55',
+        'latency_seconds_count 3',
+    ]
+
+
+def test_registry_labels(registry):
+    registry = Registry(worker=3)
+    registry.gauge('in_flight', 'In flight.').inc()
+
+    assert registry.render().splitlines()[-1] == 'in_flight{worker="3"} 1'
+
+
+@pytest.mark.parametrize('q,expected', [
+    (0.5, 0.5),
+    (0.9, 0.9),
+    (0.99, 0.99),
+])
+def test_histogram_quantile(registry, q, expected):
+    h = registry.histogram('x', 'X.', buckets=(1.0, 2.0))
+    for i in range(100):
+        h.observe(0.5)
+
+    assert h.quantile(q) == pytest.approx(expected)
+
+
+def test_histogram_quantile_empty(registry):
+    assert registry.histogram('x', 'X.').quantile(0.5) is None
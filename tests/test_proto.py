@@ -0,0 +1,52 @@
+from githome.exc import ProtocolError
+from githome.proto import HEADER, MAX_PAYLOAD, Message, unpack_header
+import struct
+import pytest
+
+
+def test_message_roundtrip():
+    msg = Message([('op', 'auth'), ('arg', 'a=b'), ('arg', ''),
+                   ('command', "git-upload-pack 'foo bar'")])
+    data = msg.encode()
+
+    version, length = unpack_header(data[:HEADER.size])
+    assert version == 1
+    assert length == len(data) - HEADER.size
+
+    decoded = Message.decode(data[HEADER.size:])
+    assert decoded == msg
+    assert decoded.get('op') == 'auth'
+    assert decoded.get('missing', 'x') == 'x'
+    assert decoded.get_all('arg') == ['a=b', '']
+
+
+def test_empty_message():
+    assert Message.decode(Message().encode()[HEADER.size:]) == []
+
+
+@pytest.mark.parametrize('header', [
+    'XGH' + struct.pack('!BI', 1, 0),
+    '\0GH' + struct.pack('!BI', 2, 0),
+    '\0GH' + struct.pack('!BI', 1, MAX_PAYLOAD + 1),
+])
+def test_invalid_header(header):
+    with pytest.raises(ProtocolError):
+        unpack_header(header)
+
+
+@pytest.mark.parametrize('payload', [
+    'op=auth',
+    'op=auth\0noequals\0',
+])
+def test_invalid_payload(payload):
+    with pytest.raises(ProtocolError):
+        Message.decode(payload)
+
+
+@pytest.mark.parametrize('field', [
+    ('na=me', 'value'),
+    ('name', 'nul\0byte'),
+])
+def test_invalid_field(field):
+    with pytest.raises(ProtocolError):
+        Message([field]).encode()
@@ -0,0 +1,123 @@
+from io import BytesIO
+import gzip
+
+from githome.exc import InvalidExport
+from githome.home import GitHome
+from githome.replica import (current_version, export_authz, import_authz,
+                             prune_log)
+from sshkeys import Key as SSHKey
+import pathlib
+import pytest
+
+
+@pytest.fixture
+def replica(tmpdir):
+    path = tmpdir / 'replica'
+    path.mkdir()
+    gh = GitHome.initialize(pathlib.Path(str(path)))
+    gh.config['local']['authorized_keys_file'] = str(path / 'ak')
+    gh.save()
+    return gh
+
+
+def transfer(source, replica, since=0):
+    buf = BytesIO()
+    version = export_authz(source, buf, since=since)
+    buf.seek(0)
+    import_authz(replica, buf)
+    return version
+
+
+def state(gh):
+    return (sorted((u.id, u.name) for u in gh.iter_users()),
+            sorted((k.fingerprint, k.user_id, k.data)
+                   for u in gh.iter_users() for k in u.public_keys),
+            list(gh.iter_rules()))
+
+
+def test_full_and_delta(gh, replica, pkey):
+    alice = gh.create_user('alice')
+    gh.add_key(alice, pkey)
+    gh.create_user('bob')
+    gh.add_rule('bob', 'bob/*', 'rwc')
+    gh.config['repos']['default_branch'] = 'main'
+    gh.save()
+
+    version = transfer(gh, replica)
+    assert state(replica) == state(gh)
+    assert replica.config['repos']['default_branch'] == 'main'
+    assert replica.config['local']['authorized_keys_file'] != \
+        gh.config['local']['authorized_keys_file']
+    block = replica.get_authorized_keys_block()
+    assert pkey.fingerprint.encode('hex') in block
+
+    gh.delete_user('alice')
+    gh.add_key(gh.get_user_by_name('bob'), SSHKey(pkey.data + 'x'))
+    del gh.config['repos']['default_branch']
+    gh.delete_rule(1)
+    gh.save()
+
+    transfer(gh, replica, since=version)
+    assert state(replica) == state(gh)
+    assert replica.rules.rules == [('bob', 'bob/*', 'rwc')]
+    assert 'default_branch' not in replica.config['repos']
+
+
+def test_delta_needs_previous_version(gh, replica):
+    gh.create_user('alice')
+    gh.save()
+    version = transfer(gh, replica)
+
+    # a delta the replica never sees
+    gh.create_user('bob')
+    gh.save()
+    later = export_authz(gh, BytesIO(), since=version)
+
+    gh.create_user('carol')
+    gh.save()
+    with pytest.raises(InvalidExport):
+        transfer(gh, replica, since=later)
+
+
+def test_checksum_mismatch(gh, replica):
+    gh.create_user('alice')
+    gh.save()
+
+    buf = BytesIO()
+    export_authz(gh, buf)
+    lines = gzip.GzipFile(fileobj=BytesIO(buf.getvalue())).readlines()
+    lines[1] = lines[1].replace('alice', 'mallory')
+
+    tampered = BytesIO()
+    with gzip.GzipFile(fileobj=tampered, mode='wb') as gz:
+        gz.writelines(lines)
+    tampered.seek(0)
+
+    with pytest.raises(InvalidExport):
+        import_authz(replica, tampered)
+    assert state(replica)[:2] == ([], [])
+
+
+def test_prune_log(gh, replica):
+    gh.create_user('alice')
+    gh.save()
+    version = transfer(gh, replica)
+
+    gh.create_user('bob')
+    gh.config['replica']['log_retention'] = 2
+    gh.save()
+    latest = current_version(gh.session)
+
+    assert prune_log(gh) > 0
+    gh.save()
+    count = gh.session.execute('SELECT count(*) FROM authz_log').scalar()
+    assert count == 2
+    assert current_version(gh.session) == latest
+
+    # the changes since the last import are gone, a delta would miss them
+    with pytest.raises(InvalidExport):
+        export_authz(gh, BytesIO(), since=version)
+
+    transfer(gh, replica)
+    assert state(replica) == state(gh)
+    transfer(gh, replica, since=latest - 1)
@@ -0,0 +1,327 @@
+from base64 import b64encode
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from githome.proto import Message
+from githome.exc import GitHomeError
+from githome.server import (SD_LISTEN_FDS_START, GitHomeServer, bind_socket,
+                            inherited_socket)
+import logbook
+import pytest
+import trollius as asyncio
+from trollius import From, Return
+
+
+@pytest.fixture
+def server(gh, pkey):
+    gh.add_key(gh.create_user('alice'), pkey)
+    gh.save()
+
+    server = GitHomeServer(gh)
+    server.index.refresh(force=True)
+    server.refresh_config(force=True)
+    server.refresh_rules(force=True)
+    yield server
+    server.index.close()
+
+
+def auth_request(server, pkey, command):
+    request = Message([('op', 'auth'),
+                       ('fingerprint', pkey.fingerprint.encode('hex')),
+                       ('command', command)])
+    return asyncio.get_event_loop().run_until_complete(
+        server.handle_auth(request, logbook.Logger('test'))
+    )
+
+
+def keys_request(server, user, key):
+    request = Message([('op', 'keys'), ('user', user), ('key', key)])
+    return asyncio.get_event_loop().run_until_complete(
+        server.handle_keys(request, logbook.Logger('test'))
+    )
+
+
+def test_keys_returns_authorized_keys_line(server, pkey):
+    reply = keys_request(server, server.system_user, b64encode(pkey.data))
+
+    assert reply.get('status') == 'ok'
+    assert reply.get_all('line') == list(server.gh.iter_authorized_keys())
+
+
+@pytest.mark.parametrize('user,key', [
+    ('someone-else', None),
+    (None, b64encode('unknown key')),
+    (None, '%%%'),
+])
+def test_keys_unknown(server, pkey, user, key):
+    reply = keys_request(server, user or server.system_user,
+                         key or b64encode(pkey.data))
+
+    assert reply.get('status') == 'ok'
+    assert reply.get_all('line') == []
+    assert len(server.index.unknown) == 0
+
+
+def test_auth_checks_rules(server, pkey):
+    gh = server.gh
+    assert not server.refresh_rules()
+
+    gh.delete_rule(1)
+    gh.add_rule('alice', 'shared/*', 'r')
+    gh.save()
+    assert server.refresh_rules()
+    assert not server.refresh_rules()
+
+    reply = auth_request(server, pkey, "git-receive-pack 'shared/x'")
+    assert reply.get('status') == 'error'
+
+    (gh.path / gh.REPOS_PATH / 'shared' / 'x.git').mkdir(parents=True)
+    server.loop = asyncio.get_event_loop()
+    reply = auth_request(server, pkey, "git-upload-pack 'shared/x'")
+    assert reply.get('status') == 'ok'
+
+
+def test_reads_use_read_only_connections(server):
+    gh = server.gh
+    assert server.refresh_config(force=True)
+    assert server.refresh_rules(force=True)
+
+    # nothing left open on the writable connection
+    assert not gh.session.registry.has()
+    assert gh.read_session.execute('PRAGMA query_only').scalar() == 1
+    gh.read_session.remove()
+
+
+def test_auth_throttles_failures(server, pkey):
+    server.key_failures.burst = server.user_failures.burst = 2
+    server.key_failures.rate = server.user_failures.rate = 0
+    server.loop = asyncio.get_event_loop()
+
+    auth_request(server, pkey, "git-upload-pack 'missing'")
+    auth_request(server, pkey, "git-upload-pack 'missing'")
+    reply = auth_request(server, pkey, "git-upload-pack 'missing'")
+    assert reply.get('status') == 'error'
+    assert server.connections['denied'].value == 2
+    assert server.connections['throttled'].value == 1
+
+    # unknown keys are remembered until the index is reloaded
+    unknown = Message([('op', 'auth'), ('fingerprint', '00' * 16),
+                       ('command', "git-upload-pack 'x'")])
+    for i in range(3):
+        asyncio.get_event_loop().run_until_complete(
+            server.handle_auth(unknown, logbook.Logger('test')))
+    assert server.connections['denied'].value == 3
+    assert server.connections['throttled'].value == 3
+
+
+def test_push_is_journaled(server):
+    def push(repo, *updates):
+        request = Message([('op', 'push'), ('repo', repo), ('user', 'alice'),
+                           ('request_id', 'r1')])
+        request.extend(('update', update) for update in updates)
+        return asyncio.get_event_loop().run_until_complete(
+            server.handle_push(request, logbook.Logger('test')))
+
+    root = server.repos_root
+    reply = push(root + '/foo/bar.git', '0' * 40 + ' ' + '1' * 40 +
+                 ' refs/heads/master', 'garbage')
+    assert reply.get('status') == 'ok'
+    row, = server.journal.pending
+    assert (row['repo'], row['user'], row['ref'], row['request_id']) == (
+        'foo/bar.git', 'alice', 'refs/heads/master', 'r1')
+
+    for repo in ('foo/bar.git', root + '/../x.git', root + '/~pool/x',
+                 root):
+        assert push(repo).get('status') == 'error'
+    assert len(server.journal.pending) == 1
+
+
+def test_sigterm_writes_pending_events(gh, tmpdir):
+    server = GitHomeServer(gh, pool_size=0, maintenance_jobs=0,
+                           journal_interval=3600)
+    server.journal.append('foo.git', [('0' * 40, '1' * 40,
+                                       'refs/heads/master')])
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.call_later(0.1, os.kill, os.getpid(), signal.SIGTERM)
+    try:
+        server.run(sock=bind_socket(str(tmpdir / 'sock')))
+    finally:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    assert gh.session.execute(
+        'SELECT repo, ref FROM push_events').fetchall() == [
+        ('foo.git', 'refs/heads/master')]
+
+
+def test_run_blocking_uses_thread_pool(gh):
+    server = GitHomeServer(gh, threads=2)
+    server.loop = loop = asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def ticks():
+        # counts while the blocking calls run
+        count = 0
+        while not all(f.done() for f in calls):
+            yield From(asyncio.sleep(0.01))
+            count += 1
+        raise Return(count)
+
+    start = time.time()
+    calls = [server.run_blocking(time.sleep, 0.2) for _ in range(2)]
+    count = loop.run_until_complete(ticks())
+    assert time.time() - start < 0.35
+    assert count > 5
+
+    thread = loop.run_until_complete(
+        server.run_blocking(threading.current_thread))
+    assert thread is not threading.current_thread()
+    server.executor.shutdown()
+    server.index.close()
+
+
+SUPERVISOR = """
+import sys
+from githome.home import GitHome
+from githome.server import Supervisor
+Supervisor(GitHome(sys.argv[1]), 2, restart_delay=0, pool_size=0,
+           maintenance_jobs=0, journal_interval=3600).run()
+"""
+
+
+def children(pid):
+    pids = set()
+    for name in os.listdir('/proc'):
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                # the process name may contain spaces, the fields after it
+                # are state and parent pid
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, ValueError, IndexError):
+            continue
+        if ppid == pid:
+            pids.add(int(name))
+    return pids
+
+
+def wait_for(check, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.05)
+    raise AssertionError('timed out')
+
+
+def send(path, request):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(request.encode())
+        return sock.makefile().read()
+    finally:
+        sock.close()
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason='needs /proc')
+def test_supervisor_restarts_and_stops_workers(gh):
+    sock_path = str(gh.path / gh.config['local']['gh_client_socket'])
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(
+            [sys.executable, '-c', SUPERVISOR, str(gh.path)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=devnull)
+    try:
+        workers = wait_for(lambda: len(children(proc.pid)) == 2 and
+                           children(proc.pid))
+
+        # a dead worker is replaced
+        dead = workers.pop()
+        os.kill(dead, signal.SIGKILL)
+        workers = wait_for(lambda: len(children(proc.pid)) == 2 and
+                           dead not in children(proc.pid) and
+                           children(proc.pid))
+
+        # serving, with a push event that is only written on shutdown
+        repo = os.path.join(os.path.realpath(str(gh.repos.root)), 'foo.git')
+        wait_for(lambda: os.path.exists(sock_path))
+        reply = send(sock_path, Message([
+            ('op', 'push'), ('repo', repo),
+            ('update', '0' * 40 + ' ' + '1' * 40 + ' refs/heads/master'),
+        ]))
+        assert 'status=ok' in reply
+
+        proc.send_signal(signal.SIGTERM)
+        assert wait_for(lambda: proc.poll() is not None) and \
+            proc.returncode == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    assert not os.path.exists(sock_path)
+    assert not any(os.path.exists('/proc/{}'.format(pid)) for pid in workers)
+    assert gh.session.execute('SELECT repo FROM push_events').fetchall() == [
+        ('foo.git',)]
+
+
+def test_inherited_socket(tmpdir, monkeypatch):
+    assert inherited_socket() is None
+
+    # meant for another process
+    monkeypatch.setenv('LISTEN_PID', str(os.getpid() + 1))
+    monkeypatch.setenv('LISTEN_FDS', '1')
+    assert inherited_socket() is None
+    assert 'LISTEN_FDS' not in os.environ
+
+    monkeypatch.setenv('LISTEN_PID', str(os.getpid()))
+    monkeypatch.setenv('LISTEN_FDS', '2')
+    with pytest.raises(GitHomeError):
+        inherited_socket()
+
+    path = str(tmpdir / 'sock')
+    listener = bind_socket(path)
+    try:
+        saved = os.dup(SD_LISTEN_FDS_START)
+    except OSError:
+        saved = None
+    os.dup2(listener.fileno(), SD_LISTEN_FDS_START)
+    listener.close()
+    try:
+        monkeypatch.setenv('LISTEN_PID', str(os.getpid()))
+        monkeypatch.setenv('LISTEN_FDS', '1')
+        monkeypatch.setenv('LISTEN_FDNAMES', 'githome.socket')
+        sock = inherited_socket()
+    finally:
+        if saved is not None:
+            os.dup2(saved, SD_LISTEN_FDS_START)
+            os.close(saved)
+
+    assert not any(name in os.environ for name in
+                   ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'))
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    sock.accept()[0].close()
+    client.close()
+    sock.close()
+
+
+def test_exit_when_idle(gh):
+    server = GitHomeServer(gh, idle_timeout=0.1)
+    server.loop = loop = asyncio.get_event_loop()
+
+    # a connection in progress keeps the server alive
+    server.in_flight.inc()
+    loop.call_later(0.3, server.in_flight.dec)
+
+    start = time.time()
+    loop.run_until_complete(server.exit_when_idle())
+    assert time.time() - start >= 0.3
+    server.index.close()
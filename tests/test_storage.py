@@ -0,0 +1,34 @@
+from githome.home import GitHome
+from githome.storage import create_engine
+from sqlalchemy.exc import OperationalError
+import pytest
+
+
+def pragma(bind, name):
+    with bind.connect() as con:
+        return con.execute('PRAGMA {}'.format(name)).scalar()
+
+
+def test_defaults(gh):
+    assert pragma(gh.bind, 'journal_mode') == 'wal'
+    assert pragma(gh.bind, 'busy_timeout') == 5000
+    assert pragma(gh.bind, 'synchronous') == 2
+
+
+def test_settings_from_config(gh):
+    gh.config.cset('sqlite.busy_timeout', 250)
+    gh.config.cset('sqlite.synchronous', 'normal')
+    gh.config.cset('sqlite.mmap_size', 'lots')
+    gh.save()
+
+    bind = GitHome(gh.path).bind
+    assert pragma(bind, 'busy_timeout') == 250
+    assert pragma(bind, 'synchronous') == 1
+
+
+def test_read_only(gh):
+    bind = create_engine(gh.dsn, read_only=True)
+    assert pragma(bind, 'query_only') == 1
+
+    with pytest.raises(OperationalError):
+        bind.execute("DELETE FROM config")
@@ -1,4 +1,5 @@
-from githome.util import sanitize_path, block_replace, block_update
+from githome.util import (sanitize_path, block_replace, block_update,
+                          iter_block_update, key_type)
 import pytest
 
 
@@ -104,3 +105,13 @@ def test_block_update_existing():
 def test_block_update_new():
     assert (block_update('{{\n', '\n}}\n', 'foobar', 'xy') ==
             'foobar\n\n{{\nxy\n}}\n')
+
+
+def test_iter_block_update_streams_chunks():
+    chunks = iter_block_update('foo', 'bar', 'fooxbaryfoozbar',
+                               iter(['!', '!']))
+    assert ''.join(chunks) == 'foo!!baryfoozbar'
+
+
+def test_key_type(pkey):
+    assert key_type(pkey.data) == 'ssh-rsa'